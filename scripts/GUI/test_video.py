@@ -1,12 +1,17 @@
 import sys
+import os
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'general_functions'))
+import video_inference as vid
 
 
 class MainWindow(QWidget):
-    def __init__(self):
+    def __init__(self, source=0, directory_model=''):
         super(MainWindow, self).__init__()
 
         self.VBL = QVBoxLayout()
@@ -14,44 +19,105 @@ class MainWindow(QWidget):
         self.FeedLabel = QLabel()
         self.VBL.addWidget(self.FeedLabel)
 
+        self.StatsLabel = QLabel()
+        self.VBL.addWidget(self.StatsLabel)
+
         self.CancelBTN = QPushButton("Cancel")
         self.CancelBTN.clicked.connect(self.CancelFeed)
         self.VBL.addWidget(self.CancelBTN)
 
-        self.Worker1 = Worker1()
+        self.Worker1 = Worker1(source=source, directory_model=directory_model)
 
         self.Worker1.start()
         self.Worker1.ImageUpdate.connect(self.ImageUpdateSlot)
+        self.Worker1.StatsUpdate.connect(self.StatsUpdateSlot)
+        self.Worker1.ErrorUpdate.connect(self.ErrorUpdateSlot)
         self.setLayout(self.VBL)
 
     def ImageUpdateSlot(self, Image):
         self.FeedLabel.setPixmap(QPixmap.fromImage(Image))
 
+    def StatsUpdateSlot(self, stats):
+        self.StatsLabel.setText(f"latency: {stats['latency'] * 1000:.0f} ms "
+                                f"(avg {stats['latency_avg'] * 1000:.0f} ms)   "
+                                f"fps: {stats['fps']:.1f}   "
+                                f"dropped frames: {stats['dropped']}")
+
+    def ErrorUpdateSlot(self, message):
+        self.StatsLabel.setText(f'Error: {message}')
+
     def CancelFeed(self):
         self.Worker1.stop()
 
 
+def load_live_model(directory_model):
+    """
+    Loads a keras model and chooses how to overlay its output: segmentation models (4D output) draw the mask,
+    classifiers write the top-1 class
+    :param directory_model: (str) path to the model
+    :return: model, annotate function
+    """
+    import tensorflow as tf
+    model = tf.keras.models.load_model(directory_model, compile=False)
+    if len(model.outputs[0].shape) == 4:
+        annotate_function = vid.annotate_segmentation()
+    else:
+        annotate_function = vid.annotate_classification()
+    return model, annotate_function
+
+
 class Worker1(QThread):
+    """
+    Runs the live pipeline of video_inference.LiveInference: capture thread -> newest frame slot -> inference
+    thread -> display. Stale frames are dropped when the inference falls behind, so the latency stays bounded.
+    A video file can be given as source instead of the camera, it is read at its own frame rate.
+    """
     ImageUpdate = pyqtSignal(QImage)
+    StatsUpdate = pyqtSignal(dict)
+    ErrorUpdate = pyqtSignal(str)
+
+    def __init__(self, source=0, directory_model=''):
+        super(Worker1, self).__init__()
+        self.source = source
+        self.directory_model = directory_model
+
     def run(self):
         self.ThreadActive = True
-        Capture = cv2.VideoCapture(0)
-        while self.ThreadActive:
-            ret, frame = Capture.read()
-            if ret:
-                Image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                FlippedImage = cv2.flip(Image, 1)
-                ConvertToQtFormat = QImage(FlippedImage.data, FlippedImage.shape[1], FlippedImage.shape[0], QImage.Format_RGB888)
-                Pic = ConvertToQtFormat.scaled(640, 480, Qt.KeepAspectRatio)
-                self.ImageUpdate.emit(Pic)
-        Capture.release()
+        model, annotate_function = None, None
+        if self.directory_model:
+            model, annotate_function = load_live_model(self.directory_model)
+        self.Pipeline = vid.LiveInference(self.source, model=model, on_result=self.EmitResult,
+                                          annotate_function=annotate_function)
+        self.Pipeline.start()
+        while self.ThreadActive and self.Pipeline.is_running():
+            self.msleep(50)
+        try:
+            self.Pipeline.stop()
+        except Exception as e:
+            self.ErrorUpdate.emit(repr(e))
+
+    def EmitResult(self, frame, stats):
+        Image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if isinstance(self.source, int):
+            Image = cv2.flip(Image, 1)
+        Image = np.ascontiguousarray(Image)
+        ConvertToQtFormat = QImage(Image.data, Image.shape[1], Image.shape[0], Image.strides[0],
+                                   QImage.Format_RGB888)
+        Pic = ConvertToQtFormat.scaled(640, 480, Qt.KeepAspectRatio)
+        self.ImageUpdate.emit(Pic)
+        self.StatsUpdate.emit(stats)
+
     def stop(self):
         self.ThreadActive = False
         self.quit()
 
 
 if __name__ == "__main__":
+    # usage: python test_video.py [camera index or video file] [model]
+    source = sys.argv[1] if len(sys.argv) > 1 else '0'
+    source = int(source) if source.isdigit() else source
+    directory_model = sys.argv[2] if len(sys.argv) > 2 else ''
     App = QApplication(sys.argv)
-    Root = MainWindow()
+    Root = MainWindow(source=source, directory_model=directory_model)
     Root.show()
-    sys.exit(App.exec())
\ No newline at end of file
+    sys.exit(App.exec())
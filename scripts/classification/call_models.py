@@ -9,6 +9,9 @@ from matplotlib import pyplot as plt
 import datetime
 import shutil
 import glob
+import tqdm
+import threading
+from concurrent import futures
 
 from absl import app, flags, logging
 from absl.flags import FLAGS
@@ -26,67 +29,128 @@ sys.path.append(os.getcwd() + '/scripts/general_functions/')
 
 import data_management as dam
 import data_analysis as daa
+import video_inference as vid
+import feature_cache as fcache
+import distributed_training as dist
 from classification import classification_models as cms
 import random
 
 
 class DataGenerator(tf.keras.utils.Sequence):
-    # Generates data for Keras
-    def __init__(self, list_IDs, labels, batch_size=32, dim=(64, 64), n_channels=1,
-                 n_classes=10, shuffle=True):
+    """
+    Generates batches of data for Keras from a list of image (or .npy) paths and their labels.
+
+    The images of a batch are decoded in parallel by a pool of threads (cv2 releases the GIL) directly into a
+    ring of preallocated uint8 buffers. The pool and the ring are created lazily in each process, so the
+    Sequence can be used with fit(workers=..., use_multiprocessing=True): every worker process builds its own
+    ones after the fork. With output_dtype='uint8' the batch returned is a view of a ring buffer that is reused
+    after ring_size batches, ring_size has to be larger than max_queue_size + workers of fit.
+    """
+    # the worker threads of fit call _init_process_resources concurrently, only one of them builds the pool
+    _init_lock = threading.Lock()
+
+    def __init__(self, list_IDs, labels, batch_size=32, dim=(64, 64), n_channels=3,
+                 n_classes=10, shuffle=True, preprocess_function=None, output_dtype='float32', num_threads=None,
+                 ring_size=16):
+        """
+        :param list_IDs: (list or dict) paths to the samples
+        :param labels: (list or dict) class index of each sample, indexed like list_IDs
+        :param batch_size: (int)
+        :param dim: (tuple) (width, height) of the samples
+        :param n_channels: (int)
+        :param n_classes: (int)
+        :param shuffle: (bool) shuffle the samples at the end of each epoch
+        :param preprocess_function: function applied to the float32 batch in [0, 255] (e.g. the preprocess_input
+        of a backbone), if None the batch is rescaled to [0, 1]
+        :param output_dtype: (str) 'float32' or 'uint8'
+        :param num_threads: (int) threads decoding each batch, by default min(batch_size, number of CPUs)
+        :param ring_size: (int) number of preallocated batch buffers
+        """
         # Initialization
-        self.dim = dim
+        keys = list(list_IDs.keys()) if isinstance(list_IDs, dict) else range(len(list_IDs))
+        self.dim = tuple(dim)
         self.batch_size = batch_size
-        self.labels = labels
-        self.list_IDs = list_IDs
+        self.list_IDs = [list_IDs[k] for k in keys]
+        self.labels = np.array([labels[k] for k in keys], dtype=int)
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.shuffle = shuffle
+        self.preprocess_function = preprocess_function
+        self.output_dtype = output_dtype
+        self.num_threads = num_threads or min(batch_size, os.cpu_count() or 1)
+        self.ring_size = ring_size
+        self._pid = None
         self.on_epoch_end()
 
     def __len__(self):
         # Denotes the number of batches per epoch
-        return int(np.floor(len(self.list_IDs) / self.batch_size))
+        return int(np.ceil(len(self.list_IDs) / self.batch_size))
 
     def __getitem__(self, index):
         # Generate one batch of data
         # Generate indexes of the batch
         indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
-        # Find list of IDs
-
-        list_IDs_temp = [self.list_IDs[k] for k in indexes]
 
         # Generate data
-        x, y = self.__data_generation(list_IDs_temp)
+        x, y = self.__data_generation(index, indexes)
 
         return x, y
 
+    def __getstate__(self):
+        # the thread pool and the lock can not be sent to the worker processes
+        state = self.__dict__.copy()
+        for key in ['_pool', '_ring', '_lock']:
+            state.pop(key, None)
+        state['_pid'] = None
+        return state
+
     def on_epoch_end(self):
         # Updates indexes after each epoch
         self.indexes = np.arange(len(self.list_IDs))
         if self.shuffle == True:
             np.random.shuffle(self.indexes)
 
-    def __data_generation(self, list_IDs_temp):
+    def _init_process_resources(self):
+        if self._pid == os.getpid():
+            return
+        with self._init_lock:
+            if self._pid != os.getpid():
+                self._pool = futures.ThreadPoolExecutor(max_workers=self.num_threads)
+                self._ring = np.zeros((self.ring_size, self.batch_size, self.dim[1], self.dim[0], self.n_channels),
+                                      dtype=np.uint8)
+                self._lock = threading.Lock()
+                self._next_slot = 0
+                # set last, the other threads only use the resources once it matches
+                self._pid = os.getpid()
+
+    def _read_sample(self, ID, buffer):
+        if ID.endswith('.npy'):
+            buffer[...] = np.load(ID)
+        else:
+            img = cv2.imread(ID)
+            cv2.resize(img, self.dim, dst=buffer, interpolation=cv2.INTER_LINEAR)
+            # same channel order as the images loaded by ImageDataGenerator
+            cv2.cvtColor(buffer, cv2.COLOR_BGR2RGB, dst=buffer)
+
+    def __data_generation(self, index, indexes):
         # Generates data containing batch_size samples' # X : (n_samples, *dim, n_channels)
-        # Initialization
-        x = np.empty((self.batch_size, self.dim, self.n_channels))
-        y = np.empty((self.batch_size), dtype=int)
+        self._init_process_resources()
+        with self._lock:
+            slot = self._next_slot
+            self._next_slot = (self._next_slot + 1) % self.ring_size
+        x = self._ring[slot, :len(indexes)]
 
         # Generate data
-        for i, ID in enumerate(list_IDs_temp):
-            # Store sample
-            if ID.endswith('.csv'):
-                x[i,] = np.load(ID)
-            elif ID.endswith('.png') or ID.endswith('.jpg') or ID.endswith('.jpeg'):
-                img = cv2.imread(ID)/255
-                reshaped = cv2.resize(img, self.dim)
-                x[i,] = reshaped
-
-            # Store class
-            y[i] = self.labels[i]
+        list(self._pool.map(lambda args: self._read_sample(self.list_IDs[args[1]], x[args[0]]),
+                            enumerate(indexes)))
+        # Store class
+        y = tf.keras.utils.to_categorical(self.labels[indexes], num_classes=self.n_classes)
 
-        return x, tf.keras.utils.to_categorical(y, num_classes=self.n_classes)
+        if self.output_dtype == 'uint8':
+            return x, y
+        if self.preprocess_function is not None:
+            return self.preprocess_function(x.astype(np.float32)), y
+        return x.astype(np.float32) / 255.0, y
 
 
 class CustomDataGenerator(ImageDataGenerator):
@@ -326,7 +390,8 @@ def fine_tune_backbone(model, training_generator, validation_generator, epochs,
                 batch_size, results_directory, new_results_id, shuffle=1, verbose=1,
                        learning_rate=0.001, trainable_layers=-1, optimizer='adam',
                        loss='categorical_crossentropy',
-                       metrics=["accuracy", tf.keras.metrics.Precision(), tf.keras.metrics.Recall()]):
+                       metrics=["accuracy", tf.keras.metrics.Precision(), tf.keras.metrics.Recall()],
+                       steps_per_epoch=None, validation_steps=None):
 
     print('Fine-tuning model')
     temp_name_model = results_directory + new_results_id + "_fine_tuned_model.h5"
@@ -342,6 +407,8 @@ def fine_tune_backbone(model, training_generator, validation_generator, epochs,
               shuffle=shuffle,
               batch_size=batch_size,
               validation_data=validation_generator,
+              steps_per_epoch=steps_per_epoch,
+              validation_steps=validation_steps,
               verbose=verbose,
               callbacks=callbacks)
 
@@ -380,6 +447,31 @@ def generate_dict_x_y(general_dict):
     return dict_x, dict_y, unique_values
 
 
+def generate_x_y_from_annotations(data_dir, annotations_file, label_column='tissue type'):
+    """
+    Lists the annotated images of a directory using the dataset manifest (data_management.build_dataset_manifest)
+    :param data_dir: (str) directory of the dataset
+    :param annotations_file: (str) name of the csv file inside data_dir
+    :param label_column: (str) column of the annotations with the class of each image
+    :return: (list) paths, (list) class index of each path, (list) name of the classes
+    """
+    manifest = dam.build_dataset_manifest(data_dir, csv_annotations=os.path.join(data_dir, annotations_file),
+                                          label_columns=[label_column])
+    list_x = list()
+    list_classes = list()
+    for rel_path in sorted(manifest['files']):
+        label = manifest['files'][rel_path]['labels'].get(label_column)
+        if label is not None:
+            list_x.append(os.path.join(data_dir, rel_path))
+            list_classes.append(label)
+
+    unique_values = sorted(set(list_classes))
+    class_indices = {value: i for i, value in enumerate(unique_values)}
+    list_y = [class_indices[value] for value in list_classes]
+
+    return list_x, list_y, unique_values
+
+
 def load_data(data_dir, annotations_file='', backbone_model='',
               img_size=(255, 255), batch_size=8, prediction_mode=False):
     # If using a pre-trained backbone model, then use the img data generator from the pretrained model
@@ -420,7 +512,8 @@ def load_data(data_dir, annotations_file='', backbone_model='',
             raise ValueError(f' MODEL: {backbone_model} not found')
 
     else:
-        pass
+        data_idg = ImageDataGenerator(rescale=1. / 255)
+        img_width, img_height = img_size
 
     if annotations_file == '':
         # determine if the structure of the directory is divided by classes or if there is an annotation file
@@ -439,16 +532,13 @@ def load_data(data_dir, annotations_file='', backbone_model='',
 
         else:
             if prediction_mode is True:
-                subdirs = [f for f in os.listdir(data_dir) if os.path.isdir(data_dir + f)]
-                total_all_imgs = 0
-                for subdir in subdirs:
-                    all_imgs = os.listdir(''.join([data_dir, subdir, '/']))
-                    total_all_imgs = total_all_imgs + len(all_imgs)
-                    data_generator = data_idg.flow_from_directory(data_dir,
-                                                                  batch_size=15,
-                                                                  class_mode='categorical',
-                                                                  target_size=(img_width, img_height),
-                                                                  shuffle=False)
+                # a single generator for all the class sub-folders, not shuffled so the order of the
+                # predictions matches data_generator.filenames
+                data_generator = data_idg.flow_from_directory(data_dir,
+                                                              batch_size=batch_size,
+                                                              class_mode='categorical',
+                                                              target_size=(img_width, img_height),
+                                                              shuffle=False)
 
             else:
                 data_generator = data_idg.flow_from_directory(data_dir,
@@ -459,22 +549,34 @@ def load_data(data_dir, annotations_file='', backbone_model='',
             num_classes = len(data_generator.class_indices)
     else:
         # read the annotations from a csv file
-        dataframe = pd.read_csv(data_dir + annotations_file)
-        data_dictionary = dam.build_dictionary_data_labels(data_dir)
-        # Parameters
-        data, labels, num_classes = generate_dict_x_y(data_dictionary)
-        params = {'dim': img_size,
-                  'batch_size': 8,
-                  'n_classes': num_classes,
-                  'n_channels': 3,
-                  'shuffle': True}
-        data_generator = DataGenerator(data, labels, params, annotations_file)
+        data, labels, classes = generate_x_y_from_annotations(data_dir, annotations_file)
+        num_classes = len(classes)
+        data_generator = DataGenerator(data, labels, batch_size=batch_size, dim=(img_width, img_height),
+                                       n_classes=num_classes, n_channels=3, shuffle=not prediction_mode,
+                                       preprocess_function=data_idg.preprocessing_function)
+        # same attributes as the generators of flow_from_directory
+        data_generator.filenames = data
+        data_generator.class_indices = {value: i for i, value in enumerate(classes)}
 
     return data_generator, num_classes
 
 
+def generator_augments(data_generator):
+    """
+    True if the batches of a generator returned by load_data are randomly augmented (e.g. the flips and the
+    brightness of the inception_v3 generator)
+    """
+    data_idg = getattr(data_generator, 'image_data_generator', None)
+    if data_idg is None:
+        return False
+    return bool(data_idg.rotation_range or data_idg.width_shift_range or data_idg.height_shift_range or
+                data_idg.shear_range or list(data_idg.zoom_range) != [1, 1] or data_idg.channel_shift_range or
+                data_idg.horizontal_flip or data_idg.vertical_flip or data_idg.brightness_range is not None)
+
+
 def train_model(model, training_generator, validation_generator, epochs,
-                batch_size, results_directory, new_results_id, shuffle=1, verbose=1):
+                batch_size, results_directory, new_results_id, shuffle=1, verbose=1, steps_per_epoch=None,
+                validation_steps=None):
     temp_name_model = results_directory + new_results_id + "_model.h5"
     callbacks = [
         ModelCheckpoint(temp_name_model,
@@ -488,45 +590,112 @@ def train_model(model, training_generator, validation_generator, epochs,
               shuffle=shuffle,
               batch_size=batch_size,
               validation_data=validation_generator,
+              steps_per_epoch=steps_per_epoch,
+              validation_steps=validation_steps,
               verbose=verbose,
               callbacks=callbacks)
 
     return trained_model
 
 
+def train_head_from_features(model, train_data_dir, validation_data_dir, backbone_model, epochs, batch_size,
+                             results_directory, new_results_id, feature_cache_dir):
+    """
+    Trains only the cap of a model with a frozen backbone: the pooled features of the backbone are computed once
+    over the train and validation data, stored on disk (memory-mapped) and the cap is trained from them. The cap
+    shares its layers with model, so model is trained as well.
+    :return: history of the training, None if the model can't be split (the backbone is trainable or the cap
+    doesn't start with a pooling layer) or if the generators of the backbone augment the images, in that case
+    nothing is trained
+    """
+    split_model = fcache.split_backbone_and_cap(model)
+    if split_model is None:
+        return None
+
+    extractor, head = split_model
+    head.compile(optimizer=model.optimizer, loss=model.loss,
+                 metrics=["accuracy", tf.keras.metrics.Precision(), tf.keras.metrics.Recall()])
+    datasets = list()
+    for data_dir in [train_data_dir, validation_data_dir]:
+        # not shuffled, the features are computed once in a fixed order
+        ordered_generator, _ = load_data(data_dir, backbone_model=backbone_model, batch_size=batch_size,
+                                         prediction_mode=True)
+        if generator_augments(ordered_generator):
+            # one random augmentation of each image would be frozen in the store
+            print(f'The images of {backbone_model} are augmented, features not cached')
+            return None
+        key = fcache.store_key(backbone_model, data_dir, ordered_generator.filenames)
+        features, labels = fcache.build_feature_store(extractor, ordered_generator, len(ordered_generator),
+                                                      len(ordered_generator.filenames), feature_cache_dir, key)
+        datasets.append((fcache.feature_dataset(features, labels, batch_size, shuffle=data_dir == train_data_dir),
+                         len(ordered_generator)))
+
+    (train_dataset, train_steps), (val_dataset, val_steps) = datasets
+    return train_model(head, train_dataset, val_dataset, epochs, batch_size, results_directory, new_results_id,
+                       steps_per_epoch=train_steps, validation_steps=val_steps)
+
+
 def evaluate_and_predict(model, directory_to_evaluate, results_directory,
-                         output_name='', results_id='', backbone_model='', batch_size=1,
-                         analyze_data=False, output_dir=''):
+                         output_name='', results_id='', backbone_model='', batch_size=13,
+                         analyze_data=False, output_dir='', annotations_file=''):
+    """
+    Evaluates a model in a directory and saves the predicted probabilities in a CSV file. Each image is decoded
+    once: the loss, the compiled metrics, the probabilities and the AUC (binary case) all come from the same
+    predictions.
+
+    :param model: compiled keras model
+    :param directory_to_evaluate: (str) directory with a sub-folder per class, or with an annotations file
+    :param results_directory: (str)
+    :param output_name: (str)
+    :param results_id: (str)
+    :param backbone_model: (str) name of the backbone, defines the pre-processing of the images
+    :param batch_size: (int)
+    :param analyze_data: (bool) calculate the AUC and save the ROC curve when there are 2 classes
+    :param output_dir:
+    :param annotations_file: (str) annotations file inside directory_to_evaluate
+    :return: (str) path to the CSV file
+    """
     print(f'Evaluation of: {directory_to_evaluate}')
 
     # load the data to evaluate and predict
-    data_gen, _ = load_data(directory_to_evaluate, backbone_model=backbone_model,
-                                  batch_size=13, prediction_mode=True)
-
-    evaluation = model.evaluate(data_gen, verbose=True)
-    print('Evaluation results:')
-    print(evaluation)
-    predictions = model.predict(data_gen, verbose=True)
+    data_gen, _ = load_data(directory_to_evaluate, annotations_file=annotations_file,
+                            backbone_model=backbone_model, batch_size=batch_size, prediction_mode=True)
+
+    compiled = getattr(model, 'compiled_loss', None) is not None
+    if compiled:
+        model.reset_metrics()
+    predictions = list()
+    real_values = list()
+    for i in tqdm.tqdm(range(len(data_gen)), desc='Evaluating'):
+        x, y = data_gen[i]
+        y_pred = model.predict_on_batch(x)
+        if compiled:
+            model.compiled_loss(tf.constant(y, dtype=y_pred.dtype), y_pred)
+            model.compiled_metrics.update_state(tf.constant(y, dtype=y_pred.dtype), y_pred)
+        predictions.append(np.asarray(y_pred))
+        real_values.append(np.argmax(y, axis=1))
+
+    predictions = np.concatenate(predictions)
+    real_values = np.concatenate(real_values)
+    if compiled:
+        print('Evaluation results:')
+        print({metric.name: float(metric.result()) for metric in model.metrics})
 
     # determine the top-1 prediction class
     predicts = np.argmax(predictions, axis=1)
-
-    x_p = x_p = [[] for _ in range(len(np.unique(predicts)))]
-    for x in predictions:
-        for i in range(len(np.unique(predicts))):
-            x_p[i].append(x[i])
+    num_classes = predictions.shape[1]
 
     label_index = {v: k for k, v in data_gen.class_indices.items()}
     predicts = [label_index[p] for p in predicts]
-    header_column = ['class_' + str(i+1) for i in range(len(np.unique(predicts)))]
+    header_column = ['class_' + str(i+1) for i in range(num_classes)]
     header_column.insert(0, 'fname')
     header_column.append('over all')
     df = pd.DataFrame(columns=header_column)
     df['fname'] = [os.path.basename(x) for x in data_gen.filenames]
 
-    for i in range(len(np.unique(predicts))):
+    for i in range(num_classes):
         class_name = 'class_' + str(i+1)
-        df[class_name] = x_p[i]
+        df[class_name] = predictions[:, i]
 
     df['over all'] = predicts
     # save the predictions  of each case
@@ -534,21 +703,69 @@ def evaluate_and_predict(model, directory_to_evaluate, results_directory,
     df.to_csv(results_csv_file, index=False)
 
     if analyze_data is True:
-        list_files = [f for f in os.listdir(directory_to_evaluate) if f.endswith('.csv')]
-        if list_files:
-            annotations_csv_data = list_files.pop()
-            dir_annotations_csv = directory_to_evaluate + annotations_csv_data
-
-            if len(np.unique(predicts)) == 2:
-                auc = daa.calculate_auc_and_roc(results_csv_file, dir_annotations_csv, output_name, plot=False,
-                                                results_directory=results_directory, results_id=results_id, save_plot=True)
-                print(f'AUC: {auc}')
-        else:
-            print(f'No annotation file found in {directory_to_evaluate}')
+        if num_classes == 2:
+            auc = daa.calculate_auc_and_roc_from_arrays(real_values, predictions[:, 1], output_name, plot=False,
+                                                        results_directory=results_directory,
+                                                        results_id=results_id, save_plot=True)
+            print(f'AUC: {auc}')
 
     return results_csv_file
 
 
+def evaluation_model(model, model_path, saved=False):
+    """
+    Model to evaluate after a training. With several workers (distributed_training) the model of the strategy can't
+    be evaluated outside strategy.run, the copy saved at model_path is loaded outside the strategy by the chief.
+    :param model: (keras Model)
+    :param model_path: (str)
+    :param saved: (bool) the model was already saved at model_path by all the workers
+    :return: keras Model, None in the workers other than the chief
+    """
+    if dist.num_workers() == 1:
+        return model
+    if saved is False:
+        model.save(model_path)
+    if not dist.is_chief():
+        return None
+    model = dist.load_saved_model(model_path)
+    model.compile(loss='categorical_crossentropy',
+                  metrics=["accuracy", tf.keras.metrics.Precision(), tf.keras.metrics.Recall()])
+    return model
+
+
+def get_backbone_preprocessing(backbone_model):
+    """
+    Returns the preprocess_input function of a backbone given its name (the name of the first layer of the models
+    built with build_model), None if it is not recognized
+    :param backbone_model: (str)
+    :return: function or None
+    """
+    preprocessing_functions = {'vgg16': tf.keras.applications.vgg16.preprocess_input,
+                               'vgg19': tf.keras.applications.vgg19.preprocess_input,
+                               'inception_v3': tf.keras.applications.inception_v3.preprocess_input,
+                               'resnet50': tf.keras.applications.resnet50.preprocess_input,
+                               'resnet101': tf.keras.applications.resnet.preprocess_input,
+                               'mobilenet': tf.keras.applications.mobilenet.preprocess_input,
+                               'densenet121': tf.keras.applications.densenet.preprocess_input,
+                               'xception': tf.keras.applications.xception.preprocess_input}
+    for name, function in preprocessing_functions.items():
+        if backbone_model.startswith(name):
+            return function
+    return None
+
+
+def predict_video(model, source, results_directory, results_id, backbone_model='', class_names=None,
+                  batch_size=8, max_latency=None):
+    """
+    Classifies the frames of a video (or of the webcam) with video_inference.predict_video
+    :param backbone_model: (str) name of the backbone, defines the pre-processing of the frames
+    :return: (dict) stats of the run
+    """
+    return vid.predict_video(model, source, results_directory, results_id,
+                             preprocess_input=get_backbone_preprocessing(backbone_model), class_names=class_names,
+                             batch_size=batch_size, max_latency=max_latency)
+
+
 def evalute_test_directory(model, test_data, results_directory, new_results_id, backbone_model, analyze_data=True):
 
     # determine if there are sub_folders or if it's the absolute path of the dataset
@@ -582,12 +799,15 @@ def evalute_test_directory(model, test_data, results_directory, new_results_id,
 def call_models(name_model, mode, data_dir=os.getcwd() + '/data/', validation_data_dir='',
                 test_data='', results_dir=os.getcwd() + '/results/', epochs=2, batch_size=4, learning_rate=0.001,
                 backbone_model='', eval_val_set=False, eval_train_set=False, analyze_data=False, directory_model='',
-                file_to_predic='', trainable_layers=-1, fine_tune_epochs=1):
+                file_to_predic='', trainable_layers=-1, fine_tune_epochs=1, cache_features=False,
+                feature_cache_dir=None):
 
 
     print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
     # Decide how to act according to the mode (train/predict/train-backbone... )
     if mode == 'train' or mode == 'train_backbone':
+        # if TF_CONFIG is set this process is one of the workers of a multi-worker training (distributed_training)
+        strategy = dist.get_strategy()
         # Determine what is the structure of the data directory,
         # if the directory contains train/val datasets
         if validation_data_dir == '':
@@ -607,11 +827,21 @@ def call_models(name_model, mode, data_dir=os.getcwd() + '/data/', validation_da
                                                     batch_size=batch_size)
         validation_generator, num_classes = load_data(validation_data_dir, backbone_model=backbone_model,
                                                       batch_size=batch_size)
+        train_steps, validation_steps = None, None
+        if dist.num_workers() > 1:
+            # each worker reads its own batches, the generators are not shuffled and the order of the batches is
+            # shuffled by shard_sequence in the same way in all the workers
+            ordered_training_generator, _ = load_data(train_data_dir, backbone_model=backbone_model,
+                                                      batch_size=batch_size, prediction_mode=True)
+            ordered_validation_generator, _ = load_data(validation_data_dir, backbone_model=backbone_model,
+                                                        batch_size=batch_size, prediction_mode=True)
+            training_generator, train_steps = dist.shard_sequence(ordered_training_generator)
+            validation_generator, validation_steps = dist.shard_sequence(ordered_validation_generator,
+                                                                         shuffle=False)
 
         # define a dir to save the results and Checkpoints
         # if results directory doesn't exist create it
-        if not os.path.isdir(results_dir):
-            os.mkdir(results_dir)
+        os.makedirs(results_dir, exist_ok=True)
 
         # ID name for the folder and results
         new_results_id = generate_experiment_ID(name_model=name_model, learning_rate=learning_rate,
@@ -619,6 +849,8 @@ def call_models(name_model, mode, data_dir=os.getcwd() + '/data/', validation_da
                                                 mode=mode)
 
         results_directory = ''.join([results_dir, new_results_id, '/'])
+        # only the chief writes in the results directory
+        results_directory = dist.worker_directory(results_directory)
         # if results experiment doesn't exists create it
         if not os.path.isdir(results_directory):
             os.mkdir(results_directory)
@@ -629,27 +861,53 @@ def call_models(name_model, mode, data_dir=os.getcwd() + '/data/', validation_da
         else:
             train_backbone = False
 
-        model = build_model(name_model, learning_rate, backbone_model, num_classes,
-                            train_backbone=train_backbone, trainable_layers=trainable_layers)
+        with strategy.scope():
+            model = build_model(name_model, learning_rate, backbone_model, num_classes,
+                                train_backbone=train_backbone, trainable_layers=trainable_layers,
+                                metrics=["accuracy", tf.keras.metrics.Precision(), tf.keras.metrics.Recall()])
 
         if train_backbone is True:
 
-            model = fine_tune_backbone(model, training_generator, validation_generator, fine_tune_epochs,
-                    batch_size, results_directory, new_results_id, trainable_layers=trainable_layers,
-                                       learning_rate=learning_rate)
+            with strategy.scope():
+                model = fine_tune_backbone(model, training_generator, validation_generator, fine_tune_epochs,
+                        batch_size, results_directory, new_results_id, trainable_layers=trainable_layers,
+                                           learning_rate=learning_rate,
+                                           metrics=["accuracy", tf.keras.metrics.Precision(),
+                                                    tf.keras.metrics.Recall()],
+                                           steps_per_epoch=train_steps, validation_steps=validation_steps)
 
             if test_data != '':
-                evalute_test_directory(model, test_data, results_directory, new_results_id + '(_pre)', backbone_model,
-                                       analyze_data=True)
+                pre_model = evaluation_model(model, ''.join([results_directory, 'fine_tuned_model_', new_results_id]))
+                if pre_model is not None:
+                    evalute_test_directory(pre_model, test_data, results_directory, new_results_id + '(_pre)',
+                                           backbone_model, analyze_data=True)
 
         # track time
         start_time = datetime.datetime.now()
         # Train the model
 
-        trained_model = train_model(model, training_generator, validation_generator, epochs,
-                    batch_size, results_directory, new_results_id)
+        trained_model = None
+        # the feature store is written by a single process
+        if cache_features is True and train_backbone is False and dist.num_workers() == 1:
+            if feature_cache_dir is None:
+                feature_cache_dir = os.path.join(results_dir, 'feature_cache')
+            trained_model = train_head_from_features(model, train_data_dir, validation_data_dir, backbone_model,
+                                                     epochs, batch_size, results_directory, new_results_id,
+                                                     feature_cache_dir)
+            if trained_model is None:
+                print('Features not cached, end-to-end training')
+
+        if trained_model is None:
+            trained_model = train_model(model, training_generator, validation_generator, epochs,
+                                        batch_size, results_directory, new_results_id,
+                                        steps_per_epoch=train_steps, validation_steps=validation_steps)
 
         model.save(''.join([results_directory, 'model_', new_results_id]))
+        model = evaluation_model(model, ''.join([results_directory, 'model_', new_results_id]), saved=True)
+        if model is None:
+            # the evaluation is only done by the chief
+            dist.remove_worker_directory(results_directory)
+            return
 
         print('Total Training TIME:', (datetime.datetime.now() - start_time))
         print('History Model Keys:')
@@ -673,7 +931,8 @@ def call_models(name_model, mode, data_dir=os.getcwd() + '/data/', validation_da
         backbone_model = model.get_layer(index=0).name
         print(f'Backbone identified: {backbone_model}')
         if daa.check_file_isvid(file_to_predic):
-            pass
+            new_results_id = generate_experiment_ID(prediction_model=os.path.basename(os.path.normpath(directory_model)))
+            predict_video(model, file_to_predic, directory_model, new_results_id, backbone_model=backbone_model)
         elif os.path.isdir(file_to_predic):
             new_results_id = generate_experiment_ID(prediction_model=os.path.basename(os.path.normpath(directory_model)))
             results_directory = directory_model
@@ -682,7 +941,9 @@ def call_models(name_model, mode, data_dir=os.getcwd() + '/data/', validation_da
                                    analyze_data=True)
 
         elif file_to_predic == 'webcam':
-            pass
+            # with a live source the batches are sent to the model at the latest 0.1 s after their first frame
+            new_results_id = generate_experiment_ID(prediction_model=os.path.basename(os.path.normpath(directory_model)))
+            predict_video(model, 0, directory_model, new_results_id, backbone_model=backbone_model, max_latency=0.1)
 
         else:
             print(f'Format or dir {file_to_predic} not understood')
@@ -728,7 +989,7 @@ def main(_argv):
                 batch_size=batch_zie, epochs=epochs, test_data=test_data,
                 analyze_data=analyze_data, directory_model=directory_model,
                 file_to_predic=file_to_predic,
-                trainable_layers=trainable_layers)
+                trainable_layers=trainable_layers, cache_features=FLAGS.cache_features)
 
 
 if __name__ == '__main__':
@@ -747,6 +1008,7 @@ if __name__ == '__main__':
     flags.DEFINE_bool('analyze_data', False, 'select if analyze data or not')
     flags.DEFINE_string('directory_model', '', 'indicate the path to the directory')
     flags.DEFINE_float('validation_split', 0.2, 'iif not validation dir but needed')
+    flags.DEFINE_bool('cache_features', False, 'compute the features of the frozen backbone once and train only the cap')
     flags.DEFINE_string('file_to_predic', '', 'Directory or file where to perform predictions if predict mode selected')
     flags.DEFINE_integer('trainable_layers', -1, 'Trainable layers in case backbone is trained')
 
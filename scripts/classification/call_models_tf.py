@@ -18,6 +18,15 @@ import time
 from tensorflow import keras
 import tensorflow_addons as tfa
 import cv2
+from general_functions import data_management as dam
+from general_functions import tf_augmentation as tfaug
+from general_functions import data_analysis as daa
+from general_functions import video_inference as vid
+from general_functions import generator_cache as gcache
+from general_functions import feature_cache as fcache
+from general_functions import custom_training as ctr
+from general_functions import distributed_training as dist
+from general_functions import tfrecord_data as tfr
 
 
 def generate_experiment_ID(name_model='', learning_rate='na', batch_size='na', backbone_model='',
@@ -59,46 +68,35 @@ def load_data_from_directory_v1(path_data, csv_annotations=None):
         Give a path, creates two lists with the
         Parameters
         ----------
-        path_data :
+        path_data : (str) root directory of the dataset
+        csv_annotations : (str) annotations file, the images of the directory not annotated are skipped
 
         Returns
         -------
+        list_files : (list) names of the annotated images found
+        dictionary_labels : (dict) {image_name: {'image_name', 'path_file', 'img_class', 'img_domain'}}
 
         """
 
-    images_path = list()
-    labels_class = list()
-    labels_domain = list()
     dictionary_labels = {}
+    # the directory listing is kept in a manifest and only refreshed for the directories that changed
+    manifest = dam.build_dataset_manifest(path_data, csv_annotations=csv_annotations)
+    name_index = dam.manifest_name_index(manifest)
 
-    list_files = os.listdir(path_data)
-    csv_list = [f for f in list_files if f.endswith('.csv')]
-    if csv_list:
-        csv_indir = csv_list.pop()
-    if csv_annotations:
-        data_frame = pd.read_csv(csv_annotations)
-        list_imgs = data_frame['image_name'].tolist()
-        list_classes = data_frame['tissue type'].tolist()
-        list_domain = data_frame['imaging type'].tolist()
-
-    list_unique_classes = np.unique(list_classes)
-    list_unique_domains = np.unique(list_domain)
     list_files = list()
-    list_path_files = list()
-
-    for (dirpath, dirnames, filenames) in os.walk(path_data):
-        list_files += [file for file in filenames]
-        list_path_files += [os.path.join(dirpath, file) for file in filenames]
-
-    for j, file in enumerate(list_imgs):
-        if file in list_files:
-            new_dictionary_labels = {file: {'image_name': file, 'path_file': list_path_files[j],
-                                            'img_class': list_classes[j], 'img_domain': list_domain[j]}}
-            dictionary_labels = {**dictionary_labels, **new_dictionary_labels}
-        else:
-            list_files.remove(file)
-
-    print(f'Found {len(list_path_files)} images corresponding to {len(list_unique_classes)} classes and '
+    for image_name, rel_path in name_index.items():
+        labels = manifest['files'][rel_path]['labels']
+        if labels.get('tissue type') is None or labels.get('imaging type') is None:
+            continue
+        list_files.append(image_name)
+        dictionary_labels[image_name] = {'image_name': image_name,
+                                         'path_file': os.path.join(path_data, rel_path),
+                                         'img_class': labels['tissue type'],
+                                         'img_domain': labels['imaging type']}
+
+    list_unique_classes = np.unique([v['img_class'] for v in dictionary_labels.values()])
+    list_unique_domains = np.unique([v['img_domain'] for v in dictionary_labels.values()])
+    print(f'Found {len(list_files)} images corresponding to {len(list_unique_classes)} classes and '
           f'{len(list_unique_domains)} domains at: {path_data}')
 
     return list_files, dictionary_labels
@@ -167,7 +165,7 @@ def read_stacked_images_npy(path_data):
 
     Returns
     -------
-
+    (array) uint8 stack of shape (3, 256, 256, 3), the cast to float is done inside the model
     """
     path_data = path_data.decode()
     if path_data.endswith('.npz'):
@@ -176,7 +174,7 @@ def read_stacked_images_npy(path_data):
     else:
         img = np.load(path_data)
 
-    img = img.astype(np.float64)
+    img = img.astype(np.uint8)
     return img
 
 
@@ -185,12 +183,12 @@ def read_stacked_images_npy_predict(path_data):
 
     Parameters
     ----------
-    path_data : (bytes) path to the data
+    path_data : (str) path to the data
     preprocessing_input : Pr-processing input unit to be used in case some backbone is used in the classifier
 
     Returns
     -------
-
+    (array) uint8 stack of shape (3, 256, 256, 3), the cast to float is done inside the model
     """
     if path_data.endswith('.npz'):
         img_array = np.load(path_data)
@@ -198,7 +196,7 @@ def read_stacked_images_npy_predict(path_data):
     else:
         img = np.load(path_data)
 
-    img = img.astype(np.float64)
+    img = img.astype(np.uint8)
     return img
 
 
@@ -210,17 +208,11 @@ def imread_tf(path):
 
 
 def tf_parser_npy(x, y):
-
-    def _parse(x, y):
-        x = read_stacked_images_npy(x)
-        out_y = np.zeros(NUM_CLASSES)
-        out_y[y] = 1.
-        out_y[y] = out_y[y].astype(np.float64)
-        return x, out_y
-
-    x, y = tf.numpy_function(_parse, [x, y], [tf.float64, tf.float64])
+    # only the file reading goes through numpy, the stack stays uint8 until it reaches the model
+    # and the one-hot label is built in-graph
+    x = tf.numpy_function(read_stacked_images_npy, [x], tf.uint8)
     x.set_shape([3, 256, 256, 3])
-    y.set_shape([NUM_CLASSES])
+    y = tf.one_hot(y, NUM_CLASSES)
     return x, y
 
 
@@ -268,7 +260,7 @@ def tf_parser_v1(x, y):
 
 
 def generate_tf_dataset_v1(list_x, dictionary_info, batch_size=1, shuffle=False, buffer_size=10, preprocess_function=None,
-                        input_size=(256, 256)):
+                        input_size=(256, 256), augment=False, augmentation_seed=0, shard=False):
 
     """
     Generates a tf dataset asd described in https://www.tensorflow.org/api_docs/python/tf/data/Dataset
@@ -278,6 +270,9 @@ def generate_tf_dataset_v1(list_x, dictionary_info, batch_size=1, shuffle=False,
     y : (list of int) target labels
     batch_size : int
     shuffle : (bool)
+    augment : (bool) augment the batches on the fly
+    augmentation_seed : (int)
+    shard : (bool) in a multi-worker training keep only the samples of this worker
 
     Returns
     -------
@@ -312,18 +307,195 @@ def generate_tf_dataset_v1(list_x, dictionary_info, batch_size=1, shuffle=False,
 
     #dataset = tf.data.Dataset.from_tensor_slices({"input_1": path_imgs, "input_2": images_domains}, images_class)
     dataset = tf.data.Dataset.from_tensor_slices((path_imgs, images_class))
+    if shard is True:
+        # each worker only reads its own images
+        dataset = dist.shard(dataset)
     if shuffle:
         dataset = dataset.shuffle(buffer_size=buffer_size * batch_size)
 
     dataset = dataset.map(tf_parser_v1)
     dataset = dataset.batch(batch_size)
     dataset = dataset.repeat()
+    if augment is True:
+        # the images are in [-1, 1] and the augmentation works in [0, 1]
+        dataset = dataset.map(lambda x, y: ((tf.cast(x, tf.float32) + 1.0) / 2.0, y))
+        dataset = tfaug.augment_tf_dataset(dataset, seed=augmentation_seed, paired_masks=False)
+        dataset = dataset.map(lambda x, y: (tf.cast(x * 2.0 - 1.0, tf.float64), y))
+
+    return dist.finalize_dataset(dataset) if shard is True else dataset
+
+
+def generate_tf_dataset_tfrecord(tfrecord_dir, split, batch_size=1, shuffle=False, buffer_size=10, augment=False,
+                                 augmentation_seed=0, shard=False):
+    """
+    Same batches as generate_tf_dataset (uint8 stacks, one-hot labels) read from the TFRecord shards written by
+    tfrecord_data.write_tfrecord_dataset, so each epoch reads a few large files instead of one .npy per sample
+
+    Parameters
+    ----------
+    tfrecord_dir : (str) directory with the shards and index.json
+    split : (str) name of the split, e.g. 'train'
+    batch_size : int
+    shuffle : (bool)
+    augment : (bool) augment the batches on the fly
+    augmentation_seed : (int)
+    shard : (bool) in a multi-worker training keep only the samples of this worker
+
+    Returns
+    -------
+    tensorflow Dataset, (int) number of samples of the split
+    """
+    data_type = tfr.read_index(tfrecord_dir)['splits'][split]['data_type']
+    if data_type != 'npy':
+        raise ValueError(f'the split {split} of {tfrecord_dir} has {data_type} samples, .npy stacks expected')
+
+    num_workers, worker_index = (dist.num_workers(), dist.worker_index()) if shard is True else (1, 0)
+    dataset, num_samples = tfr.read_tfrecord_dataset(tfrecord_dir, split, batch_size=batch_size, shuffle=shuffle,
+                                                     buffer_size=buffer_size * batch_size,
+                                                     num_workers=num_workers, worker_index=worker_index)
+    if augment is True:
+        dataset = tfaug.augment_tf_dataset(dataset, seed=augmentation_seed, paired_masks=False)
+    if shard is True:
+        dataset = dist.finalize_dataset(dataset)
+
+    return dataset, num_samples
+
+
+def generate_tf_dataset_triplet_store(store_dir, x, y, batch_size=1, shuffle=False, augment=False,
+                                      augmentation_seed=0, shard=False):
+    """
+    Same batches as generate_tf_dataset (uint8 stacks, one-hot labels) read from a triplet store written by
+    data_management.merge_multi_domain_data with output_format 'memmap' or 'hdf5', so the stacks come from a
+    single memory-mapped file instead of one .npy per sample
+
+    Parameters
+    ----------
+    store_dir : (str) path to the .npy or .h5 store
+    x : (list of strings) files of the samples, their names are looked up in the index of the store
+    y : (list of int) target labels
+    batch_size : int
+    shuffle : (bool)
+    augment : (bool) augment the batches on the fly
+    augmentation_seed : (int)
+    shard : (bool) in a multi-worker training keep only the samples of this worker
+
+    Returns
+    -------
+    tensorflow Dataset
+    """
+    global NUM_CLASSES
+
+    NUM_CLASSES = len(np.unique(y))
+    num_classes = NUM_CLASSES
+    store, index = dam.load_triplet_store(store_dir)
+    rows = dam.get_triplet_rows(index, x)
+    labels = np.asarray(y, dtype=np.int64)
+    if shard is True:
+        # each worker only reads its own rows
+        rows = rows[dist.worker_index()::dist.num_workers()]
+        labels = labels[dist.worker_index()::dist.num_workers()]
+    label_rows = dict(zip(rows.tolist(), labels.tolist()))
+
+    def _batches():
+        # iterate_triplet_batches sorts the rows of each batch, the labels follow the returned rows
+        for batch_rows, batch in dam.iterate_triplet_batches(store, rows, batch_size=batch_size, shuffle=shuffle):
+            batch_labels = [label_rows[row] for row in batch_rows.tolist()]
+            yield np.asarray(batch, dtype=np.uint8), np.eye(num_classes, dtype=np.float32)[batch_labels]
+
+    dataset = tf.data.Dataset.from_generator(
+        _batches, output_signature=(tf.TensorSpec(shape=(None,) + tuple(store.shape[1:]), dtype=tf.uint8),
+                                    tf.TensorSpec(shape=(None, num_classes), dtype=tf.float32)))
+    dataset = dataset.repeat()
+    if augment is True:
+        dataset = tfaug.augment_tf_dataset(dataset, seed=augmentation_seed, paired_masks=False)
+    if shard is True:
+        dataset = dist.finalize_dataset(dataset)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def get_target_domain(img_domain):
+    # the images are converted to the other domain, != 0 means the target domain is NBI
+    return int(str(img_domain).upper() != 'NBI')
+
+
+def generate_tf_dataset_cached_gan(list_x, dictionary_info, generator_cache, compute_function, batch_size=1,
+                                   shuffle=False, buffer_size=10, shard=False):
+    """
+    Dataset for the head of build_gan_model_features when the CycleGAN is frozen. The converted and reconverted
+    images are read from a generator_cache.GeneratorOutputCache instead of running the generators in every
+    epoch. The missing entries are computed with compute_function before the training, the input pipeline only
+    reads the cache (a ValueError is raised if the cache is too small for the dataset).
+
+    Parameters
+    ----------
+    list_x : (list of strings) names of the images
+    dictionary_info : (dict) information of each image as returned by load_data_from_directory_v1
+    generator_cache : (GeneratorOutputCache)
+    compute_function : function (images, target_domains) -> converted, reconverted
+    batch_size : int
+    shuffle : (bool)
+    shard : (bool) in a multi-worker training keep only the samples of this worker, each worker fills the cache
+    with its own samples
+
+    Returns
+    -------
+    tensorflow Dataset of ((original, converted, reconverted), label)
+    """
+    global NUM_CLASSES
+
+    path_imgs = [dictionary_info[img_name]['path_file'] for img_name in list_x]
+    images_class = [dictionary_info[img_name]['img_class'] for img_name in list_x]
+    target_domains = [get_target_domain(dictionary_info[img_name]['img_domain']) for img_name in list_x]
+
+    unique_classes = list(np.unique(images_class))
+    NUM_CLASSES = len(unique_classes)
+    images_class = [unique_classes.index(val) for val in images_class]
+
+    def _read_image(path):
+        return imread_tf(path).numpy()
+
+    # only the missing entries are computed, in batches, before the training starts
+    if shard is True:
+        # the same samples dist.shard keeps
+        generator_cache.fill(path_imgs[dist.worker_index()::dist.num_workers()],
+                             target_domains[dist.worker_index()::dist.num_workers()], _read_image, compute_function,
+                             batch_size=max(batch_size, 8))
+    else:
+        generator_cache.fill(path_imgs, target_domains, _read_image, compute_function,
+                             batch_size=max(batch_size, 8))
+
+    def _read_cached(path, target_domain):
+        # the generators are not run from the input pipeline, all the entries were computed by fill
+        outputs = generator_cache.get(path.decode(), target_domain)
+        if outputs is None:
+            raise ValueError(f'{path.decode()} not found in the generator cache {generator_cache.cache_dir}')
+        return outputs
+
+    def _parse(path, target_domain, y):
+        outputs = tf.numpy_function(_read_cached, [path, target_domain], tf.uint8)
+        outputs.set_shape([2, 256, 256, 3])
+        outputs = tf.cast(outputs, tf.float32) / 127.5 - 1.0
+        x = (imread_tf(path), outputs[0], outputs[1])
+        return x, tf.one_hot(y, NUM_CLASSES)
+
+    dataset = tf.data.Dataset.from_tensor_slices((path_imgs, target_domains, images_class))
+    if shard is True:
+        dataset = dist.shard(dataset)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=buffer_size * batch_size)
+
+    dataset = dataset.map(_parse, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.repeat()
+    if shard is True:
+        dataset = dist.finalize_dataset(dataset)
 
-    return dataset
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
 
 def generate_tf_dataset(x, y, batch_size=1, shuffle=False, buffer_size=10, preprocess_function=None,
-                        input_size=(256, 256)):
+                        input_size=(256, 256), augment=False, augmentation_seed=0, shard=False):
 
     """
     Generates a tf dataset asd described in https://www.tensorflow.org/api_docs/python/tf/data/Dataset
@@ -333,6 +505,9 @@ def generate_tf_dataset(x, y, batch_size=1, shuffle=False, buffer_size=10, prepr
     y : (list of int) target labels
     batch_size : int
     shuffle : (bool)
+    augment : (bool) augment the batches on the fly, the 3 frames of a stack get the same transformations
+    augmentation_seed : (int)
+    shard : (bool) in a multi-worker training keep only the samples of this worker
 
     Returns
     -------
@@ -347,14 +522,21 @@ def generate_tf_dataset(x, y, batch_size=1, shuffle=False, buffer_size=10, prepr
     INPUT_SIZE = input_size
 
     dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    if shard is True:
+        # each worker only reads its own files
+        dataset = dist.shard(dataset)
     if shuffle:
         dataset = dataset.shuffle(buffer_size=buffer_size * batch_size)
 
-    dataset = dataset.map(tf_parser_npy)
+    dataset = dataset.map(tf_parser_npy, num_parallel_calls=tf.data.AUTOTUNE)
     dataset = dataset.batch(batch_size)
     dataset = dataset.repeat()
+    if augment is True:
+        dataset = tfaug.augment_tf_dataset(dataset, seed=augmentation_seed, paired_masks=False)
+    if shard is True:
+        dataset = dist.finalize_dataset(dataset)
 
-    return dataset
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
 
 def analyze_tf_dataset(dataset_dir, plot=True):
@@ -456,6 +638,47 @@ def load_model(directory_model):
     return model, input_size
 
 
+# weights of the pretrained backbones already read in this process, {(weights file, include_top): list of arrays}
+_PRETRAINED_WEIGHTS = {}
+
+
+def build_pretrained_application(application, weights_dir, include_top=False, save_fast_load=True):
+    """
+    Builds a keras application with the weights saved in weights_dir. The .h5 file is parsed only once per
+    process, the weights are kept in memory and copied into every new model built afterwards. A NumPy archive
+    with the same weights is saved next to the .h5 (same name, .npz) and used instead of it by the next processes.
+
+    :param application: keras application constructor, e.g. applications.resnet.ResNet101
+    :param weights_dir: (str) path to the .h5 weights
+    :param include_top: (bool)
+    :param save_fast_load: (bool) save the .npz archive if it doesn't exist
+    :return: new keras Model
+    """
+    key = (weights_dir, include_top)
+    fast_load_dir = os.path.splitext(weights_dir)[0] + '.npz'
+    if key not in _PRETRAINED_WEIGHTS and os.path.isfile(fast_load_dir) and \
+            (not os.path.isfile(weights_dir) or os.path.getmtime(fast_load_dir) >= os.path.getmtime(weights_dir)):
+        with np.load(fast_load_dir) as archive:
+            _PRETRAINED_WEIGHTS[key] = [archive['arr_' + str(i)] for i in range(len(archive.files))]
+
+    if key in _PRETRAINED_WEIGHTS:
+        base_model = application(include_top=include_top, weights=None)
+        base_model.set_weights(_PRETRAINED_WEIGHTS[key])
+        return base_model
+
+    base_model = application(include_top=include_top, weights=weights_dir)
+    _PRETRAINED_WEIGHTS[key] = base_model.get_weights()
+    if save_fast_load is True:
+        temp_dir = fast_load_dir[:-len('.npz')] + '_' + str(os.getpid()) + '.tmp.npz'
+        try:
+            np.savez(temp_dir, *_PRETRAINED_WEIGHTS[key])
+            os.replace(temp_dir, fast_load_dir)
+        except OSError as e:
+            print(f'Fast load weights not saved: {e}')
+
+    return base_model
+
+
 def load_pretrained_backbones(name_model, weights='imagenet', include_top=False, trainable=False, new_name=None):
     base_dir_weights = ''.join([os.getcwd(), '/scripts/classification/weights_pretrained_models/'])
     """
@@ -466,31 +689,31 @@ def load_pretrained_backbones(name_model, weights='imagenet', include_top=False,
     """
     if name_model == 'vgg16':
         weights_dir = base_dir_weights + 'vgg16/vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'
-        base_model = applications.vgg16.VGG16(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.vgg16.VGG16, weights_dir, include_top=include_top)
         base_model.trainable = trainable
         input_size = (224, 224, 3)
 
     elif name_model == 'vgg19':
         weights_dir = base_dir_weights + 'vgg19/vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5'
-        base_model = applications.vgg19.VGG19(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.vgg19.VGG19, weights_dir, include_top=include_top)
         base_model.trainable = trainable
         input_size = (224, 224, 3)
 
     elif name_model == 'inception_v3':
         weights_dir = base_dir_weights + 'inception_v3/inception_v3_weights_tf_dim_ordering_tf_kernels_notop.h5'
-        base_model = applications.inception_v3.InceptionV3(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.inception_v3.InceptionV3, weights_dir, include_top=include_top)
         base_model.trainable = trainable
         input_size = (299, 299, 3)
 
     elif name_model == 'resnet50':
         weights_dir = base_dir_weights + 'resnet50/resnet50_weights_tf_dim_ordering_tf_kernels_notop.h5'
-        base_model = applications.resnet50.ResNet50(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.resnet50.ResNet50, weights_dir, include_top=include_top)
         base_model.trainable = True
         input_size = (224, 224, 3)
 
     elif name_model == 'resnet101':
         weights_dir = base_dir_weights + 'resnet101/resnet101_weights_tf_dim_ordering_tf_kernels_notop.h5'
-        base_model = applications.resnet.ResNet101(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.resnet.ResNet101, weights_dir, include_top=include_top)
         base_model.trainable = True
         #layer1 = base_model.layers[2]
         #global weights_1
@@ -509,28 +732,27 @@ def load_pretrained_backbones(name_model, weights='imagenet', include_top=False,
 
     elif name_model == 'mobilenet':
         weights_dir = base_dir_weights + 'mobilenet/mobilenet_1_0_224_tf_no_top.h5'
-        base_model = applications.mobilenet.MobileNet(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.mobilenet.MobileNet, weights_dir, include_top=include_top)
         base_model.trainable = trainable
         input_size = (224, 224, 3)
 
     elif name_model == 'densenet121':
         weights_dir = base_dir_weights + 'densenet/densenet121_weights_tf_dim_ordering_tf_kernels_notop.h5'
-        base_model = applications.densenet.DenseNet121(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.densenet.DenseNet121, weights_dir, include_top=include_top)
         base_model.trainable = trainable
         input_size = (224, 224, 3)
 
     elif name_model == 'xception':
         weights_dir = base_dir_weights + 'xception/xception_weights_tf_dim_ordering_tf_kernels_notop.h5'
-        base_model = applications.xception.Xception(include_top=include_top, weights=weights_dir)
+        base_model = build_pretrained_application(applications.xception.Xception, weights_dir, include_top=include_top)
         base_model.trainable = trainable
         input_size = (299, 299, 3)
 
     else:
         raise ValueError(f' MODEL: {name_model} not found')
 
-    new_base_model = tf.keras.models.clone_model(base_model)
-    new_base_model.set_weights(base_model.get_weights())
-    return new_base_model
+    # every call builds a new model, the weights are copied from the in-memory cache
+    return base_model
 
 class Checkpoint:
     """Enhanced "tf.train.Checkpoint"."""
@@ -673,6 +895,21 @@ def ResnetGenerator(input_shape=(256, 256, 3),
     return keras.Model(inputs=inputs, outputs=h)
 
 
+def backbone_preprocessing(x, backbone):
+    # preprocess_input of the keras application of the backbone
+    if backbone == 'resnet101':
+        x = tf.keras.applications.resnet.preprocess_input(x)
+    elif backbone == 'resnet50':
+        x = tf.keras.applications.resnet50.preprocess_input(x)
+    elif backbone == 'densenet121':
+        x = tf.keras.applications.densenet.preprocess_input(x)
+    elif backbone == 'vgg19':
+        x = tf.keras.applications.vgg19.preprocess_input(x)
+    elif backbone == 'inception_v3':
+        x = tf.keras.applications.inception_v3.preprocess_input(x)
+    return x
+
+
 def build_model_v1(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat='globalpooling',
                 dropout=False):
 
@@ -681,23 +918,15 @@ def build_model_v1(backbones=['resnet101', 'resnet101', 'resnet101'], after_conc
                           'densenet121': (224, 224), 'xception': (299, 299)}
 
     num_backbones = len(backbones)
-    input_model = Input((3, 256, 256, 3))
-    x1, x2, x3 = tf.split(input_model, 3, axis=1)
+    input_model = Input((3, 256, 256, 3), dtype=tf.uint8)
+    # the stacks arrive as uint8 and are cast only once, on device
+    x1, x2, x3 = tf.split(tf.cast(input_model, tf.float32), 3, axis=1)
     input_backbone_1 = tf.squeeze(x1, axis=1)
     input_backbone_2 = tf.squeeze(x2, axis=1)
     input_backbone_3 = tf.squeeze(x3, axis=1)
 
     b1 = tf.image.resize(input_backbone_1, input_sizes_models[backbones[0]], method='bilinear')
-    if backbones[0] == 'resnet101':
-        b1 = tf.keras.applications.resnet.preprocess_input(b1)
-    elif backbones[0] == 'resnet50':
-        b1 = tf.keras.applications.resnet50.preprocess_input(b1)
-    elif backbones[0] == 'densenet121':
-        b1 = tf.keras.applications.densenet.preprocess_input(b1)
-    elif backbones[0] == 'vgg19':
-        b1 = tf.keras.applications.vgg19.preprocess_input(b1)
-    elif backbones[0] == 'inception_v3':
-        b1 = tf.keras.applications.inception_v3.preprocess_input(b1)
+    b1 = backbone_preprocessing(b1, backbones[0])
 
     backbone_model_1 = load_pretrained_backbones(backbones[0])
     backbone_model_1._name = 'backbone_1'
@@ -713,16 +942,7 @@ def build_model_v1(backbones=['resnet101', 'resnet101', 'resnet101'], after_conc
     l1 = Flatten()(l1)
 
     b2 = tf.image.resize(input_backbone_2, input_sizes_models[backbones[1]], method='bilinear')
-    if backbones[1] == 'resnet101':
-        b2 = tf.keras.applications.resnet.preprocess_input(b2)
-    elif backbones[1] == 'resnet50':
-        b2 = tf.keras.applications.resnet50.preprocess_input(b2)
-    elif backbones[1] == 'densenet121':
-        b2 = tf.keras.applications.densenet.preprocess_input(b2)
-    elif backbones[1] == 'vgg19':
-        b2 = tf.keras.applications.vgg19.preprocess_input(b2)
-    elif backbones[1] == 'inception_v3':
-        b2 = tf.keras.applications.inception_v3.preprocess_input(b2)
+    b2 = backbone_preprocessing(b2, backbones[1])
     backbone_model_2 = load_pretrained_backbones(backbones[1])
     backbone_model_2._name = 'backbone_2'
     for layer in backbone_model_2.layers:
@@ -738,16 +958,7 @@ def build_model_v1(backbones=['resnet101', 'resnet101', 'resnet101'], after_conc
 
     if num_backbones == 3:
         b3 = tf.image.resize(input_backbone_3, input_sizes_models[backbones[2]], method='bilinear')
-        if backbones[2] == 'resnet101':
-            b3 = tf.keras.applications.resnet.preprocess_input(b3)
-        elif backbones[2] == 'resnet50':
-            b3 = tf.keras.applications.resnet50.preprocess_input(b3)
-        elif backbones[2] == 'densenet121':
-            b3 = tf.keras.applications.densenet.preprocess_input(b3)
-        elif backbones[2] == 'vgg19':
-            b3 = tf.keras.applications.vgg19.preprocess_input(b3)
-        elif backbones[2] == 'inception_v3':
-            b3 = tf.keras.applications.inception_v3.preprocess_input(b3)
+        b3 = backbone_preprocessing(b3, backbones[2])
         backbone_model_3 = load_pretrained_backbones(backbones[2])
         backbone_model_3._name = 'backbone_3'
         for layer in backbone_model_3.layers:
@@ -780,23 +991,15 @@ def multi_output_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_
                           'densenet121': (224, 224), 'xception': (299, 299)}
 
     num_backbones = len(backbones)
-    input_model = Input((3, 256, 256, 3))
-    x1, x2, x3 = tf.split(input_model, 3, axis=1)
+    input_model = Input((3, 256, 256, 3), dtype=tf.uint8)
+    # the stacks arrive as uint8 and are cast only once, on device
+    x1, x2, x3 = tf.split(tf.cast(input_model, tf.float32), 3, axis=1)
     input_backbone_1 = tf.squeeze(x1, axis=1)
     input_backbone_2 = tf.squeeze(x2, axis=1)
     input_backbone_3 = tf.squeeze(x3, axis=1)
 
     b1 = tf.image.resize(input_backbone_1, input_sizes_models[backbones[0]], method='bilinear')
-    if backbones[0] == 'resnet101':
-        b1 = tf.keras.applications.resnet.preprocess_input(b1)
-    elif backbones[0] == 'resnet50':
-        b1 = tf.keras.applications.resnet50.preprocess_input(b1)
-    elif backbones[0] == 'densenet121':
-        b1 = tf.keras.applications.densenet.preprocess_input(b1)
-    elif backbones[0] == 'vgg19':
-        b1 = tf.keras.applications.vgg19.preprocess_input(b1)
-    elif backbones[0] == 'inception_v3':
-        b1 = tf.keras.applications.inception_v3.preprocess_input(b1)
+    b1 = backbone_preprocessing(b1, backbones[0])
 
     backbone_model_1 = load_pretrained_backbones(backbones[0])
     backbone_model_1._name = 'backbone_1'
@@ -805,16 +1008,7 @@ def multi_output_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_
     b1 = backbone_model_1(b1)
 
     b2 = tf.image.resize(input_backbone_2, input_sizes_models[backbones[1]], method='bilinear')
-    if backbones[1] == 'resnet101':
-        b2 = tf.keras.applications.resnet.preprocess_input(b2)
-    elif backbones[1] == 'resnet50':
-        b2 = tf.keras.applications.resnet50.preprocess_input(b2)
-    elif backbones[1] == 'densenet121':
-        b2 = tf.keras.applications.densenet.preprocess_input(b2)
-    elif backbones[1] == 'vgg19':
-        b2 = tf.keras.applications.vgg19.preprocess_input(b2)
-    elif backbones[1] == 'inception_v3':
-        b2 = tf.keras.applications.inception_v3.preprocess_input(b2)
+    b2 = backbone_preprocessing(b2, backbones[1])
     backbone_model_2 = load_pretrained_backbones(backbones[1])
     backbone_model_2._name = 'backbone_2'
     for layer in backbone_model_2.layers:
@@ -822,16 +1016,7 @@ def multi_output_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_
     b2 = backbone_model_2(b2)
     if num_backbones == 3:
         b3 = tf.image.resize(input_backbone_3, input_sizes_models[backbones[2]], method='bilinear')
-        if backbones[2] == 'resnet101':
-            b3 = tf.keras.applications.resnet.preprocess_input(b3)
-        elif backbones[2] == 'resnet50':
-            b3 = tf.keras.applications.resnet50.preprocess_input(b3)
-        elif backbones[2] == 'densenet121':
-            b3 = tf.keras.applications.densenet.preprocess_input(b3)
-        elif backbones[2] == 'vgg19':
-            b3 = tf.keras.applications.vgg19.preprocess_input(b3)
-        elif backbones[2] == 'inception_v3':
-            b3 = tf.keras.applications.inception_v3.preprocess_input(b3)
+        b3 = backbone_preprocessing(b3, backbones[2])
         backbone_model_3 = load_pretrained_backbones(backbones[2])
         backbone_model_3._name = 'backbone_3'
         for layer in backbone_model_3.layers:
@@ -894,23 +1079,45 @@ def multi_output_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_
     return Model(inputs=input_model, outputs=[output_layer, output_l1, output_l2, output_l3, output_l4], name='multi_input_output_classification')
 
 
-def build_generator_base(G_A2B, G_B2A):
-
-    input_model = Input((256, 256, 3))
-    t_input = Input(shape=(1,), dtype=tf.int32, name="t_input")
+def cycle_gan_conversion(G_A2B, G_B2A, input_image, t_input):
+    """
+    Converts and reconverts each sample only through the pair of generators its target domain needs, instead of
+    running both cycles on every sample and choosing one afterwards. The batch is split by domain with
+    tf.dynamic_partition and the outputs are put back in the original order with tf.dynamic_stitch.
+
+    :param G_A2B: (keras Model) generator from domain A (WLI) to domain B (NBI)
+    :param G_B2A: (keras Model) generator from domain B (NBI) to domain A (WLI)
+    :param input_image: (tensor) batch of images, shape (n, 256, 256, 3)
+    :param t_input: (tensor) target domain of each sample, shape (n, 1), != 0 if the target domain is NBI
+    :return: converted, reconverted images, same shape and order as input_image
+    """
+    domain = tf.cast(tf.not_equal(tf.reshape(t_input, [-1]), 0), tf.int32)
+    indices = tf.range(tf.shape(input_image)[0])
+    images_to_wli, images_to_nbi = tf.dynamic_partition(input_image, domain, 2)
+    indices_to_wli, indices_to_nbi = tf.dynamic_partition(indices, domain, 2)
 
     # branch 1 if target domain is NBI
-    c1 = G_A2B(input_model)
+    c1 = G_A2B(images_to_nbi)
     r1 = G_B2A(c1)
-    #x1 = [c1, r1]
 
     # branch 2 if target domain is WLI
-    c2 = G_B2A(input_model)
+    c2 = G_B2A(images_to_wli)
     r2 = G_A2B(c2)
-    #x2 = [c2, r2]
 
-    c = tf.keras.backend.switch(t_input, c1, c2)
-    r = tf.keras.backend.switch(t_input, r1, r2)
+    c = tf.dynamic_stitch([indices_to_nbi, indices_to_wli], [c1, c2])
+    r = tf.dynamic_stitch([indices_to_nbi, indices_to_wli], [r1, r2])
+    c.set_shape(input_image.shape)
+    r.set_shape(input_image.shape)
+
+    return c, r
+
+
+def build_generator_base(G_A2B, G_B2A):
+
+    input_model = Input((256, 256, 3))
+    t_input = Input(shape=(1,), dtype=tf.int32, name="t_input")
+
+    c, r = cycle_gan_conversion(G_A2B, G_B2A, input_model, t_input)
     output_layer = [c, r]
     return Model(inputs=[t_input, input_model], outputs=output_layer, name='multi_input_output_classification')
 
@@ -919,52 +1126,52 @@ def build_gan_model_merge_out():
     pass
 
 
-def build_gan_model_features(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat='globalpooling',
-                dropout=False, gan_base='checkpoint_charlie'):
+def get_gan_checkpoint_dir(gan_base='checkpoint_charlie'):
+    return ''.join([os.getcwd(), '/scripts/gan_models/CycleGan/sample_weights/', gan_base])
 
-    input_sizes_models = {'vgg16': (224, 224), 'vgg19': (224, 224), 'inception_v3': (299, 299),
-                          'resnet50': (224, 224), 'resnet101': (224, 244), 'mobilenet': (224, 224),
-                          'densenet121': (224, 224), 'xception': (299, 299)}
-    checkpoint_dir = ''.join([os.getcwd(), '/scripts/gan_models/CycleGan/sample_weights/', gan_base])
 
+def load_cycle_gan(gan_base='checkpoint_charlie'):
     # Generator Models
     G_A2B = ResnetGenerator(input_shape=(256, 256, 3))
     G_B2A = ResnetGenerator(input_shape=(256, 256, 3))
 
-    Checkpoint(dict(G_A2B=G_A2B, G_B2A=G_B2A), checkpoint_dir).restore()
+    Checkpoint(dict(G_A2B=G_A2B, G_B2A=G_B2A), get_gan_checkpoint_dir(gan_base)).restore()
+    return G_A2B, G_B2A
+
+
+def build_gan_model_features(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat='globalpooling',
+                dropout=False, gan_base='checkpoint_charlie', return_head=False, generators=None):
+    """
+    Classifier of the features of the original, converted and reconverted images. The head (backbones and dense
+    layers) is a model of its own with inputs [original, converted, reconverted], so it can be trained from
+    cached generator outputs while the full model, which shares its layers, keeps the inputs [t_input, image].
+
+    :param return_head: (bool) return also the head model
+    :param generators: (tuple) G_A2B, G_B2A already loaded, otherwise they are restored from gan_base. They are
+    frozen.
+    :return: model, or (model, head) if return_head is True
+    """
+
+    input_sizes_models = {'vgg16': (224, 224), 'vgg19': (224, 224), 'inception_v3': (299, 299),
+                          'resnet50': (224, 224), 'resnet101': (224, 244), 'mobilenet': (224, 224),
+                          'densenet121': (224, 224), 'xception': (299, 299)}
+
+    G_A2B, G_B2A = generators if generators is not None else load_cycle_gan(gan_base)
+    # the generators are fixed, the same parameters are trained with or without the cache of their outputs
+    G_A2B.trainable = False
+    G_B2A.trainable = False
     num_backbones = len(backbones)
 
-    input_image = Input((256, 256, 3))
-    t_input = Input(shape=(1,), dtype=tf.int32, name="t_input")
+    input_head_1 = Input((256, 256, 3), name='input_original')
+    input_head_2 = Input((256, 256, 3), name='input_converted')
+    input_head_3 = Input((256, 256, 3), name='input_reconverted')
 
-    # branch 1 if target domain is NBI
-    c1 = G_A2B(input_image)
-    r1 = G_B2A(c1)
-    # x1 = [c1, r1]
+    input_backbone_1 = input_head_1
+    input_backbone_2 = input_head_2
+    input_backbone_3 = input_head_3
+    b1 = tf.image.resize(input_backbone_1, input_sizes_models[backbones[0]], method='bilinear')
 
-    # branch 2 if target domain is WLI
-    c2 = G_B2A(input_image)
-    r2 = G_A2B(c2)
-    # x2 = [c2, r2]
-
-    c = tf.keras.backend.switch(t_input, c1, c2)
-    r = tf.keras.backend.switch(t_input, r1, r2)
-
-    input_backbone_1 = input_image
-    input_backbone_2 = c
-    input_backbone_3 = r
-    b1 = tf.image.resize(input_image, input_sizes_models[backbones[0]], method='bilinear')
-
-    if backbones[0] == 'resnet101':
-        b1 = tf.keras.applications.resnet.preprocess_input(b1)
-    elif backbones[0] == 'resnet50':
-        b1 = tf.keras.applications.resnet50.preprocess_input(b1)
-    elif backbones[0] == 'densenet121':
-        b1 = tf.keras.applications.densenet.preprocess_input(b1)
-    elif backbones[0] == 'vgg19':
-        b1 = tf.keras.applications.vgg19.preprocess_input(b1)
-    elif backbones[0] == 'inception_v3':
-        b1 = tf.keras.applications.inception_v3.preprocess_input(b1)
+    b1 = backbone_preprocessing(b1, backbones[0])
 
     backbone_model_1 = load_pretrained_backbones(backbones[0])
     backbone_model_1._name = 'backbone_1'
@@ -973,16 +1180,7 @@ def build_gan_model_features(backbones=['resnet101', 'resnet101', 'resnet101'],
     b1 = backbone_model_1(b1)
 
     b2 = tf.image.resize(input_backbone_2, input_sizes_models[backbones[1]], method='bilinear')
-    if backbones[1] == 'resnet101':
-        b2 = tf.keras.applications.resnet.preprocess_input(b2)
-    elif backbones[1] == 'resnet50':
-        b2 = tf.keras.applications.resnet50.preprocess_input(b2)
-    elif backbones[1] == 'densenet121':
-        b2 = tf.keras.applications.densenet.preprocess_input(b2)
-    elif backbones[1] == 'vgg19':
-        b2 = tf.keras.applications.vgg19.preprocess_input(b2)
-    elif backbones[1] == 'inception_v3':
-        b2 = tf.keras.applications.inception_v3.preprocess_input(b2)
+    b2 = backbone_preprocessing(b2, backbones[1])
     backbone_model_2 = load_pretrained_backbones(backbones[1])
     backbone_model_2._name = 'backbone_2'
     for layer in backbone_model_2.layers:
@@ -990,16 +1188,7 @@ def build_gan_model_features(backbones=['resnet101', 'resnet101', 'resnet101'],
     b2 = backbone_model_2(b2)
     if num_backbones == 3:
         b3 = tf.image.resize(input_backbone_3, input_sizes_models[backbones[2]], method='bilinear')
-        if backbones[2] == 'resnet101':
-            b3 = tf.keras.applications.resnet.preprocess_input(b3)
-        elif backbones[2] == 'resnet50':
-            b3 = tf.keras.applications.resnet50.preprocess_input(b3)
-        elif backbones[2] == 'densenet121':
-            b3 = tf.keras.applications.densenet.preprocess_input(b3)
-        elif backbones[2] == 'vgg19':
-            b3 = tf.keras.applications.vgg19.preprocess_input(b3)
-        elif backbones[2] == 'inception_v3':
-            b3 = tf.keras.applications.inception_v3.preprocess_input(b3)
+        b3 = backbone_preprocessing(b3, backbones[2])
         backbone_model_3 = load_pretrained_backbones(backbones[2])
         backbone_model_3._name = 'backbone_3'
         for layer in backbone_model_3.layers:
@@ -1022,35 +1211,82 @@ def build_gan_model_features(backbones=['resnet101', 'resnet101', 'resnet101'],
     x = Dense(2048, activation='relu')(x)
     x = Flatten()(x)
     output_layer = Dense(5, activation='softmax')(x)
+    head = Model(inputs=[input_head_1, input_head_2, input_head_3], outputs=output_layer,
+                 name='gan_merge_classification_head')
+
+    input_image = Input((256, 256, 3))
+    t_input = Input(shape=(1,), dtype=tf.int32, name="t_input")
+
+    # each sample only goes through the generators of its target domain
+    c, r = cycle_gan_conversion(G_A2B, G_B2A, input_image, t_input)
+    model = Model(inputs=[t_input, input_image], outputs=head([input_image, c, r]), name='gan_merge_classification')
 
-    return Model(inputs=[t_input, input_image], outputs=output_layer, name='gan_merge_classification')
+    if return_head is True:
+        return model, head
+    return model
+
+
+def shared_backbone_features(input_model, backbone, input_size, num_backbones=3):
+    """
+    Runs a single backbone over the images of the stacks: the images are folded into the batch dimension,
+    (n, 3, h, w, 3) -> (3n, h, w, 3), go through one resize and one forward pass, and the features are unfolded
+    and concatenated on the channel axis in the order of the stack, the same as Concatenate()([b1, b2, b3])
+    with three copies of the backbone.
+
+    :param input_model: (tensor) float stacks, shape (n, 3, h, w, 3)
+    :param backbone: (str) name of the backbone
+    :param input_size: (tuple) input size of the backbone
+    :param num_backbones: (int) number of images of the stack used
+    :return: (tensor) shape (n, h', w', num_backbones * channels)
+    """
+    x = input_model[:, :num_backbones]
+    x = tf.reshape(x, [-1] + x.shape[2:].as_list())
+    x = tf.image.resize(x, input_size, method='bilinear')
+    x = backbone_preprocessing(x, backbone)
+
+    backbone_model = load_pretrained_backbones(backbone)
+    backbone_model._name = 'backbone_shared'
+    for layer in backbone_model.layers:
+        layer.trainable = False
+    x = backbone_model(x)
+
+    features_shape = x.shape[1:].as_list()
+    x = tf.reshape(x, [-1, num_backbones] + features_shape)
+    x = tf.transpose(x, [0, 2, 3, 1, 4])
+    return tf.reshape(x, [-1, features_shape[0], features_shape[1], num_backbones * features_shape[2]])
 
 
 def build_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat='globalpooling',
-                dropout=False):
+                dropout=False, shared_backbone=None):
+    """
+    :param shared_backbone: (bool) run a single copy of the backbone for all the images of the stack, only
+    possible when all the backbones are the same. By default it is used whenever they are the same.
+    """
 
     input_sizes_models = {'vgg16': (224, 224), 'vgg19': (224, 224), 'inception_v3': (299, 299),
                           'resnet50': (224, 224), 'resnet101': (224, 244), 'mobilenet': (224, 224),
                           'densenet121': (224, 224), 'xception': (299, 299)}
 
     num_backbones = len(backbones)
-    input_model = Input((3, 256, 256, 3))
-    x1, x2, x3 = tf.split(input_model, 3, axis=1)
+    input_model = Input((3, 256, 256, 3), dtype=tf.uint8)
+    if shared_backbone is None:
+        shared_backbone = len(set(backbones)) == 1
+    elif shared_backbone is True and len(set(backbones)) != 1:
+        raise ValueError(f'shared_backbone needs the same backbone for all the inputs, got {backbones}')
+
+    if shared_backbone is True:
+        x = shared_backbone_features(tf.cast(input_model, tf.float32), backbones[0],
+                                     input_sizes_models[backbones[0]], num_backbones=num_backbones)
+        return _build_model_head(input_model, x, after_concat, dropout)
+
+    # the stacks arrive as uint8 and are cast only once, on device
+    x1, x2, x3 = tf.split(tf.cast(input_model, tf.float32), 3, axis=1)
     input_backbone_1 = tf.squeeze(x1, axis=1)
     input_backbone_2 = tf.squeeze(x2, axis=1)
     input_backbone_3 = tf.squeeze(x3, axis=1)
 
     b1 = tf.image.resize(input_backbone_1, input_sizes_models[backbones[0]], method='bilinear')
-    if backbones[0] == 'resnet101':
-        b1 = tf.keras.applications.resnet.preprocess_input(b1)
-    elif backbones[0] == 'resnet50':
-        b1 = tf.keras.applications.resnet50.preprocess_input(b1)
-    elif backbones[0] == 'densenet121':
-        b1 = tf.keras.applications.densenet.preprocess_input(b1)
-    elif backbones[0] == 'vgg19':
-        b1 = tf.keras.applications.vgg19.preprocess_input(b1)
-    elif backbones[0] == 'inception_v3':
-        b1 = tf.keras.applications.inception_v3.preprocess_input(b1)
+    b1 = backbone_preprocessing(b1, backbones[0])
 
     backbone_model_1 = load_pretrained_backbones(backbones[0])
     backbone_model_1._name = 'backbone_1'
@@ -1059,16 +1295,7 @@ def build_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat=
     b1 = backbone_model_1(b1)
 
     b2 = tf.image.resize(input_backbone_2, input_sizes_models[backbones[1]], method='bilinear')
-    if backbones[1] == 'resnet101':
-        b2 = tf.keras.applications.resnet.preprocess_input(b2)
-    elif backbones[1] == 'resnet50':
-        b2 = tf.keras.applications.resnet50.preprocess_input(b2)
-    elif backbones[1] == 'densenet121':
-        b2 = tf.keras.applications.densenet.preprocess_input(b2)
-    elif backbones[1] == 'vgg19':
-        b2 = tf.keras.applications.vgg19.preprocess_input(b2)
-    elif backbones[1] == 'inception_v3':
-        b2 = tf.keras.applications.inception_v3.preprocess_input(b2)
+    b2 = backbone_preprocessing(b2, backbones[1])
     backbone_model_2 = load_pretrained_backbones(backbones[1])
     backbone_model_2._name = 'backbone_2'
     for layer in backbone_model_2.layers:
@@ -1076,16 +1303,7 @@ def build_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat=
     b2 = backbone_model_2(b2)
     if num_backbones == 3:
         b3 = tf.image.resize(input_backbone_3, input_sizes_models[backbones[2]], method='bilinear')
-        if backbones[2] == 'resnet101':
-            b3 = tf.keras.applications.resnet.preprocess_input(b3)
-        elif backbones[2] == 'resnet50':
-            b3 = tf.keras.applications.resnet50.preprocess_input(b3)
-        elif backbones[2] == 'densenet121':
-            b3 = tf.keras.applications.densenet.preprocess_input(b3)
-        elif backbones[2] == 'vgg19':
-            b3 = tf.keras.applications.vgg19.preprocess_input(b3)
-        elif backbones[2] == 'inception_v3':
-            b3 = tf.keras.applications.inception_v3.preprocess_input(b3)
+        b3 = backbone_preprocessing(b3, backbones[2])
         backbone_model_3 = load_pretrained_backbones(backbones[2])
         backbone_model_3._name = 'backbone_3'
         for layer in backbone_model_3.layers:
@@ -1095,6 +1313,11 @@ def build_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat=
 
     else:
         x = Concatenate()([b1, b2])
+
+    return _build_model_head(input_model, x, after_concat, dropout)
+
+
+def _build_model_head(input_model, x, after_concat, dropout):
     if after_concat == 'globalpooling':
         x = GlobalAveragePooling2D()(x)
     else:
@@ -1113,13 +1336,11 @@ def build_model(backbones=['resnet101', 'resnet101', 'resnet101'], after_concat=
 
 
 def evaluate_and_predict(model, directory_to_evaluate, results_directory,
-                         output_name='', results_id='', batch_size=1,
+                         output_name='', results_id='', batch_size=8,
                          analyze_data=False, output_dir=''):
     print(f'Evaluation of: {directory_to_evaluate}')
 
     # load the data to evaluate and predict
-
-    batch_size = 8
     test_x, test_y, dataset_dictionary = load_data_from_directory(directory_to_evaluate)
     test_dataset = generate_tf_dataset(test_x, test_y, batch_size=batch_size)
     test_steps = (len(test_x) // batch_size)
@@ -1127,35 +1348,42 @@ def evaluate_and_predict(model, directory_to_evaluate, results_directory,
     if len(test_x) % batch_size != 0:
         test_steps += 1
 
-    evaluation = model.evaluate(test_dataset, steps=test_steps)
-    inference_times = []
-    prediction_names = []
+    real_values = [dataset_dictionary[x] for x in test_x]
+    prediction_names = [os.path.split(x)[-1] for x in test_x]
+
+    # a single pass over the dataset, the loss and metrics of model.evaluate are computed from the same outputs
+    compiled = getattr(model, 'compiled_loss', None) is not None
+    if compiled:
+        model.reset_metrics()
+    batch_times = []
+    sample_times = []
     prediction_outputs = []
-    real_values = []
-    print('Evaluation results:')
-    print(evaluation)
-    for i, (x, y) in tqdm.tqdm(enumerate(zip(test_x, test_y)), total=len(test_x)):
-        real_values.append(dataset_dictionary[x])
-        prediction_names.append(os.path.split(x)[-1])
+    for x, y in tqdm.tqdm(test_dataset.take(test_steps), total=test_steps):
         init_time = time.time()
-        x = read_stacked_images_npy_predict(x)
-        x = np.expand_dims(x, axis=0)
-        y_pred = model.predict(x)
-        prediction_outputs.append(y_pred[0])
-        inference_times.append(time.time() - init_time)
-        # determine the top-1 prediction class
-        prediction_id = np.argmax(y_pred[0])
-
-    print('Prediction times analysis')
-    print(np.min(prediction_outputs), np.mean(prediction_outputs), np.max(prediction_outputs))
+        y_pred = model.predict_on_batch(x)
+        delta = time.time() - init_time
+        if compiled:
+            model.compiled_loss(y, y_pred)
+            model.compiled_metrics.update_state(y, y_pred)
+        y_pred = np.asarray(y_pred)
+        prediction_outputs.append(y_pred)
+        batch_times.append(delta)
+        sample_times += [delta / len(y_pred)] * len(y_pred)
+
+    prediction_outputs = np.concatenate(prediction_outputs)[:len(test_x)]
+    if compiled:
+        print('Evaluation results:')
+        print({metric.name: float(metric.result()) for metric in model.metrics})
+
+    print('Prediction times analysis (s): p50, p90, p99, max')
+    # the first batch includes the tracing of the model
+    print('per batch:', np.percentile(batch_times, [50, 90, 99]), np.max(batch_times))
+    print('per sample:', np.percentile(sample_times, [50, 90, 99]), np.max(sample_times))
 
     unique_values = np.unique(real_values)
     label_index = [unique_values[np.argmax(pred)] for pred in prediction_outputs]
 
-    x_pred = [[] for _ in range(len(unique_values))]
-    for x in prediction_outputs:
-        for i in range(len(x)):
-            x_pred[i].append(x[i])
+    x_pred = prediction_outputs.T
 
     header_column = ['class_' + str(i+1) for i in range(5)]
     header_column.insert(0, 'fname')
@@ -1216,11 +1444,32 @@ def compile_model(model, learning_rate, optimizer='adam', loss='categorical_cros
 
 def fit_model(name_model, dataset_dir, epochs=50, learning_rate=0.0001, results_dir=os.getcwd() + '/results/', backbone_model=None,
               val_dataset=None, eval_val_set=None, eval_train_set=False, test_data=None,
-              batch_size=16, buffer_size=50, backbones=['restnet50'], dropout=False, after_concat='globalpooling'):
+              batch_size=16, buffer_size=50, backbones=['restnet50'], dropout=False, after_concat='globalpooling',
+              augment=False, cache_generator_outputs=False, generator_cache_dir=None, generator_cache_size_gb=20.0,
+              cache_features=False, feature_cache_dir=None, tfrecord_dir=None, triplet_store=None):
     if len(backbones) > 3:
         raise ValueError('number maximum of backbones is 3!')
+    pre_built_models = ['pre_built_dataset_merge_features', 'pre_built_dataset_merge_predicts_v1']
+    if tfrecord_dir is not None and name_model not in pre_built_models:
+        raise ValueError(f'tfrecord_dir is only supported by the models {pre_built_models}')
+    if triplet_store is not None and name_model not in pre_built_models:
+        raise ValueError(f'triplet_store is only supported by the models {pre_built_models}')
     mode = ''.join(['fit_dop_', str(dropout), '_', after_concat, '_'])
     print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
+    # if TF_CONFIG is set this process is one of the workers of a multi-worker training (distributed_training)
+    strategy = dist.get_strategy()
+    if cache_features is True and dist.num_workers() > 1:
+        # the feature store is written by a single process
+        print('Features not cached in a multi-worker training')
+        cache_features = False
+    if cache_features is True and tfrecord_dir is not None:
+        # the feature store is keyed by the list of files
+        print('Features not cached when reading TFRecord shards')
+        cache_features = False
+    if cache_features is True and triplet_store is not None:
+        # the batches of the store are not in the order of the list of files
+        print('Features not cached when reading a triplet store')
+        cache_features = False
     # Decide how to act according to the mode (train/predict/train-backbone... )
     files_dataset_directory = [f for f in os.listdir(dataset_dir)]
     if 'train' in files_dataset_directory:
@@ -1238,53 +1487,61 @@ def fit_model(name_model, dataset_dir, epochs=50, learning_rate=0.0001, results_
     print(f'train directory found at: {path_train_dataset}')
     print(f'validation directory found at: {path_val_dataset}')
 
-    if mode == 'pre_built_dataset_merge_features' or mode == 'pre_built_dataset_merge_predicts_v1':
+    # the pre-built models take stacks of frames (.npy), the gan models single images listed in a csv file
+    if tfrecord_dir is not None:
+        # the stacks are read from the TFRecord shards (tfrecord_data.py) instead of one .npy file per sample
+        train_dataset, num_train_samples = generate_tf_dataset_tfrecord(tfrecord_dir, 'train', batch_size=batch_size,
+                                                                        shuffle=True, buffer_size=buffer_size,
+                                                                        augment=augment, shard=True)
+        val_dataset, num_val_samples = generate_tf_dataset_tfrecord(tfrecord_dir, 'val', batch_size=batch_size,
+                                                                    buffer_size=buffer_size, shard=True)
+    elif triplet_store is not None:
+        # the stacks of both splits are read from the store written by merge_multi_domain_data
+        train_x, train_y, dictionary_train = load_data_from_directory(path_train_dataset)
+        train_dataset = generate_tf_dataset_triplet_store(triplet_store, train_x, train_y, batch_size=batch_size,
+                                                          shuffle=True, augment=augment, shard=True)
+
+        val_x, val_y, dictionary_val = load_data_from_directory(path_val_dataset)
+        val_dataset = generate_tf_dataset_triplet_store(triplet_store, val_x, val_y, batch_size=batch_size,
+                                                        shuffle=True, shard=True)
+    elif name_model in pre_built_models:
         train_x, train_y, dictionary_train = load_data_from_directory(path_train_dataset)
         train_dataset = generate_tf_dataset(train_x, train_y, batch_size=batch_size, shuffle=True,
-                                           buffer_size=buffer_size)
+                                           buffer_size=buffer_size, augment=augment, shard=True)
 
         val_x, val_y, dictionary_val = load_data_from_directory(path_val_dataset)
         val_dataset = generate_tf_dataset(val_x, val_y, batch_size=batch_size, shuffle=True,
-                                           buffer_size=buffer_size)
+                                           buffer_size=buffer_size, shard=True)
+        if cache_features is True:
+            # same data in a fixed order, to compute the features once
+            ordered_datasets = [generate_tf_dataset(train_x, train_y, batch_size=batch_size),
+                                generate_tf_dataset(val_x, val_y, batch_size=batch_size)]
     else:
         csv_file_train = [f for f in os.listdir(path_train_dataset) if f.endswith('.csv')].pop()
         path_csv_file_train = os.path.join(path_train_dataset, csv_file_train)
         train_x, dictionary_train = load_data_from_directory_v1(path_train_dataset,
                                                                          csv_annotations=path_csv_file_train)
         train_dataset = generate_tf_dataset_v1(train_x, dictionary_train, batch_size=batch_size, shuffle=True,
-                                            buffer_size=buffer_size)
-
-        for j, element in enumerate(train_dataset):
-            print(j)
-            print(element)
-            x, y = element
-            print(type(x))
-            print(type(y))
-            x_array = x.numpy()
-            y_array = y.numpy()
-            print('x:', np.shape(x_array), np.amin(x_array), np.amax(x_array))
-            print('y:', np.shape(y_array), np.unique(y_array))
-
-        dataset = train_dataset.batch(2, drop_remainder=True)
+                                            buffer_size=buffer_size, augment=augment, shard=True)
 
         csv_file_val = [f for f in os.listdir(path_val_dataset) if f.endswith('.csv')].pop()
         path_csv_file_val = os.path.join(path_val_dataset, csv_file_val)
         val_x, dictionary_val = load_data_from_directory_v1(path_val_dataset, csv_annotations=path_csv_file_val)
         val_dataset = generate_tf_dataset_v1(val_x, dictionary_val, batch_size=batch_size, shuffle=True,
-                                          buffer_size=buffer_size)
-
-    train_steps = len(train_x) // batch_size
-    val_steps = len(val_x) // batch_size
+                                          buffer_size=buffer_size, shard=True)
+        if cache_features is True:
+            ordered_datasets = [generate_tf_dataset_v1(train_x, dictionary_train, batch_size=batch_size),
+                                generate_tf_dataset_v1(val_x, dictionary_val, batch_size=batch_size)]
 
-    if len(train_x) % batch_size != 0:
-        train_steps += 1
-    if len(val_x) % batch_size != 0:
-        val_steps += 1
+    if tfrecord_dir is None:
+        num_train_samples, num_val_samples = len(train_x), len(val_x)
+    # steps of each worker, the same as len(x) / batch_size with a single worker
+    train_steps = dist.steps_per_worker(num_train_samples, batch_size)
+    val_steps = dist.steps_per_worker(num_val_samples, batch_size)
 
     # define a dir to save the results and Checkpoints
     # if results directory doesn't exist create it
-    if not os.path.isdir(results_dir):
-        os.mkdir(results_dir)
+    os.makedirs(results_dir, exist_ok=True)
 
     # ID name for the folder and results
     backbone_model = ''.join([name_model + '_' for name_model in backbones])
@@ -1293,26 +1550,75 @@ def fit_model(name_model, dataset_dir, epochs=50, learning_rate=0.0001, results_
                                             mode=mode)
 
     results_directory = ''.join([results_dir, new_results_id, '/'])
+    # only the chief writes in the results directory
+    results_directory = dist.worker_directory(results_directory)
     # if results experiment doesn't exists create it
     if not os.path.isdir(results_directory):
         os.mkdir(results_directory)
 
     # Build the model
-    if len(backbones) == 1:
-        backbones = backbones*3
-    print(f'list backbones:{backbones}')
-    if name_model == 'pre_built_dataset_merge_features':
-        model = build_model(backbones=backbones, dropout=dropout, after_concat=after_concat)
-    elif name_model == 'pre_built_dataset_merge_predicts_v1':
-        model = build_model_v1(backbones=backbones, dropout=dropout, after_concat=after_concat)
-    elif name_model == 'gan_merge_features':
-        model = build_gan_model_features(backbones=backbones, gan_base='checkpoint_charlie',
-                                        dropout=dropout, after_concat=after_concat)
-    elif name_model == 'gan_merge_predicts_v1':
-        model = build_gan_model_merge_out(backbones=backbones, gan_base='checkpoint_charlie',
-                                         dropout=dropout, after_concat=after_concat)
-
-    model = compile_model(model, learning_rate)
+    # the variables of the model and of the optimizer are mirrored in all the workers
+    with strategy.scope():
+        if len(backbones) == 1:
+            backbones = backbones*3
+        print(f'list backbones:{backbones}')
+        full_model = None
+        if name_model == 'pre_built_dataset_merge_features':
+            model = build_model(backbones=backbones, dropout=dropout, after_concat=after_concat)
+        elif name_model == 'pre_built_dataset_merge_predicts_v1':
+            model = build_model_v1(backbones=backbones, dropout=dropout, after_concat=after_concat)
+        elif name_model == 'gan_merge_features' and cache_generator_outputs is True:
+            G_A2B, G_B2A = load_cycle_gan('checkpoint_charlie')
+            full_model, model = build_gan_model_features(backbones=backbones, gan_base='checkpoint_charlie',
+                                                         dropout=dropout, after_concat=after_concat,
+                                                         return_head=True, generators=(G_A2B, G_B2A))
+            # the generators are frozen, their outputs are computed once and read from a disk cache in every epoch,
+            # only the head (which shares its layers with full_model) is trained
+            if generator_cache_dir is None:
+                generator_cache_dir = os.path.join(results_dir, 'generator_cache')
+            generator_cache = gcache.GeneratorOutputCache(generator_cache_dir,
+                                                          get_gan_checkpoint_dir('checkpoint_charlie'),
+                                                          max_size_gb=generator_cache_size_gb)
+            conversion_model = build_generator_base(G_A2B, G_B2A)
+
+            def _convert(images, target_domains):
+                return conversion_model.predict_on_batch([target_domains, images])
+
+            train_dataset = generate_tf_dataset_cached_gan(train_x, dictionary_train, generator_cache, _convert,
+                                                           batch_size=batch_size, shuffle=True, buffer_size=buffer_size,
+                                                           shard=True)
+            val_dataset = generate_tf_dataset_cached_gan(val_x, dictionary_val, generator_cache, _convert,
+                                                         batch_size=batch_size, buffer_size=buffer_size, shard=True)
+            print(f'generator cache: {generator_cache_dir}, {generator_cache.size_gb():.2f} GB')
+        elif name_model == 'gan_merge_features':
+            model = build_gan_model_features(backbones=backbones, gan_base='checkpoint_charlie',
+                                            dropout=dropout, after_concat=after_concat)
+        elif name_model == 'gan_merge_predicts_v1':
+            model = build_gan_model_merge_out(backbones=backbones, gan_base='checkpoint_charlie',
+                                             dropout=dropout, after_concat=after_concat)
+
+        if cache_features is True and not (name_model == 'gan_merge_features' and cache_generator_outputs is True):
+            split_model = fcache.split_at_pooling(model) if augment is False else None
+            if split_model is None:
+                print('Features not cached (trainable backbones, augmentation or no pooled features), '
+                      'end-to-end training')
+            else:
+                # the frozen backbones are run once over train and val, the head is trained from the stored features
+                full_model = model
+                extractor, model = split_model
+                if feature_cache_dir is None:
+                    feature_cache_dir = os.path.join(results_dir, 'feature_cache')
+                stores = list()
+                for ordered_dataset, list_x in zip(ordered_datasets, [train_x, val_x]):
+                    # every sample once, the last batch can be partial
+                    num_batches = int(np.ceil(len(list_x) / batch_size))
+                    key = fcache.store_key(name_model, backbones, after_concat, list_x)
+                    stores.append(fcache.build_feature_store(extractor, ordered_dataset.take(num_batches), num_batches,
+                                                             len(list_x), feature_cache_dir, key))
+                train_dataset = fcache.feature_dataset(*stores[0], batch_size=batch_size, shuffle=True)
+                val_dataset = fcache.feature_dataset(*stores[1], batch_size=batch_size)
+
+        model = compile_model(model, learning_rate)
     temp_name_model = results_directory + new_results_id + "_model.h5"
     callbacks = [
         ModelCheckpoint(temp_name_model,
@@ -1335,19 +1641,33 @@ def fit_model(name_model, dataset_dir, epochs=50, learning_rate=0.0001, results_
                               verbose=True,
                               callbacks=callbacks)
 
+    if name_model == 'gan_merge_features' and cache_generator_outputs is True:
+        print(f'generator cache hits: {generator_cache.hits}, misses: {generator_cache.misses}')
+    if full_model is not None:
+        # only the head was trained, the complete model is the one saved
+        with strategy.scope():
+            model = compile_model(full_model, learning_rate)
     model.save(''.join([results_directory, 'model_', new_results_id]))
+    if not dist.is_chief():
+        # the evaluation is only done by the chief
+        dist.remove_worker_directory(results_directory)
+        return
+    if dist.num_workers() > 1:
+        # the copy saved outside the strategy is evaluated, see dist.load_saved_model
+        model = compile_model(dist.load_saved_model(''.join([results_directory, 'model_', new_results_id])),
+                              learning_rate)
 
     print('Total Training TIME:', (datetime.datetime.now() - start_time))
     print('History Model Keys:')
     print(trained_model.history.keys())
-    # in case evaluate val dataset is True
+    # in case evaluate val dataset is True, the directories are evaluated (the training datasets are sharded)
     if eval_val_set is True:
-        evaluate_and_predict(model, val_dataset, results_directory,
+        evaluate_and_predict(model, path_val_dataset, results_directory,
                              results_id=new_results_id, output_name='val',
                              )
 
     if eval_train_set is True:
-        evaluate_and_predict(model, train_dataset, results_directory,
+        evaluate_and_predict(model, path_train_dataset, results_directory,
                              results_id=new_results_id, output_name='train',
                              )
 
@@ -1379,7 +1699,7 @@ def make_dataset(path, batch_size):
   path_imgs = list()
   images_class = list()
   images_domains = list()
-  csv_annotations_file = [path + f for f in os.listdir(path) if f.endswith('.csv')].pop()
+  csv_annotations_file = [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.csv')].pop()
   list_files, dictionary_labels = load_data_from_directory_v1(path, csv_annotations=csv_annotations_file)
   for img_name in list_files:
     path_imgs.append(dictionary_labels[img_name]['path_file'])
@@ -1391,12 +1711,9 @@ def make_dataset(path, batch_size):
   images_domains = [unique_domains.index(val) for val in images_domains]
   images_class = [unique_classes.index(val) for val in images_class]
 
-  list_path_files = list()
-  for (dirpath, dirnames, filenames) in os.walk(path):
-      list_path_files += [os.path.join(dirpath, file) for file in filenames]
-
-  list_path_files = [f for f in list_files if f.endswith('.png')]
-  labels = [unique_classes.index(name.split('/')[-2]) for name in list_path_files]
+  # paths and labels come from the manifest built in load_data_from_directory_v1, no second walk needed
+  labels = [label for label, path_img in zip(images_class, path_imgs) if path_img.endswith('.png')]
+  list_path_files = [path_img for path_img in path_imgs if path_img.endswith('.png')]
 
   filenames_ds = tf.data.Dataset.from_tensor_slices(list_path_files)
   images_ds = filenames_ds.map(parse_image, num_parallel_calls=tf.data.experimental.AUTOTUNE)
@@ -1408,7 +1725,18 @@ def make_dataset(path, batch_size):
 
 def train_model(name_model, dataset_dir, epochs=50, learning_rate=0.0001, results_dir=os.getcwd() + '/results/', backbone_model=None,
               val_dataset=None, eval_val_set=None, eval_train_set=False, test_data=None,
-              batch_size=16, buffer_size=50, backbones=['restnet50'], dropout=False, after_concat='globalpooling'):
+              batch_size=16, buffer_size=50, backbones=['restnet50'], dropout=False, after_concat='globalpooling',
+              accumulation_steps=1, jit_compile=False, checkpoint_every=1, resume_dir=None):
+    """
+    Trains the model with the custom training loop of custom_training.CustomTrainer instead of model.fit
+
+    :param accumulation_steps: (int) micro-batches of batch_size accumulated in each update, the effective batch
+    size is accumulation_steps * batch_size
+    :param jit_compile: (bool) compile the train and validation steps with XLA
+    :param checkpoint_every: (int) epochs between checkpoints (saved in results_directory/checkpoints/)
+    :param resume_dir: (str) results directory of a previous train_model run, the training continues from its
+    latest checkpoint and the results are saved in it
+    """
 
     if len(backbones) > 3:
         raise ValueError('number maximum of backbones is 3!')
@@ -1459,6 +1787,12 @@ def train_model(name_model, dataset_dir, epochs=50, learning_rate=0.0001, result
                                             mode=mode)
 
     results_directory = ''.join([results_dir, new_results_id, '/'])
+    if resume_dir is not None:
+        # the checkpoints of the previous run are restored by CustomTrainer
+        if not os.path.isdir(os.path.join(resume_dir, 'checkpoints')):
+            raise ValueError(f'no checkpoints directory found at: {resume_dir}')
+        new_results_id = os.path.basename(os.path.normpath(resume_dir))
+        results_directory = os.path.join(resume_dir, '')
     # if results experiment doesn't exists create it
     if not os.path.isdir(results_directory):
         os.mkdir(results_directory)
@@ -1467,75 +1801,103 @@ def train_model(name_model, dataset_dir, epochs=50, learning_rate=0.0001, result
     if len(backbones) == 1:
         backbones = backbones*3
     print(f'list backbones:{backbones}')
-    if name_model == 'gan_merge_features':
+    if name_model in ['gan_merge_features', 'pre_built_dataset_merge_features']:
         model = build_model(backbones=backbones, dropout=dropout, after_concat=after_concat)
-    elif name_model == 'gan_merge_predicts_v1':
+    elif name_model in ['gan_merge_predicts_v1', 'pre_built_dataset_merge_predicts_v1']:
         model = build_model_v1(backbones=backbones, dropout=dropout, after_concat=after_concat)
+    else:
+        raise ValueError(f'model {name_model} not supported by train_model')
 
-    model = compile_model(model, learning_rate)
-
-
-    # Instantiate a loss function.
-    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-    # Prepare the metrics.
-    train_acc_metric = tf.keras.metrics.SparseCategoricalAccuracy()
-    val_acc_metric = tf.keras.metrics.SparseCategoricalAccuracy()
+    trainer = ctr.CustomTrainer(model, Adam(learning_rate=learning_rate),
+                                tf.keras.losses.CategoricalCrossentropy(),
+                                metrics=[tf.keras.metrics.CategoricalAccuracy(name='accuracy'),
+                                         tf.keras.metrics.Precision(name='precision'),
+                                         tf.keras.metrics.Recall(name='recall')],
+                                accumulation_steps=accumulation_steps, jit_compile=jit_compile,
+                                checkpoint_dir=results_directory + 'checkpoints/',
+                                checkpoint_every=checkpoint_every)
 
-    for epoch in range(epochs):
-        print("\nStart of epoch %d" % (epoch,))
-        start_time = time.time()
+    # track time
+    start_time = datetime.datetime.now()
+    history = trainer.fit(train_dataset, epochs, train_steps, val_dataset=val_dataset, validation_steps=val_steps)
+    # a resumed training only returns the history of its epochs, it is appended to the previous one
+    path_history = results_directory + 'train_history_' + new_results_id + "_.csv"
+    resumed = os.path.isfile(path_history)
+    pd.DataFrame(history).to_csv(path_history, index=False, mode='a' if resumed else 'w', header=not resumed)
 
-        # Iterate over the batches of the dataset.
-        for step, (x_batch_train, y_batch_train) in enumerate(train_dataset):
-            with tf.GradientTape() as tape:
-                logits = model(x_batch_train, training=True)
-                loss_value = loss_fn(y_batch_train, logits)
-            grads = tape.gradient(loss_value, model.trainable_weights)
-            optimizer.apply_gradients(zip(grads, model.trainable_weights))
+    model = compile_model(model, learning_rate)
+    model.save(''.join([results_directory, 'model_', new_results_id]))
+    print('Total Training TIME:', (datetime.datetime.now() - start_time))
 
-            # Update training metric.
-            train_acc_metric.update_state(y_batch_train, logits)
+    return history
 
-            # Log every 200 batches.
-            if step % 200 == 0:
-                print(
-                    "Training loss (for one batch) at step %d: %.4f"
-                    % (step, float(loss_value))
-                )
-                print("Seen so far: %d samples" % ((step + 1) * batch_size))
 
-        # Display metrics at the end of each epoch.
-        train_acc = train_acc_metric.result()
-        print("Training acc over epoch: %.4f" % (float(train_acc),))
+def build_video_triplet_model(model, G_A2B, G_B2A, target_domain):
+    """
+    Wraps a model of stacks (original, converted, reconverted), as written by merge_multi_domain_data, so it
+    classifies single frames: each frame is converted and reconverted with the CycleGAN generators inside the
+    model and the uint8 triplet is built in-graph.
+
+    :param model: keras model with input (3, 256, 256, 3)
+    :param G_A2B: (keras Model) generator from domain A (WLI) to domain B (NBI)
+    :param G_B2A: (keras Model) generator from domain B (NBI) to domain A (WLI)
+    :param target_domain: (int) != 0 if the frames are converted to NBI, see get_target_domain
+    :return: keras model with input (256, 256, 3) uint8 RGB frames
+    """
+    def _to_uint8(images):
+        return tf.cast(tf.clip_by_value(tf.round((images + 1.0) * 127.5), 0, 255), tf.uint8)
+
+    input_frame = Input((256, 256, 3), dtype=tf.uint8)
+    x = tf.cast(input_frame, tf.float32) / 127.5 - 1.0
+    if target_domain != 0:
+        c = G_A2B(x)
+        r = G_B2A(c)
+    else:
+        c = G_B2A(x)
+        r = G_A2B(c)
+    triplet = tf.stack([input_frame, _to_uint8(c), _to_uint8(r)], axis=1)
+    return Model(inputs=input_frame, outputs=model(triplet), name='video_triplet_classification')
 
-        # Reset training metrics at the end of each epoch
-        train_acc_metric.reset_states()
 
-        # Run a validation loop at the end of each epoch.
-        for x_batch_val, y_batch_val in val_dataset:
-            val_logits = model(x_batch_val, training=False)
-            # Update val metrics
-            val_acc_metric.update_state(y_batch_val, val_logits)
-        val_acc = val_acc_metric.result()
-        val_acc_metric.reset_states()
-        print("Validation acc: %.4f" % (float(val_acc),))
-        print("Time taken: %.2fs" % (time.time() - start_time))
+def predict_video(model, source, results_directory, results_id, batch_size=8, max_latency=None,
+                  video_domain='WLI', gan_base='checkpoint_charlie'):
+    """
+    Classifies a video (or the webcam) with video_inference.predict_video. The models of stacks are trained on
+    (original, converted, reconverted) triplets, so the triplet of each frame is built with the CycleGAN.
+    :param model: keras model
+    :param source: (str or int) path to the video or index of the camera
+    :param results_directory: (str)
+    :param results_id: (str)
+    :param batch_size: (int) frames predicted together
+    :param max_latency: (float) maximum time in seconds a frame waits for its batch to be full
+    :param video_domain: (str) imaging type of the video ('WLI' or 'NBI'), the frames are converted to the other
+    :param gan_base: (str) checkpoint of the CycleGAN
+    :return: (dict) stats of the run
+    """
+    if len(model.inputs[0].shape) == 5:
+        G_A2B, G_B2A = load_cycle_gan(gan_base)
+        model = build_video_triplet_model(model, G_A2B, G_B2A, get_target_domain(video_domain))
+    # the models cast the uint8 images to float themselves
+    return vid.predict_video(model, source, results_directory, results_id, rescale=False, batch_size=batch_size,
+                             max_latency=max_latency)
 
 
-def predict(directory_model, file_to_predict):
+def predict(directory_model, file_to_predict, video_domain='WLI'):
 
     model, _ = load_model(directory_model)
-    #if daa.check_file_isvid(file_to_predic):
-    #    pass
-    # elif os.path.isdir(file_to_predic):
-    if os.path.isdir(file_to_predict):
+    if daa.check_file_isvid(file_to_predict):
+        new_results_id = generate_experiment_ID(prediction_model=os.path.basename(os.path.normpath(directory_model)))
+        predict_video(model, file_to_predict, directory_model, new_results_id, video_domain=video_domain)
+
+    elif os.path.isdir(file_to_predict):
         new_results_id = generate_experiment_ID(prediction_model=os.path.basename(os.path.normpath(directory_model)))
         results_directory = directory_model
         print(f'Test directory found at: {file_to_predict}')
         evalute_test_directory(model, file_to_predict, results_directory, new_results_id,
                                )
     elif file_to_predict == 'webcam':
-        pass
+        new_results_id = generate_experiment_ID(prediction_model=os.path.basename(os.path.normpath(directory_model)))
+        predict_video(model, 0, directory_model, new_results_id, max_latency=0.1, video_domain=video_domain)
 
     else:
         print(f'Format or dir {file_to_predict} not understood')
@@ -1561,11 +1923,19 @@ def main(_argv):
         analyze_tf_dataset(test_dataset)
 
     elif mode == 'fit':
-        fit_model(name_model, train_dataset, val_dataset=val_dataset, epochs=epochs)
+        fit_model(name_model, train_dataset, val_dataset=val_dataset, epochs=epochs, augment=FLAGS.augment,
+                  cache_generator_outputs=FLAGS.cache_generators, generator_cache_dir=FLAGS.generator_cache_dir,
+                  generator_cache_size_gb=FLAGS.generator_cache_size_gb, cache_features=FLAGS.cache_features,
+                  feature_cache_dir=FLAGS.feature_cache_dir, tfrecord_dir=FLAGS.tfrecord_dir,
+                  triplet_store=FLAGS.triplet_store)
         #fit_model(name_model, train_dataset, backbone_model, val_dataset=val_dataset, batch_size=batch_size,
         #          buffer_size=buffer_size)
+    elif mode == 'eager_tf':
+        train_model(name_model, train_dataset, val_dataset=val_dataset, epochs=epochs, batch_size=batch_size,
+                    buffer_size=buffer_size, accumulation_steps=FLAGS.accumulation_steps,
+                    jit_compile=FLAGS.jit_compile, resume_dir=FLAGS.resume_dir)
     elif mode == 'predict':
-        predict(directory_model, file_to_predic)
+        predict(directory_model, file_to_predic, video_domain=FLAGS.video_domain)
 
 
 if __name__ == '__main__':
@@ -1575,7 +1945,7 @@ if __name__ == '__main__':
                       'fit: model.fit, '
                       'eager_fit: model.fit(run_eagerly=True), '
                       'predict: predict in a dataset given a model'
-                      'eager_tf: custom GradientTape,'
+                      'eager_tf: custom training loop compiled with tf.function,'
                       'analyze_dataset: analyze_dataset')
     flags.DEFINE_string('backbone', None, 'backbone network')
     flags.DEFINE_string('dataset_dir', os.getcwd() + 'data/', 'path to dataset')
@@ -1593,6 +1963,18 @@ if __name__ == '__main__':
     flags.DEFINE_string('file_to_predic', '',
                         'Directory or file where to perform predictions if predict mode selected')
     flags.DEFINE_integer('trainable_layers', -1, 'Trainable layers in case backbone is trained')
+    flags.DEFINE_string('video_domain', 'WLI', 'imaging type of the videos to predict (WLI or NBI)')
+    flags.DEFINE_bool('augment', False, 'augment the training batches on the fly')
+    flags.DEFINE_bool('cache_generators', False, 'cache the outputs of the frozen CycleGAN on disk (gan_merge_features)')
+    flags.DEFINE_string('generator_cache_dir', None, 'directory of the generator cache, results_dir/generator_cache by default')
+    flags.DEFINE_float('generator_cache_size_gb', 20.0, 'maximum size of the generator cache')
+    flags.DEFINE_bool('cache_features', False, 'compute the features of the frozen backbones once and train only the head')
+    flags.DEFINE_string('feature_cache_dir', None, 'directory of the feature store, results_dir/feature_cache by default')
+    flags.DEFINE_string('tfrecord_dir', None, 'read the training and validation stacks from the TFRecord shards of this directory')
+    flags.DEFINE_string('triplet_store', None, 'read the training and validation stacks from this memmap (.npy) or hdf5 (.h5) store')
+    flags.DEFINE_integer('accumulation_steps', 1, 'micro-batches accumulated in each update (eager_tf)')
+    flags.DEFINE_bool('jit_compile', False, 'compile the training steps with XLA (eager_tf)')
+    flags.DEFINE_string('resume_dir', None, 'results directory of a previous run to resume from its checkpoints (eager_tf)')
 
 
     try:
@@ -6,7 +6,6 @@ import cv2
 from classification import call_models as img_class
 from classification import grad_cam as gc
 import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 import datetime
 import tqdm
 
@@ -14,7 +13,7 @@ from absl import app, flags, logging
 from absl.flags import FLAGS
 from general_functions import data_management as dam
 from general_functions import data_analysis as daa
-from PIL import Image
+from general_functions import heatmap_overlay as hmo
 
 
 def get_img_array(img_path, size):
@@ -110,108 +109,133 @@ def create_auxiliar_networks(model, last_conv_layer_name, classifier_layer_names
     return last_conv_layer_model, classifier_model
 
 
-def make_gradcam_heatmap(img_array, last_conv_layer_model, classifier_model):
+def build_batched_gradcam(last_conv_layer_model, classifier_model):
     """
-    :param img_array:
+    Builds a tf.function that computes the Grad-CAM heatmaps of a batch of images in one forward and backward
+    pass. The gradients pooled over the spatial dimensions weight the channels of the last conv layer with an
+    einsum, and each heatmap is normalized to [0, 1] independently (NaN when it has no positive value).
+
+    :param last_conv_layer_model: model from the input to the activations of the last conv layer
+    :param classifier_model: model from those activations to the class predictions
+    :return: function (img_batch, class_indices=None) -> (heatmaps, predictions). img_batch are pre-processed
+    images of shape (N, h, w, 3). class_indices is None for the top predicted class of each image (heatmaps of
+    shape (N, h', w')), or an int tensor of shape (N, K) with K target classes per image (heatmaps of shape
+    (N, K, h', w')).
+    """
+    @tf.function(experimental_relax_shapes=True)
+    def _gradcam(img_batch, class_indices=None):
+        single_target = class_indices is None
+        with tf.GradientTape(persistent=True) as tape:
+            last_conv_layer_output = last_conv_layer_model(img_batch)
+            tape.watch(last_conv_layer_output)
+            preds = classifier_model(last_conv_layer_output)
+            if single_target:
+                class_indices = tf.expand_dims(tf.argmax(preds, axis=1, output_type=tf.int32), axis=1)
+            # score of each target class, shape (N, K)
+            class_scores = tf.gather(preds, class_indices, axis=1, batch_dims=1)
+            # the score of an image only depends on its own activations, so the gradient of the sum over the
+            # batch gives the gradient of every image
+            target_scores = [tf.reduce_sum(class_scores[:, k]) for k in range(class_indices.shape[1])]
+
+        heatmaps = list()
+        for target_score in target_scores:
+            grads = tape.gradient(target_score, last_conv_layer_output)
+            pooled_grads = tf.reduce_mean(grads, axis=(1, 2))
+            heatmap = tf.einsum('nhwc,nc->nhw', last_conv_layer_output, pooled_grads) / \
+                tf.cast(tf.shape(pooled_grads)[-1], pooled_grads.dtype)
+            heatmap = tf.nn.relu(heatmap)
+            # as np.maximum(heatmap, 0) / np.max(heatmap), a heatmap without positive values is NaN and gives an
+            # empty mask
+            heatmap = heatmap / tf.reduce_max(heatmap, axis=(1, 2), keepdims=True)
+            heatmaps.append(heatmap)
+        del tape
+
+        if single_target:
+            return heatmaps[0], preds
+        return tf.stack(heatmaps, axis=1), preds
+
+    return _gradcam
+
+
+def make_gradcam_heatmap(img_array, last_conv_layer_model, classifier_model, return_predictions=False):
+    """
+    :param img_array: (array) pre-processed images, batch of shape (N, h, w, 3)
     :type img_array:
     :param last_conv_layer_model:
     :type last_conv_layer_model:
     :param classifier_model:
     :type classifier_model:
-    :return:
+    :param return_predictions: (bool) also return the class predictions, they come from the same forward pass
+    used for the gradients so the model does not need to be run again to get them
+    :return: heatmap, (predictions). For a batch of 1 the heatmap and predictions of that image, otherwise the
+    arrays of the whole batch
     :rtype:
     """
-    # Then, we compute the gradient of the top predicted class for our input image
-    # with respect to the activations of the last conv layer
-    with tf.GradientTape() as tape:
-        # Compute activations of the last conv layer and make the tape watch it
-        last_conv_layer_output = last_conv_layer_model(img_array)
-        tape.watch(last_conv_layer_output)
-        # Compute class predictions
-        preds = classifier_model(last_conv_layer_output)
-        top_pred_index = tf.argmax(preds[0])
-        top_class_channel = preds[:, top_pred_index]
-
-    # This is the gradient of the top predicted class with regard to
-    # the output feature map of the last conv layer
-    grads = tape.gradient(top_class_channel, last_conv_layer_output)
-
-    # This is a vector where each entry is the mean intensity of the gradient
-    # over a specific feature map channel
-    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-    # We multiply each channel in the feature map array
-    # by "how important this channel is" with regard to the top predicted class
-    last_conv_layer_output = last_conv_layer_output.numpy()[0]
-    pooled_grads = pooled_grads.numpy()
-    for i in range(pooled_grads.shape[-1]):
-        last_conv_layer_output[:, :, i] *= pooled_grads[i]
-
-    # The channel-wise mean of the resulting feature map
-    # is our heatmap of class activation
-    heatmap = np.mean(last_conv_layer_output, axis=-1)
-
-    # For visualization purpose, we will also normalize the heatmap between 0 & 1
-    heatmap = np.maximum(heatmap, 0) / np.max(heatmap)
-    return heatmap
+    # the tf.function of each pair of networks is built (and traced) only once. It is kept in the __dict__ of the
+    # classifier, so it is freed with the models and the keras attribute tracking (and saving) ignores it
+    cached = classifier_model.__dict__.get('_batched_gradcam')
+    if cached is None or cached[0] is not last_conv_layer_model:
+        cached = (last_conv_layer_model, build_batched_gradcam(last_conv_layer_model, classifier_model))
+        classifier_model.__dict__['_batched_gradcam'] = cached
 
+    heatmaps, preds = cached[1](tf.convert_to_tensor(img_array, dtype=tf.float32))
+    heatmaps = heatmaps.numpy()
+    preds = preds.numpy()
+    if len(heatmaps) == 1:
+        heatmaps, preds = heatmaps[0], preds[0]
 
-def generate_heat_map_and_mask(heatmap, img, img_size):
+    if return_predictions is True:
+        return heatmaps, preds
+    return heatmaps
+
+
+def generate_heat_maps_and_masks(heatmaps, imgs, img_size):
     """
+    Batch version of generate_heat_map_and_mask
 
     Parameters
     ----------
-    heatmap : (array) heatmap generated with Gradcam
-    img : (array) 3ch image
+    heatmaps : (array) heatmaps generated with Gradcam, shape (N, h, w)
+    imgs : (array) RGB images, shape (N, H, W, 3)
     img_size : (tuple) size of the input to the network
 
     Returns
     -------
-    superimposed_img: (array)
-    mask_heatmap: (array)
-    binary_mask: (array)
+    superimposed_imgs: (array uint8) RGB images with the heatmaps superimposed, shape (N, H, W, 3)
+    masks_heatmap: (array) masks {0, 1} of size img_size, shape (N, img_size[1], img_size[0])
+    binary_masks: (array uint8) the same masks as 3 channel images {0, 255}
 
     """
-    mask_heatmap = cv2.resize(heatmap, img_size)
-
-    if np.isnan(np.sum(np.unique(mask_heatmap))):
-        mask_heatmap = np.zeros(img_size)
-    else:
-        limit = 0.7 * np.amax(mask_heatmap)
-        mask_heatmap[mask_heatmap >= limit] = 1
-        mask_heatmap[mask_heatmap < limit] = 0
-
-    # We rescale heatmap to a range 0-255
-    heatmap = np.uint8(255 * heatmap)
+    masks_heatmap, binary_masks = hmo.threshold_heatmaps(hmo.resize_heatmaps(heatmaps, img_size))
+    superimposed_imgs = hmo.overlay_heatmaps(imgs, heatmaps, alpha=0.4)
 
-    # We use jet colormap to colorize heatmap
-    jet = cm.get_cmap("jet")
+    return superimposed_imgs, masks_heatmap, binary_masks
 
-    # We use RGB values of the colormap
-    jet_colors = jet(np.arange(256))[:, :3]
-    jet_heatmap = jet_colors[heatmap]
 
-    # We create an image with RGB colorized heatmap
-    jet_heatmap = tf.keras.preprocessing.image.array_to_img(jet_heatmap)
-    jet_heatmap = jet_heatmap.resize((img.shape[1], img.shape[0]))
+def generate_heat_map_and_mask(heatmap, img, img_size):
+    """
 
-    jet_heatmap = tf.keras.preprocessing.image.img_to_array(jet_heatmap)
+    Parameters
+    ----------
+    heatmap : (array) heatmap generated with Gradcam
+    img : (array) 3ch image
+    img_size : (tuple) size of the input to the network
 
-    # Superimpose the heatmap on original image
-    superimposed_img = jet_heatmap * 0.4 + img
-    superimposed_img = tf.keras.preprocessing.image.array_to_img(superimposed_img)
+    Returns
+    -------
+    superimposed_img: (array uint8)
+    mask_heatmap: (array)
+    binary_mask: (array)
 
-    w, d = np.shape(mask_heatmap)
-    binary_mask = np.zeros((w, d, 3))
-    binary_mask[:, :, 0] = mask_heatmap * 255
-    binary_mask[:, :, 1] = mask_heatmap * 255
-    binary_mask[:, :, 2] = mask_heatmap * 255
+    """
+    superimposed_imgs, masks_heatmap, binary_masks = generate_heat_maps_and_masks(np.expand_dims(heatmap, 0),
+                                                                                np.expand_dims(img, 0), img_size)
 
-    return superimposed_img, mask_heatmap, binary_mask
+    return superimposed_imgs[0], masks_heatmap[0], binary_masks[0]
 
 
 def analyze_data_gradcam(name_model, dataset_dir, dataset_to_analyze, output_dir='', plot=False,
-                         save_results=True):
+                         save_results=True, batch_size=16):
     """
     Given a classification network and a dataset to analyze, it returns the heat-map and the binary mask
     Parameters
@@ -222,6 +246,7 @@ def analyze_data_gradcam(name_model, dataset_dir, dataset_to_analyze, output_dir
     output_dir :
     plot (bool):
     save_results (bool):
+    batch_size (int): number of images whose heatmaps are computed together
 
     Returns
     -------
@@ -293,35 +318,37 @@ def analyze_data_gradcam(name_model, dataset_dir, dataset_to_analyze, output_dir
             imgs_subdir = [dir_folder + f for f in os.listdir(dir_folder) if f.endswith('.png') or f.endswith('.jpg')]
             list_imgs = list_imgs + imgs_subdir
 
-        for i, img_path in enumerate(tqdm.tqdm(list_imgs, desc=f'Making mask predictions, {len(list_imgs)} images')):
-            # if you want to pick random paths uncomment bellow and comment the previous one to have a counter
-            #img_path = random.choice(list_imgs)
-            preprocess_input, img_size = gc.load_preprocess_input(backbone_model.name)
-            img_array = preprocess_input(gc.get_img_array(img_path, size=img_size))
-            img_name = os.path.split(img_path)[-1]
-            img = tf.keras.preprocessing.image.load_img(img_path)
-            img = tf.keras.preprocessing.image.img_to_array(img)
-            img = tf.keras.preprocessing.image.smart_resize(img, img_size, interpolation='bilinear')
-
-            test_img = cv2.imread(img_path)
-            test_img = cv2.cvtColor(test_img, cv2.COLOR_BGR2RGB)
-            img_resized = cv2.resize(test_img, img_size, interpolation=cv2.INTER_AREA)
-
-            heatmap = gc.make_gradcam_heatmap(img_array, last_conv_layer_model, classifier_model)
-            superimposed_img, mask_heatmap, binary_mask = generate_heat_map_and_mask(heatmap, img, img_size)
-            if save_results is True:
-                cv2.imwrite(binary_masks_dir + img_name, binary_mask)
-                superimposed_img.save(heat_maps_dir + img_name)
-
-            if plot is True:
-                plt.figure()
-                plt.subplot(131)
-                plt.imshow(img_resized)
-                plt.subplot(132)
-                plt.imshow(superimposed_img)
-                plt.subplot(133)
-                plt.imshow(mask_heatmap)
-                plt.show()
+        preprocess_input, img_size = gc.load_preprocess_input(backbone_model.name)
+        for j in tqdm.tqdm(range(0, len(list_imgs), batch_size),
+                           desc=f'Making mask predictions, {len(list_imgs)} images'):
+            batch_paths = list_imgs[j:j + batch_size]
+            # each image is decoded once, the same resized copy is the input of the network and the background
+            # of the heatmap
+            imgs_resized = np.stack([cv2.resize(cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB), img_size,
+                                                interpolation=cv2.INTER_AREA) for img_path in batch_paths])
+            imgs = imgs_resized.astype(np.float32)
+            img_batch = preprocess_input(imgs.copy())
+
+            # the heatmaps of the whole batch in one pass
+            heatmaps = gc.make_gradcam_heatmap(img_batch, last_conv_layer_model, classifier_model)
+            heatmaps = heatmaps.reshape((len(batch_paths),) + heatmaps.shape[-2:])
+            superimposed_imgs, masks_heatmap, binary_masks = generate_heat_maps_and_masks(heatmaps, imgs, img_size)
+            for img_path, img_resized, superimposed_img, mask_heatmap, binary_mask in \
+                    zip(batch_paths, imgs_resized, superimposed_imgs, masks_heatmap, binary_masks):
+                img_name = os.path.split(img_path)[-1]
+                if save_results is True:
+                    cv2.imwrite(binary_masks_dir + img_name, binary_mask)
+                    cv2.imwrite(heat_maps_dir + img_name, cv2.cvtColor(superimposed_img, cv2.COLOR_RGB2BGR))
+
+                if plot is True:
+                    plt.figure()
+                    plt.subplot(131)
+                    plt.imshow(img_resized)
+                    plt.subplot(132)
+                    plt.imshow(superimposed_img)
+                    plt.subplot(133)
+                    plt.imshow(mask_heatmap)
+                    plt.show()
 
     else:
         if daa.check_file_isvid(dataset_to_analyze):
@@ -395,6 +422,8 @@ def analyze_data_gradcam(name_model, dataset_dir, dataset_to_analyze, output_dir
             pos = 0
             cv2.createTrackbar('time', name_video, 0, total_frames, do_nothing)
             ret, img = cap.read()
+            # the heat map is only computed again when the frame changes
+            new_frame = True
             while cap.isOpened():
                 key = cv2.waitKey(1) & 0xFF
 
@@ -412,23 +441,26 @@ def analyze_data_gradcam(name_model, dataset_dir, dataset_to_analyze, output_dir
                     pos = cv2.getTrackbarPos('time', name_video)
                     loop_flag = pos
 
-                rgb = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                reshape_img = cv2.resize(rgb, img_size)
-                #im_pil = Image.fromarray(reshape_img)
-                array = tf.keras.preprocessing.image.img_to_array(reshape_img)
-                img_array = np.expand_dims(array, axis=0)
-                prediction = model.predict(img_array, verbose=True)
-                heatmap = gc.make_gradcam_heatmap(img_array, last_conv_layer_model, classifier_model)
-                superimposed_img, mask_heatmap, binary_mask = generate_heat_map_and_mask(heatmap, img, img_size)
-                open_cv_image = np.array(superimposed_img)
-                # Convert RGB to BGR
-                open_cv_image = open_cv_image[:, :, ::-1].copy()
+                if new_frame is True and ret:
+                    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                    reshape_img = cv2.resize(rgb, img_size)
+                    img_array = preprocess_input(np.expand_dims(reshape_img.astype(np.float32), axis=0))
+                    # the prediction comes from the same pass as the gradients
+                    heatmap, prediction = gc.make_gradcam_heatmap(img_array, last_conv_layer_model,
+                                                                  classifier_model, return_predictions=True)
+                    superimposed_img, mask_heatmap, binary_mask = generate_heat_map_and_mask(heatmap, rgb, img_size)
+                    # Convert RGB to BGR
+                    open_cv_image = cv2.cvtColor(superimposed_img, cv2.COLOR_RGB2BGR)
+                    cv2.putText(open_cv_image, f'class {np.argmax(prediction)}: {np.max(prediction):.2f}', (10, 30),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+                    new_frame = False
 
                 cv2.imshow(name_video, open_cv_image)
 
                 # (right arrow)
                 if key == 83:
                     ret, img = cap.read()
+                    new_frame = True
                     loop_flag = loop_flag + 1
                     cv2.setTrackbarPos('time', name_video, loop_flag)
 
@@ -436,6 +468,7 @@ def analyze_data_gradcam(name_model, dataset_dir, dataset_to_analyze, output_dir
                 if key == 81:
                     cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
                     ret, img = cap.read()
+                    new_frame = True
                     loop_flag = loop_flag - 1
                     cv2.setTrackbarPos('time', name_video, loop_flag)
 
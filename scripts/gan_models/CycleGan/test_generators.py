@@ -13,8 +13,7 @@ from tensorflow.keras.optimizers import SGD, Adam, RMSprop, Nadam
 from tensorflow.keras.models import Model
 import skimage.io as iio
 import cv2
-
-import skimage.io as iio
+import pandas as pd
 
 
 def _check(images, dtypes, min_value=-np.inf, max_value=np.inf):
@@ -221,6 +220,67 @@ def build_complete_model(G_A2B, G_B2A, target_domain='nbi'):
   return Model(inputs=input_model, outputs=output_layer, name='multi_input_output_classification')
 
 
+def convert_and_classify(model, model_classification, images_bgr, input_size=(224, 224)):
+    """
+    Converts a batch of images with the CycleGAN and classifies the original, converted and reconverted images
+    with a single call to the classifier. Everything stays in memory, the generated images are not written to
+    disk and read back.
+
+    :param model: (keras Model) conversion model, outputs [converted, reconverted] in [-1, 1]
+    :param model_classification: (keras Model) classifier, takes BGR images in [0, 255]
+    :param images_bgr: (list) images as read by cv2
+    :param input_size: (tuple) (width, height) input size of the classifier
+    :return: converted and reconverted images (RGB uint8), predictions of the original, converted and
+    reconverted images
+    """
+    num_images = len(images_bgr)
+    proc_imgs = np.stack([_map_fn(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), crop_size=256) for img in images_bgr])
+    converted, reconverted = model.predict_on_batch(proc_imgs)
+    converted = im2uint(np.asarray(converted))
+    reconverted = im2uint(np.asarray(reconverted))
+
+    # original, converted and reconverted images go to the classifier as one batch
+    batch = [cv2.resize(img, input_size) for img in images_bgr]
+    batch += [cv2.resize(cv2.cvtColor(img, cv2.COLOR_RGB2BGR), input_size) for img in converted]
+    batch += [cv2.resize(cv2.cvtColor(img, cv2.COLOR_RGB2BGR), input_size) for img in reconverted]
+    predictions = np.asarray(model_classification.predict_on_batch(np.stack(batch).astype(np.float32)))
+
+    return converted, reconverted, predictions[:num_images], predictions[num_images:2 * num_images], \
+           predictions[2 * num_images:]
+
+
+def prediction_rows(names, predictions_original, predictions_converted, predictions_reconverted, unique_classes):
+    """
+    Rows of the results csv, one per image
+    :param names: (list) name of each image (or frame number)
+    :param predictions_original: (array) predictions of the original images
+    :param predictions_converted: (array) predictions of the converted images
+    :param predictions_reconverted: (array) predictions of the reconverted images
+    :param unique_classes: (list) names of the classes
+    :return: (list) of dictionaries
+    """
+    rows = list()
+    for i, name in enumerate(names):
+        row = {'name': name}
+        for version, predictions in zip(['original', 'converted', 'reconverted'],
+                                        [predictions_original, predictions_converted, predictions_reconverted]):
+            row[' '.join(['predicted', version])] = unique_classes[int(np.argmax(predictions[i]))]
+            for j, class_name in enumerate(unique_classes):
+                row[' '.join([version, class_name])] = float(predictions[i][j])
+        rows.append(row)
+
+    return rows
+
+
+def get_classifier_input_size(model_classification, default=(224, 224)):
+    input_shape = model_classification.input_shape
+    if isinstance(input_shape, list):
+        input_shape = input_shape[0]
+    if input_shape[1] is None or input_shape[2] is None:
+        return default
+    return input_shape[2], input_shape[1]
+
+
 def main(_argv):
     base_dir = os.getcwd()
 
@@ -229,6 +289,8 @@ def main(_argv):
     target_test = FLAGS.test_target
     target_domain = FLAGS.target_domain
     directory_model = FLAGS.model_classification
+    batch_size = FLAGS.batch_size
+    results_dir = FLAGS.results_dir if FLAGS.results_dir else base_dir
     # models
     G_A2B = ResnetGenerator(input_shape=(256, 256, 3))
     G_B2A = ResnetGenerator(input_shape=(256, 256, 3))
@@ -241,66 +303,30 @@ def main(_argv):
 
     model_classification, input_size_classification = load_model(directory_model)
     print(input_size_classification)
+    input_size = get_classifier_input_size(model_classification)
+    rows = list()
     if os.path.isdir(target_test):
-        list_imgs = os.listdir(target_test)
-        for img in list_imgs:
-            print(img)
-            image_dir = target_test + img
-            input_image = imread(image_dir)
-            proc_imgs = _map_fn(input_image, crop_size=256)
-            proc_imgs = np.expand_dims(proc_imgs, axis=0)
-
-            predict = model.predict(proc_imgs)
-
-            img_b2a = predict[0][0]
-            img_b2a2b = predict[1][0]
-            imwrite(img_b2a, os.path.join(base_dir, 'temp_folder', 'converted.jpg'))
-            imwrite(img_b2a2b, os.path.join(base_dir, 'temp_folder', 'reconverted.jpg'))
-
-            c = im2uint(predict[0][0])
-            r = im2uint(predict[1][0])
-            print(np.amin(predict[0][0]), np.amax(predict[0][0]))
-            print(np.amin(predict[1][0]), np.amax(predict[1][0]))
-
-            input_c = cv2.resize(c, (224, 224))
-            input_r = cv2.resize(r, (224, 224))
-
-            input_c = cv2.cvtColor(input_c, cv2.COLOR_RGB2BGR)
-            input_r = cv2.cvtColor(input_r, cv2.COLOR_RGB2BGR)
-
-            class_c = model_classification.predict(np.expand_dims(input_c, axis=0))
-            class_r = model_classification.predict(np.expand_dims(input_r, axis=0))
-
-            print(np.shape(c), class_c, unique_classes[np.argmax(class_c)])
-            print(np.shape(r), class_r, unique_classes[np.argmax(class_r)])
-
-            input_cv = cv2.imread(image_dir)
-            plot_original = cv2.resize(input_cv, (256, 256))
-            #input_cv = cv2.cvtColor(input_cv, cv2.COLOR_BGR2RGB)
-            input_classification = cv2.resize(input_cv, (224, 224))
-            input_classification = np.expand_dims(input_classification, axis=0)
-            class_O = model_classification.predict(input_classification)
-            print('Prediction Original', class_O, unique_classes[np.argmax(class_O)])
-
-            read_c = cv2.imread(os.path.join(base_dir, 'temp_folder', 'converted.jpg'))
-            read_r = cv2.imread(os.path.join(base_dir, 'temp_folder', 'reconverted.jpg'))
-
-            input2_c = cv2.resize(read_c, (224, 224))
-            input2_r = cv2.resize(read_r, (224, 224))
-
-            #print(np.amin(input2_c), np.amax(input2_c))
-            #print(np.amin(input2_r), np.amax(input2_r))
-
-            class_c2 = model_classification.predict(np.expand_dims(input2_c, axis=0))
-            class_r2 = model_classification.predict(np.expand_dims(input2_r, axis=0))
-
-            print(np.shape(input2_c), class_c2, unique_classes[np.argmax(class_c2)])
-            print(np.shape(input2_r), class_r2, unique_classes[np.argmax(class_r2)])
-
-            img_mix = np.concatenate([plot_original, c, r], axis=1)
-            plt.figure()
-            plt.imshow(img_mix)
-            plt.show()
+        list_imgs = sorted(os.listdir(target_test))
+        for i in range(0, len(list_imgs), batch_size):
+            batch_names = list_imgs[i:i + batch_size]
+            batch_imgs = [cv2.imread(os.path.join(target_test, img)) for img in batch_names]
+            converted, reconverted, class_o, class_c, class_r = convert_and_classify(model, model_classification,
+                                                                                     batch_imgs, input_size)
+            rows += prediction_rows(batch_names, class_o, class_c, class_r, unique_classes)
+
+            for name, img, c, r, pred_o, pred_c, pred_r in zip(batch_names, batch_imgs, converted, reconverted,
+                                                               class_o, class_c, class_r):
+                print(name)
+                print('Prediction Original', pred_o, unique_classes[np.argmax(pred_o)])
+                print('Prediction Converted', pred_c, unique_classes[np.argmax(pred_c)])
+                print('Prediction Reconverted', pred_r, unique_classes[np.argmax(pred_r)])
+
+                if FLAGS.plot is True:
+                    plot_original = cv2.cvtColor(cv2.resize(img, (256, 256)), cv2.COLOR_BGR2RGB)
+                    img_mix = np.concatenate([plot_original, c, r], axis=1)
+                    plt.figure()
+                    plt.imshow(img_mix)
+                    plt.show()
 
     elif target_test.endswith('.avi') or target_test.endswith('.mp4') or target_test.endswith('.mpg'):
         # If the input is the camera, pass 0 instead of the video file name
@@ -309,54 +335,64 @@ def main(_argv):
         if (cap.isOpened() == False):
             print("Error opening video stream or file")
 
+        frame_number = 0
+        finished = False
         # Read until video is completed
-        while (cap.isOpened()):
-            # Capture frame-by-frame
-            ret, frame = cap.read()
-            if ret == True:
-                #image = frame
-                image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                image = np.expand_dims(image, axis=0)
-                proc_imgs = _map_fn(image, crop_size=256)
-                predict = model.predict(proc_imgs)
-                original_img = (proc_imgs[0] + 1) * (127)
-                c = im2uint(predict[0][0])
-                r = im2uint(predict[1][0])
-                img_mix = np.concatenate([c, r], axis=1)
-                # Display the resulting frame
-
-                #x = image / 255
-                #x = np.expand_dims(x, axis=0)
-                #y_pred = model_classification.predict(x)
+        while cap.isOpened() and not finished:
+            # Capture a batch of frames
+            frames = list()
+            while len(frames) < batch_size:
+                ret, frame = cap.read()
+                if ret == False:
+                    finished = True
+                    break
+                frames.append(frame)
+            if not frames:
+                break
 
+            converted, reconverted, class_o, class_c, class_r = convert_and_classify(model, model_classification,
+                                                                                     frames, input_size)
+            frame_names = list(range(frame_number, frame_number + len(frames)))
+            frame_number += len(frames)
+            rows += prediction_rows(frame_names, class_o, class_c, class_r, unique_classes)
 
-                original_img = (proc_imgs[0] + 1)
-                #norm_image = cv2.normalize(img_mix, None, alpha=np.amin(img_mix), beta=np.amax(img_mix),
-                #                           norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
+            for frame, c, r, pred_o, pred_c, pred_r in zip(frames, converted, reconverted, class_o, class_c, class_r):
+                img_mix = np.concatenate([c, r], axis=1)
+                # Display the resulting frame
                 norm_image = cv2.cvtColor(img_mix, cv2.COLOR_RGB2BGR)
+                for k, (version, pred) in enumerate(zip(['original', 'converted', 'reconverted'],
+                                                        [pred_o, pred_c, pred_r])):
+                    cv2.putText(norm_image, ' '.join([version, unique_classes[np.argmax(pred)]]), (10, 20 + 20 * k),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
                 reshaped_frame = cv2.resize(frame, (256, 256))
                 cv2.imshow('Original Frames', reshaped_frame)
                 cv2.imshow('Converted ', norm_image)
 
                 # Press Q on keyboard to  exit
                 if cv2.waitKey(25) & 0xFF == ord('q'):
+                    finished = True
                     break
 
-            # Break the loop
-            else:
-                break
-
         # When everything done, release the video capture object
         cap.release()
         # Closes all the frames
         cv2.destroyAllWindows()
 
+    if rows:
+        name_csv = ''.join(['predictions_', os.path.splitext(os.path.basename(os.path.normpath(target_test)))[0],
+                            '_', target_domain, '.csv'])
+        pd.DataFrame(rows).to_csv(os.path.join(results_dir, name_csv), index=False)
+        print(f'results saved at {os.path.join(results_dir, name_csv)}')
+
 
 if __name__ == '__main__':
     flags.DEFINE_string('model_dir', 'gan_merge_features', 'name of the model')
     flags.DEFINE_string('test_target', 'gan_merge_features', 'name of the model')
     flags.DEFINE_string('model_classification', '', 'model to perform classification')
     flags.DEFINE_string('target_domain', 'nbi', 'nbi ir wli')
+    flags.DEFINE_integer('batch_size', 8, 'number of images converted and classified at once')
+    flags.DEFINE_string('results_dir', '', 'directory where the csv with the predictions is saved')
+    flags.DEFINE_boolean('plot', False, 'plot the original, converted and reconverted images')
     try:
         app.run(main)
     except SystemExit:
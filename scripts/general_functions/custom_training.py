@@ -0,0 +1,170 @@
+import time
+import collections
+import tensorflow as tf
+
+
+class CustomTrainer:
+    """
+    Custom training loop with the train and validation steps compiled with tf.function (optionally with XLA).
+    The gradients can be accumulated over several micro-batches before each update, so the effective batch size
+    is accumulation_steps * batch size while only one micro-batch is kept in memory. Loss and metrics are
+    updated in-graph and only read at the end of each epoch.
+
+    e.g:
+    trainer = CustomTrainer(model, Adam(1e-4), tf.keras.losses.CategoricalCrossentropy(),
+                            metrics=[tf.keras.metrics.CategoricalAccuracy()], accumulation_steps=4,
+                            checkpoint_dir=results_directory + 'checkpoints/')
+    history = trainer.fit(train_dataset, epochs, train_steps, val_dataset, val_steps)
+    """
+
+    def __init__(self, model, optimizer, loss_fn, metrics=None, accumulation_steps=1, jit_compile=False,
+                 checkpoint_dir=None, checkpoint_every=1, max_to_keep=3):
+        """
+        :param model: (keras Model)
+        :param optimizer: (keras Optimizer)
+        :param loss_fn: (keras Loss)
+        :param metrics: (list) keras metrics, copies of them are used for the validation
+        :param accumulation_steps: (int) number of micro-batches accumulated before each update
+        :param jit_compile: (bool) compile the forward and backward passes with XLA
+        :param checkpoint_dir: (str) directory of the checkpoints, the latest one is restored to resume training
+        :param checkpoint_every: (int) save a checkpoint every checkpoint_every epochs
+        :param max_to_keep: (int) number of checkpoints kept
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.accumulation_steps = max(int(accumulation_steps), 1)
+        self.checkpoint_every = checkpoint_every
+
+        metrics = metrics if metrics is not None else []
+        self.train_loss = tf.keras.metrics.Mean(name='loss')
+        self.val_loss = tf.keras.metrics.Mean(name='val_loss')
+        self.train_metrics = metrics
+        self.val_metrics = [metric.__class__.from_config(metric.get_config()) for metric in metrics]
+
+        if self.accumulation_steps > 1:
+            self.accumulators = [tf.Variable(tf.zeros_like(variable), trainable=False)
+                                 for variable in model.trainable_variables]
+
+        self.epoch = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.manager = None
+        if checkpoint_dir:
+            checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, epoch=self.epoch)
+            self.manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=max_to_keep)
+            if self.manager.latest_checkpoint:
+                checkpoint.restore(self.manager.latest_checkpoint)
+                print(f'Training restored from {self.manager.latest_checkpoint}, epoch {int(self.epoch.numpy())}')
+
+        self._forward_backward = tf.function(self._forward_backward_fn, jit_compile=jit_compile)
+        self._train_step = tf.function(self._train_step_fn)
+        self._accumulate_step = tf.function(self._accumulate_step_fn)
+        self._apply_step = tf.function(self._apply_step_fn)
+        self._val_step = tf.function(self._val_step_fn, jit_compile=jit_compile)
+
+    def _forward_backward_fn(self, x, y):
+        with tf.GradientTape() as tape:
+            y_pred = self.model(x, training=True)
+            loss = self.loss_fn(y, y_pred)
+            if self.model.losses:
+                loss += tf.add_n(self.model.losses)
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        gradients = [g if g is not None else tf.zeros_like(v)
+                     for g, v in zip(gradients, self.model.trainable_variables)]
+        return loss, y_pred, gradients
+
+    def _update_metrics(self, loss, y, y_pred, loss_metric, metrics):
+        loss_metric.update_state(loss)
+        for metric in metrics:
+            metric.update_state(y, y_pred)
+
+    def _train_step_fn(self, x, y):
+        # one update per micro-batch
+        loss, y_pred, gradients = self._forward_backward(x, y)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        self._update_metrics(loss, y, y_pred, self.train_loss, self.train_metrics)
+
+    def _accumulate_step_fn(self, x, y):
+        loss, y_pred, gradients = self._forward_backward(x, y)
+        for accumulator, gradient in zip(self.accumulators, gradients):
+            accumulator.assign_add(gradient)
+        self._update_metrics(loss, y, y_pred, self.train_loss, self.train_metrics)
+
+    def _apply_step_fn(self, num_steps):
+        # the update uses the mean of the gradients of the accumulated micro-batches
+        scale = 1.0 / tf.cast(num_steps, tf.float32)
+        self.optimizer.apply_gradients([(accumulator * scale, variable) for accumulator, variable
+                                        in zip(self.accumulators, self.model.trainable_variables)])
+        for accumulator in self.accumulators:
+            accumulator.assign(tf.zeros_like(accumulator))
+
+    def _val_step_fn(self, x, y):
+        y_pred = self.model(x, training=False)
+        self._update_metrics(self.loss_fn(y, y_pred), y, y_pred, self.val_loss, self.val_metrics)
+
+    def reset_metrics(self):
+        for metric in [self.train_loss, self.val_loss] + self.train_metrics + self.val_metrics:
+            metric.reset_states()
+
+    def train_epoch(self, dataset, steps):
+        """
+        :param dataset: (tf.data.Dataset) of (x, y) micro-batches
+        :param steps: (int) number of micro-batches of the epoch
+        """
+        accumulated = 0
+        for x, y in dataset.take(steps):
+            if self.accumulation_steps == 1:
+                self._train_step(x, y)
+                continue
+            self._accumulate_step(x, y)
+            accumulated += 1
+            if accumulated == self.accumulation_steps:
+                self._apply_step(tf.constant(accumulated))
+                accumulated = 0
+        # the micro-batches left at the end of the epoch make a smaller update
+        if accumulated > 0:
+            self._apply_step(tf.constant(accumulated))
+
+    def evaluate(self, dataset, steps):
+        for x, y in dataset.take(steps):
+            self._val_step(x, y)
+
+    def fit(self, train_dataset, epochs, steps_per_epoch, val_dataset=None, validation_steps=None, verbose=True):
+        """
+        :param train_dataset: (tf.data.Dataset) repeated dataset of (x, y) micro-batches
+        :param epochs: (int) total number of epochs, when a checkpoint is restored the training continues from
+        its epoch
+        :param steps_per_epoch: (int) micro-batches per epoch
+        :param val_dataset: (tf.data.Dataset)
+        :param validation_steps: (int)
+        :param verbose: (bool) print the metrics at the end of each epoch
+        :return: (dict) history, {metric name: list of values per epoch}
+        """
+        history = collections.defaultdict(list)
+        for epoch in range(int(self.epoch.numpy()), epochs):
+            start_time = time.time()
+            self.reset_metrics()
+            self.train_epoch(train_dataset, steps_per_epoch)
+            if val_dataset is not None:
+                self.evaluate(val_dataset, validation_steps)
+
+            history['epoch'].append(epoch)
+            results = [(metric.name, metric) for metric in [self.train_loss] + self.train_metrics]
+            if val_dataset is not None:
+                results += [(self.val_loss.name, self.val_loss)]
+                results += [('val_' + metric.name, metric) for metric in self.val_metrics]
+            for name, metric in results:
+                history[name].append(float(metric.result()))
+
+            self.epoch.assign(epoch + 1)
+            if self.manager is not None and (epoch + 1) % self.checkpoint_every == 0:
+                self.manager.save(checkpoint_number=epoch + 1)
+
+            if verbose:
+                results = ', '.join([f'{name}: {values[-1]:.4f}' for name, values in history.items()
+                                     if name != 'epoch'])
+                print(f'Epoch {epoch + 1}/{epochs} ({time.time() - start_time:.1f}s) {results}')
+
+        if self.manager is not None and int(self.epoch.numpy()) % self.checkpoint_every != 0:
+            self.manager.save(checkpoint_number=int(self.epoch.numpy()))
+
+        return dict(history)
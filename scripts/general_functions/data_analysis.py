@@ -104,6 +104,24 @@ def calculate_auc_and_roc(predicted, real, case_name, plot=True, results_directo
     :return:
     """
     y_test, y_pred = match_pair_of_data(predicted, real)
+    return calculate_auc_and_roc_from_arrays(y_test, y_pred, case_name, plot=plot,
+                                             results_directory=results_directory, results_id=results_id,
+                                             save_plot=save_plot)
+
+
+def calculate_auc_and_roc_from_arrays(y_test, y_pred, case_name, plot=True, results_directory='',
+                                      results_id='', save_plot=False):
+    """
+    Same as calculate_auc_and_roc but with the labels and scores already in memory
+    :param y_test: (list) ground truth labels (0 or 1)
+    :param y_pred: (list) predicted score of the class 1
+    :param case_name:
+    :param plot:
+    :param results_directory:
+    :param results_id:
+    :param save_plot:
+    :return: (float) AUC
+    """
     fpr_keras, tpr_keras, thresholds_keras = roc_curve(y_test, y_pred)
     auc_keras = auc(fpr_keras, tpr_keras)
 
@@ -8,11 +8,15 @@ import pandas as pd
 import ast
 import shutil
 import random
-import colorsys
-from scipy.ndimage import zoom
 from PIL import Image
 import re
 import datetime
+import json
+import functools
+from concurrent import futures
+import multiprocessing
+import collections
+import h5py
 
 from matplotlib import pyplot as plt
 import tensorflow as tf
@@ -48,87 +52,80 @@ def load_video(path, max_frames=0, resize=(255, 255)):
     return np.array(frames)
 
 
-def clipped_zoom(img, zoom_factor, **kwargs):
+def clipped_zoom(img, zoom_factor, interpolation=cv2.INTER_LINEAR):
     """
-    :param img:
-    :param zoom_factor:
-    :param kwargs:
-    :return:
+    Zooms in (zoom_factor > 1) or out (zoom_factor < 1) around the center of the image keeping its size,
+    when zooming out the border is filled with zeros. It is a single affine warp, use
+    interpolation=cv2.INTER_NEAREST for masks.
+    :param img: (array) image
+    :param zoom_factor: (float)
+    :param interpolation: cv2 interpolation flag
+    :return: (array) zoomed image with the same shape and dtype as img
     """
+    if zoom_factor == 1:
+        return img
 
     h, w = img.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), 0, zoom_factor)
+    out = cv2.warpAffine(img, matrix, (w, h), flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    # cv2 drops the channel axis of single channel images
+    return out.reshape(img.shape)
 
-    # For multichannel images we don't want to apply the zoom factor to the RGB
-    # dimension, so instead we create a tuple of zoom factors, one per array
-    # dimension, with 1's for any trailing dimensions after the width and height.
-    zoom_tuple = (zoom_factor,) * 2 + (1,) * (img.ndim - 2)
-
-    # Zooming out
-    if zoom_factor < 1:
 
-        # Bounding box of the zoomed-out image within the output array
-        zh = int(np.round(h * zoom_factor))
-        zw = int(np.round(w * zoom_factor))
-        top = (h - zh) // 2
-        left = (w - zw) // 2
-
-        # Zero-padding
-        out = np.zeros_like(img)
-        out[top:top + zh, left:left + zw] = zoom(img, zoom_tuple, **kwargs)
-
-    # Zooming in
-    elif zoom_factor > 1:
+@functools.lru_cache(maxsize=None)
+def _gamma_table(gamma):
+    invGamma = 1.0 / gamma
+    return (((np.arange(0, 256) / 255.0) ** invGamma) * 255).astype("uint8")
 
-        # Bounding box of the zoomed-in region within the input array
-        zh = int(np.round(h / zoom_factor))
-        zw = int(np.round(w / zoom_factor))
-        top = (h - zh) // 2
-        left = (w - zw) // 2
 
-        out = zoom(img[top:top + zh, left:left + zw], zoom_tuple, **kwargs)
+def adjust_brightness(image, gamma=1.0):
+    """
+    Gamma correction through a look up table, the table of each gamma is computed only once
+    :param image: (array uint8)
+    :param gamma: (float)
+    :return: (array uint8)
+    """
+    return cv2.LUT(image, _gamma_table(gamma))
 
-        # `out` might still be slightly larger than `img` due to rounding, so
-        # trim off any extra pixels at the edges
-        # trim_top = ((out.shape[0] - h) // 2)
-        # trim_left = ((out.shape[1] - w) // 2)
-        # out = out[trim_top:trim_top+h, trim_left:trim_left+w]
 
-    # If zoom_factor == 1, just return the input array
-    else:
-        out = img
-    return out
+def adjust_contrast(image, contrast_factor):
+    """
+    Same operation as tf.image.adjust_contrast: (x - mean) * contrast_factor + mean, with the mean of each channel
+    :param image: (array uint8)
+    :param contrast_factor: (float)
+    :return: (array uint8)
+    """
+    mean = image.mean(axis=(0, 1), keepdims=True)
+    out = (image.astype(np.float32) - mean) * contrast_factor + mean
+    return np.clip(out, 0, 255).astype(np.uint8)
 
 
-def adjust_brightness(image, gamma=1.0):
+def adjust_saturation(image, saturation_factor, bgr=True):
     """
-
-    :param image:
-    :param gamma:
-    :return:
+    Multiplies the saturation channel in HSV space, same as tf.image.adjust_saturation
+    :param image: (array uint8) 3 channels image
+    :param saturation_factor: (float)
+    :param bgr: (bool) channels in BGR order (cv2.imread)
+    :return: (array uint8)
     """
-    invGamma = 1.0 / gamma
-    table = np.array([((i / 255.0) ** invGamma) * 255
-                      for i in np.arange(0, 256)]).astype("uint8")
-
-    return cv2.LUT(image, table)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV if bgr is True else cv2.COLOR_RGB2HSV)
+    hsv[..., 1] = cv2.convertScaleAbs(hsv[..., 1], alpha=saturation_factor)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR if bgr is True else cv2.COLOR_HSV2RGB)
 
 
 def shift_hue(arr, hout):
     """
-
-    :param arr:
-    :param hout:
-    :return:
+    Sets the hue of an RGBA image
+    :param arr: (array) RGBA image with values in [0, 255]
+    :param hout: (float) hue in [0, 1]
+    :return: (array float) RGBA image
     """
-
-    rgb_to_hsv = np.vectorize(colorsys.rgb_to_hsv)
-    hsv_to_rgb = np.vectorize(colorsys.hsv_to_rgb)
-    r, g, b, a = np.rollaxis(arr, axis=-1)
-    h, s, v = rgb_to_hsv(r, g, b)
-    h = hout
-    r, g, b = hsv_to_rgb(h, s, v)
-    arr = np.dstack((r, g, b, a))
-    return arr
+    rgb = np.clip(arr[..., :3], 0, 255).astype(np.uint8)
+    # cv2 encodes the hue of uint8 images in [0, 180)
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+    hsv[..., 0] = int(round(hout * 180)) % 180
+    rgb = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+    return np.dstack((rgb.astype(arr.dtype), arr[..., 3]))
 
 
 def colorize(image, hue):
@@ -147,133 +144,70 @@ def colorize(image, hue):
     return new_img
 
 
-def augment_image(img, mask=[]):
+def augment_image(img, mask=None, seed=None):
     """
-
-    :param img:
-    :param mask:
-    :return:
+    Generates 14 augmented versions of an image (the original, rotations, flips, gamma, zoom in/out, contrast and
+    saturation). Only cv2/NumPy operations are used so it can run in worker processes.
+    :param img: (array uint8) image
+    :param mask: (array) mask, it gets the same geometric transformations as the image
+    :param seed: (int) seed of the random choices, if None the global random state is used
+    :return: augmented_imgs, (augmented_masks), list_operations
     """
+    rng = random.Random(seed) if seed is not None else random
+    has_mask = mask is not None and len(mask) > 0
     augmented_imgs = []
     augmented_masks = []
     list_operations = []
 
     augmented_imgs.append(img)
-    if mask:
+    list_operations.append('original')
+    if has_mask:
         augmented_masks.append(mask)
 
-    rows, cols, channels = img.shape
-    # define the rotation matrixes
-    rot1 = cv2.getRotationMatrix2D((cols / 2, rows / 2), 90, 1)
-    rot2 = cv2.getRotationMatrix2D((cols / 2, rows / 2), 180, 1)
-    rot3 = cv2.getRotationMatrix2D((cols / 2, rows / 2), 270, 1)
-
-    # rotate the images
-    im_rot1 = cv2.warpAffine(img, rot1, (cols, rows))
-    im_rot2 = cv2.warpAffine(img, rot2, (cols, rows))
-    im_rot3 = cv2.warpAffine(img, rot3, (cols, rows))
-    augmented_imgs.append(im_rot1)
-    augmented_imgs.append(im_rot2)
-    augmented_imgs.append(im_rot3)
-
-    # rotate the masks
-    if mask:
-        mask_rot1 = cv2.warpAffine(mask, rot1, (cols, rows))
-        mask_rot2 = cv2.warpAffine(mask, rot2, (cols, rows))
-        mask_rot3 = cv2.warpAffine(mask, rot3, (cols, rows))
-        augmented_masks.append(mask_rot1)
-        augmented_masks.append(mask_rot2)
-        augmented_masks.append(mask_rot3)
-
-    # flip images
-    horizontal_img = cv2.flip(img, 0)
-    vertical_img = cv2.flip(img, 1)
-    augmented_imgs.append(horizontal_img)
-    augmented_imgs.append(vertical_img)
-    # flip masks
-    if mask:
-        horizontal_mask = cv2.flip(mask, 0)
-        vertical_mask = cv2.flip(mask, 1)
-        augmented_masks.append(horizontal_mask)
-        augmented_masks.append(vertical_mask)
+    # rotate and flip the images and the masks
+    for rotation in [cv2.ROTATE_90_COUNTERCLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_CLOCKWISE]:
+        augmented_imgs.append(cv2.rotate(img, rotation))
+        if has_mask:
+            augmented_masks.append(cv2.rotate(mask, rotation))
+    list_operations += ['rot90', 'rot180', 'rot270']
+
+    for flip in [0, 1]:
+        augmented_imgs.append(cv2.flip(img, flip))
+        if has_mask:
+            augmented_masks.append(cv2.flip(mask, flip))
+    list_operations += ['flip_vertical', 'flip_horizontal']
 
     list_of_images = copy.copy(augmented_imgs)
-    if mask:
+    if has_mask:
         list_of_masks = copy.copy(augmented_masks)
 
+    def _add(operation, name, mask_operation=None):
+        index = rng.randint(0, len(list_of_images) - 1)
+        augmented_imgs.append(operation(list_of_images[index]))
+        list_operations.append(''.join([list_operations[index], '+', name]))
+        if has_mask:
+            mask_choice = list_of_masks[index]
+            augmented_masks.append(mask_operation(mask_choice) if mask_operation else mask_choice)
+
     # change brightness
     gammas = [0.6, 0.7, 0.8, 0.9, 1.1, 1.2, 1.3, 1.4, 1.5]
-
     for i in range(4):
-        index = random.randint(0, len(list_of_images) - 1)
-        img_choice = list_of_images[index]
-        if mask:
-            mask_choice = list_of_masks[index]
-        image_brg = adjust_brightness(img_choice, random.choice(gammas))
-        augmented_imgs.append(image_brg)
-        if mask:
-            augmented_masks.append(mask_choice)
-
-    # zoom in
-    index_2 = random.randint(0, len(list_of_images) - 1)
-    img_choice_2 = list_of_images[index_2]
-    zoom_in_img = clipped_zoom(img_choice_2, 1.2)
-    if mask:
-        mask_choice_2 = list_of_masks[index_2]
-        zoom_in_mask = clipped_zoom(mask_choice_2, 1.2)
-
-    augmented_imgs.append(zoom_in_img)
-    if mask:
-        augmented_masks.append(zoom_in_mask)
-
-    # zoom out
-    index_3 = random.randint(0, len(list_of_images) - 1)
-    img_choice_3 = list_of_images[index_3]
-    zoom_out_img = clipped_zoom(img_choice_3, 0.8)
-    augmented_imgs.append(zoom_out_img)
-
-    if mask:
-        mask_choice_3 = list_of_masks[index_3]
-        zoom_out_mask = clipped_zoom(mask_choice_3, 0.8)
-        augmented_masks.append(zoom_out_mask)
-
-
-    # change hue
-    #index_4 = random.randint(0, len(list_of_images) - 1)
-    #img_choice_4 = list_of_images[index_4]
-    #mask_choice_4 = list_of_masks[index_4]
-    #colorized = colorize(img_choice_4, np.random.randint(70, 220))
-    #augmented_imgs.append(colorized)
-    #augmented_masks.append(mask_choice_4)
-
-    # change contrast
-    index_5 = random.randint(0, len(list_of_images) - 1)
-    img_choice_5 = list_of_images[index_5]
-    stateless_random_contrast = tf.image.stateless_random_contrast(img_choice_5, lower=0.5, upper=0.9, seed = (i, 0))
-    augmented_imgs.append(stateless_random_contrast.numpy())
-
-    if mask:
-        mask_choice_5 = list_of_masks[index_5]
-        augmented_masks.append(mask_choice_5)
-
+        gamma = rng.choice(gammas)
+        _add(lambda x: adjust_brightness(x, gamma), f'gamma_{gamma}')
 
-    #index_6 = random.randint(0, len(list_of_images) - 1)
-    #img_choice_6 = list_of_images[index_6]
-    #mask_choice_6 = list_of_masks[index_6]
-    #noisy_image = skimage.util.random_noise(img_choice_6, mode='s&p')
-    #augmented_imgs.append(noisy_image)
-    #augmented_masks.append(mask_choice_6)
+    # zoom in and out
+    for zoom_factor, name in [(1.2, 'zoom_in'), (0.8, 'zoom_out')]:
+        _add(lambda x: clipped_zoom(x, zoom_factor), name,
+             mask_operation=lambda x: clipped_zoom(x, zoom_factor, interpolation=cv2.INTER_NEAREST))
 
-    index_7 = random.randint(0, len(list_of_images) - 1)
-    img_choice_7 = list_of_images[index_7]
-    saturated = tf.image.adjust_saturation(img_choice_7, 3)
-    augmented_imgs.append(saturated.numpy())
+    # change contrast
+    contrast_factor = rng.uniform(0.5, 0.9)
+    _add(lambda x: adjust_contrast(x, contrast_factor), 'contrast')
 
-    if mask:
-        mask_choice_7 = list_of_masks[index_7]
-        augmented_masks.append(mask_choice_7)
+    # change saturation
+    _add(lambda x: adjust_saturation(x, 3), 'saturation')
 
-    if mask:
+    if has_mask:
         return augmented_imgs, augmented_masks, list_operations
     else:
         return augmented_imgs, list_operations
@@ -360,19 +294,54 @@ def arrange_data_from_gan(path_datafile, csv_annotations_dir, destination_dir=''
     print(f'File saved at:{output_csv_file_dir}')
 
 
-def augment_dataset(files_path, destination_path='', visualize_augmentation=False, augment_maks=False):
+def _augment_and_save(files_path, destination_path, element, augment_maks, seed):
     """
-    Performs data augmentation given a directory containing images and masks
-    :param files_path:
-    :param destination_path:
-    :return:
+    Reads one image (and its mask), augments it and writes the results. Runs in the worker processes of
+    augment_dataset.
+    :return: (str, list) name of the image and names of the files written
     """
     if augment_maks is True:
-        files = os.listdir(files_path + 'images/')
-        masks = os.listdir(files_path + 'masks/')
+        img = cv2.imread("".join([files_path, 'images/', element]))
+        mask = cv2.imread("".join([files_path, 'masks/', element]))
+        list_images, list_masks, list_operations = augment_image(img, mask, seed=seed)
+    else:
+        img = cv2.imread("".join([files_path, element]))
+        list_images, list_operations = augment_image(img, seed=seed)
+
+    written_files = list()
+    for i, image in enumerate(list_images):
+        name_file = ''.join([element[:-4], '_', str(i).zfill(3), '.png'])
+        if augment_maks is True:
+            cv2.imwrite("".join([destination_path, 'images/', name_file]), image)
+            cv2.imwrite("".join([destination_path, 'masks/', name_file]), list_masks[i])
+        else:
+            cv2.imwrite("".join([destination_path, name_file]), image)
+        written_files.append(name_file)
+
+    return element, written_files
+
+
+def augment_dataset(files_path, destination_path='', visualize_augmentation=False, augment_maks=False,
+                    workers=None, seed=0, manifest_name='augmentation_manifest.json'):
+    """
+    Performs data augmentation given a directory containing images and masks. The images are processed in
+    parallel by a pool of processes and the files already written are recorded in a manifest in
+    destination_path, so an interrupted run continues where it stopped.
+    :param files_path: directory with the images, or with the folders 'images' and 'masks' if augment_maks
+    :param destination_path: directory where the augmented data is saved, by default files_path
+    :param visualize_augmentation: (bool) plot the augmentations of each image, it runs in a single process
+    :param augment_maks: (bool) augment also the masks
+    :param workers: (int) number of processes, by default the number of CPUs
+    :param seed: (int) the augmentations of each image are seeded with seed + its position in the directory
+    :param manifest_name: (str) name of the manifest file
+    :return: (dict) manifest {image_name: [augmented files]}
+    """
+    if augment_maks is True:
+        files = sorted(os.listdir(files_path + 'images/'))
+        masks = set(os.listdir(files_path + 'masks/'))
 
     else:
-        files = os.listdir(files_path)
+        files = sorted([f for f in os.listdir(files_path) if os.path.isfile(files_path + f)])
 
     if destination_path == '':
         destination_path = files_path
@@ -384,42 +353,58 @@ def augment_dataset(files_path, destination_path='', visualize_augmentation=Fals
                 os.mkdir(destination_path + 'images/')
                 os.mkdir(destination_path + 'masks/')
 
-    for i, element in enumerate(tqdm.tqdm(files[:], desc='Augmenting Dataset')):
-        if augment_maks is True:
-            if element not in masks:
-                print(f'{element}, has no pair')
-
-        if augment_maks is True:
-            img = cv2.imread("".join([files_path, 'images/', element]))
-            mask = cv2.imread("".join([files_path, 'masks/', element]))
-
-        else:
-            img = cv2.imread("".join([files_path, element]))
-
-        if augment_maks is True:
-            list_images, list_masks, list_operations, = augment_image(img, mask)
-
-        else:
-            list_images, list_operations, = augment_image(img)
-
-        # visualize the augmentation
-
-        if visualize_augmentation is True:
+    manifest_dir = destination_path + manifest_name
+    if os.path.isfile(manifest_dir):
+        with open(manifest_dir, 'r') as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+
+    def _save_manifest():
+        with open(manifest_dir + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_dir + '.tmp', manifest_dir)
+
+    # when destination_path is files_path the augmented files are in the same directory as the originals
+    written_files = {f for list_files in manifest.values() for f in list_files}
+    pending = list()
+    for i, element in enumerate(files):
+        if element == manifest_name or element in manifest or element in written_files:
+            continue
+        if augment_maks is True and element not in masks:
+            print(f'{element}, has no pair')
+            continue
+        pending.append((i, element))
+
+    print(f'{len(files) - len(pending)} images already augmented, {len(pending)} to go')
+
+    if visualize_augmentation is True:
+        for i, element in tqdm.tqdm(pending, desc='Augmenting Dataset'):
+            img = cv2.imread("".join([files_path, 'images/' if augment_maks is True else '', element]))
+            list_images = augment_image(img, seed=seed + i)[0]
             plt.figure()
-            for i in range(len(list_images)-1):
-                plt.subplot(4, 4, i+1)
-                plt.imshow(list_images[i])
-
+            for j in range(len(list_images)):
+                plt.subplot(4, 4, j + 1)
+                plt.imshow(cv2.cvtColor(list_images[j], cv2.COLOR_BGR2RGB))
             plt.show()
-
-        # save the images
-        for i, image in enumerate(list_images):
-            if augment_maks is True:
-                cv2.imwrite("".join([destination_path, 'images/', element[:-4], '_', str(i).zfill(3), '.png']), list_images[i])
-                cv2.imwrite("".join([destination_path, 'masks/', element[:-4], '_', str(i).zfill(3), '.png']), list_masks[i])
-            else:
-                cv2.imwrite("".join([destination_path, element[:-4], '_', str(i).zfill(3), '.png']),
-                            list_images[i])
+            element, written_files = _augment_and_save(files_path, destination_path, element, augment_maks,
+                                                       seed + i)
+            manifest[element] = written_files
+            _save_manifest()
+        return manifest
+
+    # the workers are spawned, forking a process where TensorFlow already started its threads can deadlock
+    with futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        jobs = [executor.submit(_augment_and_save, files_path, destination_path, element, augment_maks, seed + i)
+                for i, element in pending]
+        for j, job in enumerate(tqdm.tqdm(futures.as_completed(jobs), total=len(jobs), desc='Augmenting Dataset')):
+            element, written_files = job.result()
+            manifest[element] = written_files
+            if j % 100 == 0:
+                _save_manifest()
+
+    _save_manifest()
+    return manifest
 
 
 def check_folder_exists(folder_dir, create_folder=False):
@@ -1110,6 +1095,126 @@ def build_dictionary_data_labels(path_dir, path_annotation_file=''):
     return dictionary
 
 
+def build_dataset_manifest(path_data, csv_annotations=None, manifest_file=None,
+                           label_columns=['tissue type', 'imaging type'], save=True):
+    """
+    Scans a dataset directory once and keeps an on-disk index (manifest) of its files with their size,
+    modification time and the label columns of the annotations file. If the manifest already exists only the
+    directories whose modification time changed are listed again to add and remove files, in the other ones
+    the size and modification time of the known files are refreshed (files rewritten in place do not change
+    the modification time of their directory), so refreshing a big unchanged dataset costs one scandir per
+    directory.
+
+    :param path_data: (str) root directory of the dataset
+    :param csv_annotations: (str) annotations file with an 'image_name' column
+    :param manifest_file: (str) path of the manifest, by default '<path_data>_manifest.json' next to path_data,
+    so writing it does not change the modification time of the dataset directories
+    :param label_columns: (list) columns of the annotations to store with each file
+    :param save: (bool) save the manifest after refreshing it
+    :return: (dict) manifest, its key 'files' maps the relative path of each file to its information
+    """
+    if manifest_file is None:
+        manifest_file = os.path.normpath(path_data) + '_manifest.json'
+
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    else:
+        manifest = {'directories': {}, 'files': {}, 'annotations': {}}
+
+    directories = manifest['directories']
+    files = manifest['files']
+    files_by_dir = collections.defaultdict(list)
+    for rel_path, entry in files.items():
+        files_by_dir[entry['dir']].append(rel_path)
+
+    seen_dirs = set()
+    changed_dirs = 0
+    stack = ['.']
+    while stack:
+        rel_dir = stack.pop()
+        seen_dirs.add(rel_dir)
+        abs_dir = os.path.normpath(os.path.join(path_data, rel_dir))
+        mtime_dir = os.stat(abs_dir).st_mtime
+        if rel_dir in directories and directories[rel_dir]['mtime'] == mtime_dir:
+            # same files, only their contents may have changed
+            known_files = set(files_by_dir.get(rel_dir, []))
+            with os.scandir(abs_dir) as entries:
+                for entry in entries:
+                    rel_path = os.path.normpath(os.path.join(rel_dir, entry.name))
+                    if rel_path in known_files:
+                        stat = entry.stat()
+                        files[rel_path]['size'] = stat.st_size
+                        files[rel_path]['mtime'] = stat.st_mtime
+            stack += directories[rel_dir]['subdirs']
+            continue
+
+        changed_dirs += 1
+        for rel_path in files_by_dir.pop(rel_dir, []):
+            files.pop(rel_path, None)
+
+        subdirs = list()
+        with os.scandir(abs_dir) as entries:
+            for entry in entries:
+                rel_path = os.path.normpath(os.path.join(rel_dir, entry.name))
+                if entry.is_dir():
+                    subdirs.append(rel_path)
+                # the manifests used to be saved inside path_data as dataset_manifest.json
+                elif os.path.abspath(entry.path) != os.path.abspath(manifest_file) and \
+                        entry.name != 'dataset_manifest.json':
+                    stat = entry.stat()
+                    files[rel_path] = {'image_name': entry.name, 'dir': rel_dir, 'size': stat.st_size,
+                                       'mtime': stat.st_mtime, 'labels': {}}
+        directories[rel_dir] = {'mtime': mtime_dir, 'subdirs': subdirs}
+        stack += subdirs
+
+    # directories that do not exist anymore
+    for rel_dir in [d for d in directories if d not in seen_dirs]:
+        directories.pop(rel_dir)
+        for rel_path in files_by_dir.pop(rel_dir, []):
+            files.pop(rel_path, None)
+
+    if csv_annotations:
+        data_frame = pd.read_csv(csv_annotations).drop_duplicates(subset='image_name')
+        columns = [c for c in label_columns if c in data_frame.columns]
+        annotations = data_frame.set_index('image_name')[columns].to_dict('index')
+        for entry in files.values():
+            row = annotations.get(entry['image_name'])
+            entry['labels'] = {} if row is None else \
+                {c: (None if pd.isnull(v) else getattr(v, 'item', lambda: v)()) for c, v in row.items()}
+        manifest['annotations'] = {'file': csv_annotations, 'mtime': os.stat(csv_annotations).st_mtime}
+
+    if save is True:
+        manifest_dir = os.path.relpath(os.path.dirname(os.path.abspath(manifest_file)), os.path.abspath(path_data))
+        created = not os.path.isfile(manifest_file)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f)
+        if created and manifest_dir in directories:
+            # a manifest inside path_data changes the modification time of its directory when it is created
+            directories[manifest_dir]['mtime'] = os.stat(os.path.dirname(os.path.abspath(manifest_file))).st_mtime
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f)
+
+    print(f'Manifest of {path_data}: {len(files)} files, {changed_dirs}/{len(directories)} directories scanned')
+    return manifest
+
+
+def manifest_name_index(manifest):
+    """
+    Builds a dictionary {image_name: relative path} to query a manifest in O(1) by the name of the file
+    :param manifest: (dict) manifest returned by build_dataset_manifest
+    :return: (dict)
+    """
+    name_index = {}
+    for rel_path, entry in manifest['files'].items():
+        if entry['image_name'] in name_index:
+            print(f"{entry['image_name']} found more than once, using {name_index[entry['image_name']]}")
+        else:
+            name_index[entry['image_name']] = rel_path
+
+    return name_index
+
+
 def read_mat_files(file_dir):
     """
     Read a .mat file
@@ -1422,7 +1527,8 @@ def merge_annotations_data(annotations_list, selected_elements=[], output_dir=''
 
 
 def merge_multi_domain_data(directory_dataset, keywords=['converted', 'reconverted'], csv_annotations=None,
-                            output_dir=None, output_shape=(256,256), compress=False):
+                            output_dir=None, output_shape=(256,256), compress=False, output_format=None,
+                            store_name='triplets'):
     """
 
     Parameters
@@ -1431,13 +1537,25 @@ def merge_multi_domain_data(directory_dataset, keywords=['converted', 'reconvert
     keywords :
     csv_annotations :
     output_dir :
+    output_shape :
+    compress : (bool) kept for compatibility, same as output_format='npz'
+    output_format : (str) 'npy' (default), 'npz', 'memmap' or 'hdf5'. 'npy' and 'npz' save one file per triplet,
+        'memmap' and 'hdf5' save all the triplets in a single preallocated array (store_name.npy or store_name.h5)
+        plus a name->row index (store_name_index.json)
+    store_name : (str) name of the store when output_format is 'memmap' or 'hdf5'
 
     Returns
     -------
 
     """
 
+    if output_format is None:
+        output_format = 'npz' if compress is True else 'npy'
+    if output_format not in ['npy', 'npz', 'memmap', 'hdf5']:
+        raise ValueError(f"output_format should be 'npy', 'npz', 'memmap' or 'hdf5', got {output_format}")
+
     list_img_files = os.listdir(directory_dataset)
+    set_img_files = set(list_img_files)
 
     if output_dir is None:
         output_dir = directory_dataset
@@ -1455,37 +1573,119 @@ def merge_multi_domain_data(directory_dataset, keywords=['converted', 'reconvert
     for key_word in keywords:
         original_names = [f for f in original_names if key_word not in f]
 
-    # iterate over each of the "base" names
-    for i, image_name in enumerate(tqdm.tqdm(original_names[:], desc='Arranging data')):
+    # find the "base" names which have both, the converted and the reconverted pair
+    list_triplets = list()
+    for image_name in original_names:
         search_name = image_name[:-8]
         transformation_id = re.findall(r"(\d+).png", image_name).pop() + '.png'
-        matching_names = list()
         conv_name = ''.join([search_name, '_', 'converted__', transformation_id])
         reconv_name = ''.join([search_name, '_', 'reconverted__', transformation_id])
+        if conv_name in set_img_files and reconv_name in set_img_files:
+            save_name = ''.join([search_name, '_', transformation_id.replace('.png', '')])
+            list_triplets.append((save_name, [image_name, conv_name, reconv_name]))
+
+    def _read_triplet(ordered_matching_names):
+        array_imgs = np.zeros((3, output_shape[0], output_shape[1], 3), dtype=np.uint8)
+        for j, img_name in enumerate(ordered_matching_names):
+            img = tf.keras.utils.load_img(directory_dataset + img_name, target_size=output_shape,
+                                          interpolation='bilinear')
+            array_imgs[j] = tf.keras.utils.img_to_array(img, dtype='uint8')
+        return array_imgs
+
+    store_shape = (len(list_triplets), 3, output_shape[0], output_shape[1], 3)
+    if output_format == 'memmap':
+        store_dir = output_dir + store_name + '.npy'
+        store = np.lib.format.open_memmap(store_dir, mode='w+', dtype=np.uint8, shape=store_shape)
+    elif output_format == 'hdf5':
+        store_dir = output_dir + store_name + '.h5'
+        h5_file = h5py.File(store_dir, 'w')
+        store = h5_file.create_dataset('triplets', shape=store_shape, dtype=np.uint8,
+                                       chunks=(1, 3, output_shape[0], output_shape[1], 3))
+
+    index = {}
+    for i, (save_name, ordered_matching_names) in enumerate(tqdm.tqdm(list_triplets, desc='Arranging data')):
+        array_imgs = _read_triplet(ordered_matching_names)
+        if output_format == 'npy':
+            np.save(output_dir + save_name + '.npy', array_imgs)
+        elif output_format == 'npz':
+            np.savez_compressed(output_dir + save_name + '.npz', array_imgs)
+        else:
+            store[i] = array_imgs
+            index[save_name] = i
+
+    if output_format == 'memmap':
+        store.flush()
+        del store
+    elif output_format == 'hdf5':
+        h5_file.close()
+
+    if output_format in ['memmap', 'hdf5']:
+        index_dir = output_dir + store_name + '_index.json'
+        with open(index_dir, 'w') as f:
+            json.dump(index, f)
+        print(f'{len(index)} triplets saved at: {store_dir}, index saved at: {index_dir}')
+    else:
+        print(f'files saved at:{output_dir}')
 
-        ordered_matching_names = [image_name]
-        if conv_name in list_img_files:
-            ordered_matching_names.append(conv_name)
-            if reconv_name in list_img_files:
-                ordered_matching_names.append(reconv_name)
-                array_imgs = np.zeros((3, output_shape[0], output_shape[1], 3)).astype(int)
-                for j, img_name in enumerate(ordered_matching_names):
-                    img = tf.keras.utils.load_img(directory_dataset + img_name, target_size=output_shape,
-                                                  interpolation='bilinear')
-                    img_array = tf.keras.utils.img_to_array(img).astype(int)
-                    array_imgs[j] = img_array.astype(int)
-
-                    if compress is False:
-                        save_name = ''.join([search_name, '_', transformation_id.replace('.png', '.npy')])
-                        save_dir_name = output_dir + save_name
-                        np.save(save_dir_name, array_imgs)
 
-                    else:
-                        save_name = ''.join([search_name, '_', transformation_id.replace('.png', '.npz')])
-                        save_dir_name = output_dir + save_name
-                        np.savez_compressed(save_dir_name, array_imgs)
+def load_triplet_store(store_dir):
+    """
+    Opens a store written by merge_multi_domain_data with output_format 'memmap' or 'hdf5'. The arrays are
+    not loaded into memory, the memmap is opened read-only and the hdf5 dataset is read on slicing.
+
+    :param store_dir: (str) path to the .npy or .h5 store
+    :return: store array (N, 3, H, W, 3), (dict) index {name: row}
+    """
+    if store_dir.endswith('.h5'):
+        store = h5py.File(store_dir, 'r')['triplets']
+        index_dir = store_dir.replace('.h5', '_index.json')
+    else:
+        store = np.load(store_dir, mmap_mode='r')
+        index_dir = store_dir.replace('.npy', '_index.json')
+
+    with open(index_dir, 'r') as f:
+        index = json.load(f)
+
+    return store, index
 
-    print(f'files saved at:{output_dir}')
+
+def get_triplet_rows(index, names):
+    """
+    Converts a list of names (with or without extension) into rows of the store
+    :param index: (dict) {name: row}
+    :param names: (list)
+    :return: (array) rows
+    """
+    return np.array([index[os.path.splitext(os.path.basename(name))[0]] for name in names], dtype=np.int64)
+
+
+def iterate_triplet_batches(store, rows=None, batch_size=8, shuffle=False):
+    """
+    Iterates over a triplet store in batches. When the rows are contiguous (no shuffle and no subset) each
+    batch is a view of the memory-mapped array, so no copy is made until the data is used.
+
+    :param store: array returned by load_triplet_store
+    :param rows: (array) rows to iterate, all the store by default
+    :param batch_size: (int)
+    :param shuffle: (bool) shuffle the order of the rows
+    :return: generator of (rows, batch)
+    """
+    if rows is None:
+        rows = np.arange(len(store))
+    rows = np.asarray(rows)
+    if shuffle:
+        rows = np.random.permutation(rows)
+
+    for start in range(0, len(rows), batch_size):
+        batch_rows = rows[start:start + batch_size]
+        if np.all(np.diff(batch_rows) == 1):
+            yield batch_rows, store[batch_rows[0]:batch_rows[-1] + 1]
+        else:
+            # h5py needs increasing indexes for fancy indexing
+            order = np.argsort(batch_rows)
+            batch = store[batch_rows[order].tolist()] if isinstance(store, h5py.Dataset) \
+                else store[batch_rows[order]]
+            yield batch_rows[order], batch
 
 
 def generate_annotations_npy_from_csv(directory_npy_data, csv_sample_file, output_name=None):
@@ -0,0 +1,230 @@
+"""
+Multi-process data-parallel training with tf.distribute.MultiWorkerMirroredStrategy.
+
+The training functions (segmentation/call_models.call_model, classification/call_models.call_models and
+classification/call_models_tf.fit_model) call get_strategy(): when the TF_CONFIG environment variable is set the
+process is one worker of a cluster, otherwise the default (single process) strategy is used and nothing changes.
+Each worker reads its own shard of the data and only the chief writes checkpoints, logs and the final model.
+
+Launch N local workers (e.g. 2 on localhost to test it):
+    python scripts/general_functions/distributed_training.py --num_workers=2 -- \
+        python scripts/run_experiment.py --experiment_type=segmentation ...
+
+Multi-node: run on every node the same command with the list of workers and the index of the node:
+    python scripts/general_functions/distributed_training.py --workers=node1:23456,node2:23456 --task_index=0 -- ...
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+
+
+# the strategy can only be created once per process, before any other collective op
+_STRATEGY = None
+
+
+def get_tf_config():
+    return json.loads(os.environ.get('TF_CONFIG', '{}'))
+
+
+def num_workers():
+    return len(get_tf_config().get('cluster', {}).get('worker', [])) or 1
+
+
+def worker_index():
+    return int(get_tf_config().get('task', {}).get('index', 0))
+
+
+def is_chief():
+    """
+    The chief is the task of type 'chief' if there is one in the cluster, otherwise the worker 0
+    """
+    tf_config = get_tf_config()
+    if not tf_config:
+        return True
+    task = tf_config.get('task', {})
+    if 'chief' in tf_config.get('cluster', {}):
+        return task.get('type') == 'chief'
+    return task.get('type', 'worker') == 'worker' and int(task.get('index', 0)) == 0
+
+
+def get_strategy():
+    """
+    MultiWorkerMirroredStrategy if TF_CONFIG is set, the default strategy otherwise. Call it at the beginning of
+    the training, before building the datasets and the model.
+    """
+    global _STRATEGY
+    if _STRATEGY is not None:
+        return _STRATEGY
+
+    if num_workers() > 1:
+        intra_op_threads = int(os.environ.get('DISTRIBUTED_INTRA_OP_THREADS', 0))
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        communication = tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+        _STRATEGY = tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication)
+        print(f'Worker {worker_index()} of {num_workers()}, chief: {is_chief()}')
+    else:
+        _STRATEGY = tf.distribute.get_strategy()
+
+    return _STRATEGY
+
+
+def shard(dataset):
+    """
+    Keeps the elements of this worker, to be called on the dataset of file names before reading the files so
+    each worker only reads its own shard
+    """
+    if num_workers() > 1:
+        dataset = dataset.shard(num_workers(), worker_index())
+    return dataset
+
+
+def finalize_dataset(dataset):
+    """
+    The datasets are already sharded with shard(), the automatic sharding of tf.distribute is disabled
+    """
+    if num_workers() > 1:
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        dataset = dataset.with_options(options)
+    return dataset
+
+
+def steps_per_worker(num_samples, batch_size):
+    """
+    Steps of an epoch of one worker, the same for all the workers (the shards differ at most by one sample)
+    """
+    samples_worker = int(np.ceil(num_samples / num_workers()))
+    return int(np.ceil(samples_worker / batch_size))
+
+
+def shard_sequence(sequence, shuffle=True, seed=0):
+    """
+    Dataset with the batches of a keras Sequence (e.g. flow_from_directory or DataGenerator) that belong to this
+    worker. The order of the batches is shuffled in every epoch with the same seed in all the workers, so the
+    workers always read disjoint batches. The sequence itself must not be shuffled.
+
+    :return: repeated tf.data.Dataset, steps per epoch
+    """
+    steps = max(len(sequence) // num_workers(), 1)
+    x_sample, y_sample = sequence[0]
+
+    def _batches():
+        epoch = 0
+        while True:
+            order = np.random.RandomState(seed + epoch).permutation(len(sequence)) if shuffle \
+                else np.arange(len(sequence))
+            for i in order[worker_index()::num_workers()][:steps]:
+                yield sequence[int(i)]
+            epoch += 1
+
+    dataset = tf.data.Dataset.from_generator(
+        _batches, output_signature=(tf.TensorSpec((None,) + np.shape(x_sample)[1:], tf.as_dtype(x_sample.dtype)),
+                                    tf.TensorSpec((None,) + np.shape(y_sample)[1:], tf.as_dtype(y_sample.dtype))))
+
+    return finalize_dataset(dataset.prefetch(tf.data.AUTOTUNE)), steps
+
+
+def worker_directory(directory):
+    """
+    Directory where a worker writes its results: the directory itself for the chief, a temporary one for the
+    other workers (they must also save the model and the checkpoints, but their copies are discarded)
+    """
+    if is_chief():
+        return directory
+    return tempfile.mkdtemp(prefix=''.join(['worker_', str(worker_index()), '_'])) + '/'
+
+
+def remove_worker_directory(directory):
+    if not is_chief():
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def load_saved_model(model_path, custom_objects=None):
+    """
+    Loads a model saved by a multi-worker training outside of the strategy, to evaluate it on the chief. The model
+    built in strategy.scope() can only be evaluated inside strategy.run: its metrics are aggregated across the
+    workers and predict_on_batch gathers the predictions of all of them.
+
+    :param model_path: (str) path given to model.save
+    :param custom_objects: (dict)
+    :return: keras Model, not compiled
+    """
+    return tf.keras.models.load_model(model_path, custom_objects=custom_objects, compile=False)
+
+
+def make_tf_config(workers, task_index):
+    """
+    :param workers: (list) host:port of each worker
+    :param task_index: (int) index of this worker
+    :return: (str) TF_CONFIG
+    """
+    return json.dumps({'cluster': {'worker': list(workers)}, 'task': {'type': 'worker', 'index': int(task_index)}})
+
+
+def launch_workers(command, workers, task_indexes, intra_op_threads=None):
+    """
+    Runs the command once per task index with its TF_CONFIG and waits for all of them
+
+    :param command: (list) command line of a worker
+    :param workers: (list) host:port of all the workers of the cluster
+    :param task_indexes: (list) the workers to run in this node
+    :param intra_op_threads: (int) threads of each worker
+    :return: (list) return codes
+    """
+    processes = list()
+    for task_index in task_indexes:
+        env = dict(os.environ, TF_CONFIG=make_tf_config(workers, task_index))
+        if intra_op_threads:
+            env['DISTRIBUTED_INTRA_OP_THREADS'] = str(intra_op_threads)
+            env['OMP_NUM_THREADS'] = str(intra_op_threads)
+        processes.append(subprocess.Popen(command, env=env))
+
+    try:
+        return_codes = [process.wait() for process in processes]
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+
+    return return_codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Launches the workers of a MultiWorkerMirroredStrategy training')
+    parser.add_argument('--num_workers', type=int, default=2, help='number of local workers')
+    parser.add_argument('--port', type=int, default=23456, help='first port of the local workers')
+    parser.add_argument('--workers', type=str, default='',
+                        help='host:port of all the workers of a multi-node cluster, separated by commas')
+    parser.add_argument('--task_index', type=int, default=0, help='index of this node in --workers')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='command of the training, after --')
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command and args.command[0] == '--' else args.command
+    if not command:
+        parser.error('no training command given')
+
+    if args.workers:
+        workers = args.workers.split(',')
+        task_indexes = [args.task_index]
+        intra_op_threads = None
+    else:
+        workers = ['localhost:' + str(args.port + i) for i in range(args.num_workers)]
+        task_indexes = list(range(args.num_workers))
+        # the cores of the node are split between the local workers
+        intra_op_threads = max(multiprocessing.cpu_count() // args.num_workers, 1)
+
+    return_codes = launch_workers(command, workers, task_indexes, intra_op_threads=intra_op_threads)
+    sys.exit(max(return_codes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+import tqdm
+
+
+def split_at_pooling(model):
+    """
+    Splits a functional model with frozen backbones at the outputs of its GlobalAveragePooling2D layers (the
+    pooled features of the backbones). The two models share the layers of model, so training the head trains the
+    dense layers of model.
+
+    :param model: (keras Model)
+    :return: extractor (inputs of model -> pooled features), head (pooled features -> outputs of model),
+    None if the model has no pooling layer or if the part before the pooling is trainable (fine-tuning)
+    """
+    pooling_layers = [layer for layer in model.layers
+                      if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)]
+    if not pooling_layers:
+        return None
+
+    features = [layer.output for layer in pooling_layers]
+    extractor = tf.keras.Model(inputs=model.inputs, outputs=features, name=model.name + '_extractor')
+    if extractor.trainable_weights:
+        return None
+
+    head_inputs = features if len(features) > 1 else features[0]
+    head = tf.keras.Model(inputs=head_inputs, outputs=model.outputs, name=model.name + '_head')
+    return extractor, head
+
+
+def split_backbone_and_cap(model):
+    """
+    Same as split_at_pooling for the Sequential models [backbone, cap] of classification/call_models, when the
+    cap starts with a GlobalAveragePooling2D layer
+
+    :param model: (keras Sequential)
+    :return: extractor, head or None
+    """
+    base_model, cap_model = model.layers[0], model.layers[-1]
+    cap_layers = getattr(cap_model, 'layers', [])
+    if not cap_layers or not isinstance(cap_layers[0], tf.keras.layers.GlobalAveragePooling2D):
+        return None
+
+    extractor = tf.keras.Sequential([base_model, tf.keras.layers.GlobalAveragePooling2D()],
+                                    name=model.name + '_extractor')
+    if extractor.trainable_weights:
+        return None
+
+    head = tf.keras.Sequential([tf.keras.Input(shape=(base_model.output_shape[-1],))] + cap_layers[1:],
+                               name=model.name + '_head')
+    return extractor, head
+
+
+def store_key(*parts):
+    """
+    Name of a feature store from the elements that define it (backbones, list of files, input size...)
+    """
+    return hashlib.sha1(json.dumps([str(part) for part in parts]).encode()).hexdigest()
+
+
+def _store_paths(store_dir, key, num_features):
+    features_paths = [os.path.join(store_dir, ''.join([key, '_features_', str(i), '.npy']))
+                      for i in range(num_features)]
+    return features_paths, os.path.join(store_dir, key + '_labels.npy'), os.path.join(store_dir, key + '.json')
+
+
+def load_feature_store(store_dir, key):
+    """
+    Opens a complete feature store as read-only memory-mapped arrays
+    :return: list of feature arrays, labels array; None if the store does not exist or is not complete
+    """
+    info_path = os.path.join(store_dir, key + '.json')
+    if not os.path.isfile(info_path):
+        return None
+    with open(info_path, 'r') as f:
+        info = json.load(f)
+    features_paths, labels_path, _ = _store_paths(store_dir, key, info['num_features'])
+    return [np.load(path, mmap_mode='r') for path in features_paths], np.load(labels_path, mmap_mode='r')
+
+
+def build_feature_store(extractor, batches, num_batches, num_samples, store_dir, key):
+    """
+    Runs the frozen extractor once over a dataset and writes its outputs in memory-mapped .npy files. The store
+    is only marked as complete (key.json) once all the samples are written, an existing complete store with the
+    same key is reused.
+
+    :param extractor: (keras Model) returned by split_at_pooling or split_backbone_and_cap
+    :param batches: iterable of (x, y) batches in a fixed order (not shuffled, not augmented)
+    :param num_batches: (int) number of batches to read from batches
+    :param num_samples: (int) number of samples, the extra samples of the last batch are dropped
+    :param store_dir: (str)
+    :param key: (str) name of the store, see store_key
+    :return: list of feature arrays, labels array
+    """
+    store = load_feature_store(store_dir, key)
+    if store is not None:
+        print(f'Features found at {store_dir}, key: {key}')
+        return store
+
+    os.makedirs(store_dir, exist_ok=True)
+    features, labels = None, None
+    start = 0
+    for i, (x, y) in enumerate(tqdm.tqdm(batches, total=num_batches, desc='Computing features')):
+        if i == num_batches or start == num_samples:
+            break
+        outputs = extractor.predict_on_batch(x)
+        outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+        outputs = [np.asarray(output) for output in outputs]
+        y = np.asarray(y)
+        if features is None:
+            features_paths, labels_path, info_path = _store_paths(store_dir, key, len(outputs))
+            features = [np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                                  shape=(num_samples,) + output.shape[1:])
+                        for path, output in zip(features_paths, outputs)]
+            labels = np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.float32,
+                                               shape=(num_samples,) + y.shape[1:])
+        end = min(start + len(y), num_samples)
+        for store_array, output in zip(features, outputs):
+            store_array[start:end] = output[:end - start]
+        labels[start:end] = y[:end - start]
+        start = end
+
+    if start != num_samples:
+        raise ValueError(f'{start} samples read, {num_samples} expected')
+
+    for store_array in features + [labels]:
+        store_array.flush()
+    with open(info_path, 'w') as f:
+        json.dump({'num_features': len(features), 'num_samples': num_samples}, f)
+    print(f'Features saved at {store_dir}, key: {key}')
+
+    return load_feature_store(store_dir, key)
+
+
+def feature_dataset(features, labels, batch_size, shuffle=False):
+    """
+    tf.data.Dataset of (features, labels) batches read from the memory-mapped store, only the rows of each batch
+    are read from disk
+    :param features: list of feature arrays
+    :param labels: labels array
+    :param batch_size: (int)
+    :param shuffle: (bool) shuffle the samples in every epoch
+    :return: repeated tf.data.Dataset
+    """
+    num_features = len(features)
+
+    def _gather(rows):
+        rows = np.sort(rows)
+        return tuple(np.asarray(store_array[rows], dtype=np.float32) for store_array in features + [labels])
+
+    def _read(rows):
+        arrays = tf.numpy_function(_gather, [rows], [tf.float32] * (num_features + 1))
+        for array, store_array in zip(arrays, features + [labels]):
+            array.set_shape((None,) + store_array.shape[1:])
+        x = tuple(arrays[:-1]) if num_features > 1 else arrays[0]
+        return x, arrays[-1]
+
+    dataset = tf.data.Dataset.range(len(labels))
+    if shuffle:
+        dataset = dataset.shuffle(len(labels), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(_read, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return dataset.repeat().prefetch(tf.data.AUTOTUNE)
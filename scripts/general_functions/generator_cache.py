@@ -0,0 +1,188 @@
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+import tensorflow as tf
+import tqdm
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    sha1 of the content of a file
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def checkpoint_hash(checkpoint_dir):
+    """
+    Hash of the latest checkpoint saved in checkpoint_dir (content of its .index and .data files), it changes
+    whenever the generators are retrained
+    :param checkpoint_dir: (str) directory of the tf.train.CheckpointManager
+    :return: (str)
+    """
+    latest_checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+    if latest_checkpoint is None:
+        raise ValueError(f'No checkpoint found in {checkpoint_dir}')
+
+    checkpoint_prefix = os.path.basename(latest_checkpoint)
+    checkpoint_files = sorted([f for f in os.listdir(os.path.dirname(latest_checkpoint))
+                               if f.startswith(checkpoint_prefix + '.')])
+    sha = hashlib.sha1()
+    for f in checkpoint_files:
+        sha.update(f.encode())
+        sha.update(file_hash(os.path.join(os.path.dirname(latest_checkpoint), f)).encode())
+    return sha.hexdigest()
+
+
+def to_uint8(images):
+    """Transform images from [-1.0, 1.0] to uint8."""
+    return np.round((np.clip(images, -1.0, 1.0) + 1.0) * 127.5).astype(np.uint8)
+
+
+def from_uint8(images):
+    """Transform uint8 images to [-1.0, 1.0] float32."""
+    return images.astype(np.float32) / 127.5 - 1.0
+
+
+class GeneratorOutputCache:
+    """
+    Disk cache of the outputs of a frozen CycleGAN. Each entry holds the converted and reconverted images (uint8,
+    shape (2, H, W, 3)) of one input image for one target domain. The key is the hash of the content of the
+    image, the target domain and the hash of the generators checkpoint, so renamed or moved images are still
+    found and entries of older generators are never used.
+
+    The total size of the cache is bounded, when max_size_gb is exceeded the least recently used entries are
+    removed. The entries computed by fill are needed for the whole training, if the cache is too small to keep
+    them fill raises a ValueError instead of evicting them. The cache can be read from the parallel calls of a
+    tf.data map.
+    """
+
+    def __init__(self, cache_dir, checkpoint_dir, max_size_gb=20.0):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.generator_hash = checkpoint_hash(checkpoint_dir)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._image_hashes = {}
+        # entries of the datasets given to fill, they are never evicted
+        self._required = set()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # entries ordered from the least to the most recently used
+        entries = [f for f in os.listdir(cache_dir) if f.endswith('.npy')]
+        stats = {f: os.stat(os.path.join(cache_dir, f)) for f in entries}
+        self._entries = collections.OrderedDict(
+            (f, stats[f].st_size) for f in sorted(entries, key=lambda f: stats[f].st_mtime))
+        self._size = sum(self._entries.values())
+
+    def _image_hash(self, image_path):
+        # the content hash is computed once per version of the file
+        stat = os.stat(image_path)
+        identifier = (image_path, stat.st_mtime_ns, stat.st_size)
+        if identifier not in self._image_hashes:
+            self._image_hashes[identifier] = file_hash(image_path)
+        return self._image_hashes[identifier]
+
+    def key(self, image_path, target_domain):
+        sha = hashlib.sha1()
+        sha.update(self._image_hash(image_path).encode())
+        sha.update(str(int(target_domain)).encode())
+        sha.update(self.generator_hash.encode())
+        return sha.hexdigest() + '.npy'
+
+    def get(self, image_path, target_domain):
+        """
+        :param image_path: (str)
+        :param target_domain: (int) != 0 if the target domain is NBI
+        :return: (array uint8) converted and reconverted images, shape (2, H, W, 3), None if not in the cache
+        """
+        name = self.key(image_path, target_domain)
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+        path = os.path.join(self.cache_dir, name)
+        try:
+            outputs = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            # removed by another process or partially written
+            with self._lock:
+                self._size -= self._entries.pop(name, 0)
+            return None
+        return outputs
+
+    def put(self, image_path, target_domain, outputs):
+        """
+        :param image_path: (str)
+        :param target_domain: (int)
+        :param outputs: (array uint8) converted and reconverted images, shape (2, H, W, 3)
+        """
+        name = self.key(image_path, target_domain)
+        path = os.path.join(self.cache_dir, name)
+        temp_path = ''.join([path[:-len('.npy')], '_', str(os.getpid()), '_', str(threading.get_ident()), '.tmp'])
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.asarray(outputs, dtype=np.uint8))
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._size -= self._entries.pop(name, 0)
+            self._entries[name] = os.path.getsize(path)
+            self._size += self._entries[name]
+            self._evict()
+
+    def _evict(self):
+        # least recently used entries first, down to 90 % of the maximum size to not evict on every put
+        if self._size <= self.max_size:
+            return
+        while self._entries and self._size > 0.9 * self.max_size:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            if name in self._required:
+                raise ValueError(f'The generator cache of {self.max_size / 1024 ** 3:.1f} GB can not hold the '
+                                 f'{len(self._required)} outputs of the dataset, increase max_size_gb')
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def fill(self, image_paths, target_domains, read_function, compute_function, batch_size=8):
+        """
+        Computes the entries missing in the cache in batches, before the training starts. The entries of all
+        the datasets filled are kept until the end of the training.
+        :param image_paths: (list)
+        :param target_domains: (list) target domain of each image
+        :param read_function: function path -> image, as the generators expect it
+        :param compute_function: function (images, target_domains) -> converted, reconverted in [-1, 1]
+        :param batch_size: (int)
+        :return: number of entries computed
+        """
+        keys = [self.key(path, domain) for path, domain in zip(image_paths, target_domains)]
+        with self._lock:
+            self._required.update(keys)
+            # the entries already in the cache become the most recently used, so the stale ones are evicted first
+            for name in keys:
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+        missing = [(path, domain) for path, domain, name in zip(image_paths, target_domains, keys)
+                   if name not in self._entries]
+        for i in tqdm.tqdm(range(0, len(missing), batch_size), desc='Caching generator outputs'):
+            batch = missing[i:i + batch_size]
+            images = np.stack([read_function(path) for path, _ in batch])
+            domains = np.array([[int(domain)] for _, domain in batch], dtype=np.int32)
+            converted, reconverted = compute_function(images, domains)
+            for j, (path, domain) in enumerate(batch):
+                self.put(path, domain, np.stack([to_uint8(np.asarray(converted[j])),
+                                                 to_uint8(np.asarray(reconverted[j]))]))
+        return len(missing)
+
+    def size_gb(self):
+        return self._size / 1024 ** 3
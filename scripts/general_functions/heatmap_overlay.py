@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+
+
+# jet colormap as a 256 entries uint8 look up table, computed once
+JET_LUT_BGR = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_JET).reshape(256, 3)
+JET_LUT_RGB = np.ascontiguousarray(JET_LUT_BGR[:, ::-1])
+
+
+def resize_heatmaps(heatmaps, size, interpolation=cv2.INTER_LINEAR):
+    """
+    Resizes a batch of heatmaps. cv2 resizes up to 512 channels in one call, so the batch is moved to the
+    channel axis instead of resizing the heatmaps one by one.
+    :param heatmaps: (array) shape (N, h, w)
+    :param size: (tuple) (width, height)
+    :param interpolation: cv2 interpolation flag
+    :return: (array float32) shape (N, height, width)
+    """
+    heatmaps = np.asarray(heatmaps, dtype=np.float32)
+    resized = list()
+    for j in range(0, len(heatmaps), 512):
+        chunk = np.ascontiguousarray(np.transpose(heatmaps[j:j + 512], (1, 2, 0)))
+        chunk = cv2.resize(chunk, tuple(size), interpolation=interpolation)
+        resized.append(chunk.reshape(size[1], size[0], -1))
+    return np.transpose(np.concatenate(resized, axis=-1), (2, 0, 1))
+
+
+def colorize_heatmaps(heatmaps, rgb=True):
+    """
+    Colorizes heatmaps in [0, 1] with the jet colormap
+    :param heatmaps: (array) shape (N, h, w) or (h, w)
+    :param rgb: (bool) RGB output, otherwise BGR
+    :return: (array uint8) shape (..., 3)
+    """
+    heatmaps = np.nan_to_num(np.asarray(heatmaps, dtype=np.float32))
+    index = (np.clip(heatmaps, 0, 1) * 255).astype(np.uint8)
+    return (JET_LUT_RGB if rgb is True else JET_LUT_BGR)[index]
+
+
+def overlay_heatmaps(images, heatmaps, alpha=0.4, rgb=True):
+    """
+    Superimposes the colorized heatmaps on the images: images + alpha * jet(heatmaps), rescaled to [0, 255] per
+    image
+    :param images: (array) shape (N, H, W, 3), values in [0, 255]
+    :param heatmaps: (array) shape (N, h, w) in [0, 1], resized to (H, W) if needed
+    :param alpha: (float) weight of the heatmap
+    :param rgb: (bool) channel order of the images
+    :return: (array uint8) shape (N, H, W, 3)
+    """
+    images = np.asarray(images, dtype=np.float32)
+    heatmaps = np.asarray(heatmaps)
+    if heatmaps.shape[1:3] != images.shape[1:3]:
+        heatmaps = resize_heatmaps(heatmaps, (images.shape[2], images.shape[1]))
+    superimposed = colorize_heatmaps(heatmaps, rgb=rgb).astype(np.float32) * alpha + images
+    minimum = superimposed.min(axis=(1, 2, 3), keepdims=True)
+    maximum = superimposed.max(axis=(1, 2, 3), keepdims=True)
+    superimposed = (superimposed - minimum) / np.maximum(maximum - minimum, 1e-7) * 255
+    return superimposed.astype(np.uint8)
+
+
+def threshold_heatmaps(heatmaps, ratio=0.7):
+    """
+    Binary masks of the regions of each heatmap above ratio * its maximum, heatmaps with NaNs or without positive
+    values give empty masks
+    :param heatmaps: (array) shape (N, h, w)
+    :param ratio: (float)
+    :return: (array float32) masks with values {0, 1}, (array uint8) the same masks as 3 channel images {0, 255}
+    """
+    heatmaps = np.asarray(heatmaps, dtype=np.float32)
+    valid = ~np.isnan(heatmaps).any(axis=(1, 2), keepdims=True)
+    limit = ratio * np.nanmax(np.where(valid, heatmaps, 0), axis=(1, 2), keepdims=True)
+    masks = ((heatmaps >= limit) & valid & (limit > 0)).astype(np.float32)
+    binary_masks = np.repeat((masks * 255).astype(np.uint8)[..., np.newaxis], 3, axis=-1)
+    return masks, binary_masks
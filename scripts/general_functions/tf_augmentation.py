@@ -0,0 +1,165 @@
+import tensorflow as tf
+
+
+AUTOTUNE = tf.data.AUTOTUNE
+# same gamma values used by data_management.augment_image
+GAMMAS = [0.6, 0.7, 0.8, 0.9, 1.1, 1.2, 1.3, 1.4, 1.5]
+
+
+def _select(condition, x_true, x_false):
+    """
+    Per sample tf.where, condition has shape (batch,)
+    """
+    condition = tf.reshape(condition, [-1] + [1] * (len(x_true.shape) - 1))
+    return tf.where(condition, x_true, x_false)
+
+
+def _coin(seed, n, probability):
+    return tf.random.stateless_uniform([n], seed=seed) < probability
+
+
+def _dihedral(x, transpose, flip_lr, flip_ud):
+    """
+    Random 90 degree rotations and flips. Transpose + flips cover the 4 rotations and their mirrors,
+    the transpose is only done for square images.
+    :param x: (tensor) batch of shape (n, h, w, c)
+    :param transpose: (tensor bool) shape (n,)
+    :param flip_lr: (tensor bool) shape (n,)
+    :param flip_ud: (tensor bool) shape (n,)
+    :return: (tensor) same shape as x
+    """
+    if x.shape[1] is not None and x.shape[1] == x.shape[2]:
+        x = _select(transpose, tf.transpose(x, [0, 2, 1, 3]), x)
+    x = _select(flip_lr, tf.reverse(x, axis=[2]), x)
+    x = _select(flip_ud, tf.reverse(x, axis=[1]), x)
+    return x
+
+
+def _zoom(x, scales, method='bilinear'):
+    """
+    Central zoom in (scale > 1) or zoom out with zero padding (scale < 1), same behaviour as
+    data_management.clipped_zoom but done for the whole batch with a single crop_and_resize
+    :param x: (tensor) batch of shape (n, h, w, c)
+    :param scales: (tensor) shape (n,)
+    :param method: 'bilinear' for images, 'nearest' for masks
+    :return: (tensor float32)
+    """
+    half = 0.5 / scales
+    boxes = tf.stack([0.5 - half, 0.5 - half, 0.5 + half, 0.5 + half], axis=1)
+    box_indices = tf.range(tf.shape(x)[0])
+    return tf.image.crop_and_resize(x, boxes, box_indices, tf.shape(x)[1:3], method=method,
+                                    extrapolation_value=0)
+
+
+def augment_batch(images, masks=None, seed=(0, 0), probability=0.5, zoom_range=(0.8, 1.2),
+                  contrast_range=(0.5, 0.9), saturation_range=(1.0, 3.0), bgr=False):
+    """
+    In-graph version of the operations of data_management.augment_image (90 degree rotations, flips, gamma,
+    zoom in/out, contrast and saturation) applied to a whole batch. Every sample draws its own transformations,
+    the geometric ones are applied in the same way to its mask.
+
+    :param images: (tensor) batch of shape (n, h, w, 3), or (n, frames, h, w, 3) for stacks of frames, in that
+    case all the frames of a sample get the same transformations. uint8 images are expected in [0, 255],
+    float images in [0, 1]. The output has the same dtype as the input.
+    :param masks: (tensor) optional batch of masks of shape (n, h, w, 1)
+    :param seed: (tensor) shape [2], seed of the stateless random ops
+    :param probability: (float) probability of applying each one of the operations
+    :param zoom_range: (tuple) min and max zoom factor
+    :param contrast_range: (tuple) min and max contrast factor
+    :param saturation_range: (tuple) min and max saturation factor
+    :param bgr: (bool) the channels of the images are in BGR order (cv2), used to compute the gray level
+    :return: augmented images, or (images, masks) if masks are given
+    """
+    seeds = tf.random.experimental.stateless_split(tf.cast(seed, tf.int64), num=11)
+    input_dtype = images.dtype
+    n = tf.shape(images)[0]
+
+    x = tf.cast(images, tf.float32)
+    if input_dtype == tf.uint8:
+        x = x / 255.0
+
+    # stacks of frames are flattened and the parameters of each sample repeated for its frames
+    is_stack = len(images.shape) == 5
+    if is_stack:
+        frames = tf.shape(images)[1]
+        stack_shape = tf.shape(x)
+        x = tf.reshape(x, tf.concat([[-1], stack_shape[2:]], axis=0))
+
+    def _per_frame(params):
+        return tf.repeat(params, frames, axis=0) if is_stack else params
+
+    # geometric transformations
+    transpose = _coin(seeds[0], n, probability)
+    flip_lr = _coin(seeds[1], n, probability)
+    flip_ud = _coin(seeds[2], n, probability)
+    scales = tf.random.stateless_uniform([n], seed=seeds[3], minval=zoom_range[0], maxval=zoom_range[1])
+    scales = tf.where(_coin(seeds[4], n, probability), scales, tf.ones_like(scales))
+
+    x = _dihedral(x, _per_frame(transpose), _per_frame(flip_lr), _per_frame(flip_ud))
+    x = _zoom(x, _per_frame(scales), method='bilinear')
+
+    # photometric transformations
+    gammas = tf.gather(tf.constant(GAMMAS, tf.float32),
+                       tf.random.stateless_uniform([n], seed=seeds[5], maxval=len(GAMMAS), dtype=tf.int32))
+    gammas = tf.where(_coin(seeds[6], n, probability), gammas, tf.ones_like(gammas))
+    x = tf.pow(tf.clip_by_value(x, 0.0, 1.0), tf.reshape(1.0 / _per_frame(gammas), [-1, 1, 1, 1]))
+
+    contrast = tf.random.stateless_uniform([n], seed=seeds[7], minval=contrast_range[0],
+                                           maxval=contrast_range[1])
+    contrast = tf.where(_coin(seeds[8], n, probability), contrast, tf.ones_like(contrast))
+    mean = tf.reduce_mean(x, axis=[1, 2], keepdims=True)
+    x = (x - mean) * tf.reshape(_per_frame(contrast), [-1, 1, 1, 1]) + mean
+
+    saturation = tf.random.stateless_uniform([n], seed=seeds[9], minval=saturation_range[0],
+                                             maxval=saturation_range[1])
+    saturation = tf.where(_coin(seeds[10], n, probability), saturation,
+                          tf.ones_like(saturation))
+    luma = [0.114, 0.587, 0.299] if bgr is True else [0.299, 0.587, 0.114]
+    gray = tf.reduce_sum(x * tf.constant(luma, tf.float32), axis=-1, keepdims=True)
+    x = (x - gray) * tf.reshape(_per_frame(saturation), [-1, 1, 1, 1]) + gray
+
+    x = tf.clip_by_value(x, 0.0, 1.0)
+    if is_stack:
+        x = tf.reshape(x, stack_shape)
+    if input_dtype == tf.uint8:
+        x = tf.cast(tf.round(x * 255.0), tf.uint8)
+    else:
+        x = tf.cast(x, input_dtype)
+    x.set_shape(images.shape)
+
+    if masks is None:
+        return x
+
+    y = _dihedral(masks, transpose, flip_lr, flip_ud)
+    y = tf.cast(_zoom(y, scales, method='nearest'), masks.dtype)
+    y.set_shape(masks.shape)
+
+    return x, y
+
+
+def augment_tf_dataset(dataset, seed=0, paired_masks=True, steps_per_epoch=None, **kwargs):
+    """
+    Adds the augmentation stage to a batched (and repeated) dataset of (x, y) elements. The seed of each
+    batch is built from the seed given and the position of the batch, so the transformations change from one
+    epoch to the next but a training run can be reproduced.
+
+    :param dataset: (tf.data.Dataset) batched dataset
+    :param seed: (int) base seed
+    :param paired_masks: (bool) y is a mask and the geometric transformations must also be applied to it,
+    otherwise y (e.g. a class label) is passed through unchanged
+    :param steps_per_epoch: (int) if given the seed of each batch is (seed + epoch, step in the epoch)
+    :param kwargs: arguments passed to augment_batch
+    :return: (tf.data.Dataset)
+    """
+    def _augment(step, element):
+        x, y = element
+        if steps_per_epoch:
+            batch_seed = tf.stack([seed + step // steps_per_epoch, step % steps_per_epoch])
+        else:
+            batch_seed = tf.stack([tf.constant(seed, tf.int64), step])
+
+        if paired_masks is True:
+            return augment_batch(x, y, seed=batch_seed, **kwargs)
+        return augment_batch(x, seed=batch_seed, **kwargs), y
+
+    return dataset.enumerate().map(_augment, num_parallel_calls=AUTOTUNE)
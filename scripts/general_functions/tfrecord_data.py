@@ -0,0 +1,357 @@
+import os
+import json
+import heapq
+import argparse
+import numpy as np
+import pandas as pd
+import tqdm
+import tensorflow as tf
+
+
+AUTOTUNE = tf.data.AUTOTUNE
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+ARRAY_EXTENSIONS = ('.npy', '.npz')
+DEFAULT_LABEL_COLUMNS = ['tissue type', 'imaging type']
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+
+
+def _feature_name(column):
+    return column.replace(' ', '_')
+
+
+def _read_array_bytes(path_file):
+    """
+    Reads a .npy/.npz stack and returns its raw uint8 bytes and shape
+    :param path_file: (str) path to the file
+    :return: (bytes, tuple)
+    """
+    if path_file.endswith('.npz'):
+        array = np.load(path_file)['arr_0']
+    else:
+        array = np.load(path_file)
+    array = array.astype(np.uint8)
+    return array.tobytes(), array.shape
+
+
+def _find_annotations(split_dir, csv_annotations=None):
+    """
+    Returns a dictionary {image_name: row} with the annotations of a split, the csv file given in csv_annotations
+    is used if indicated, otherwise the first .csv found in the split directory
+    """
+    if csv_annotations is None:
+        csv_files = [f for f in os.listdir(split_dir) if f.endswith('.csv')]
+        if not csv_files:
+            return {}
+        csv_annotations = os.path.join(split_dir, csv_files.pop())
+
+    data_frame = pd.read_csv(csv_annotations).drop_duplicates(subset='image_name')
+    return data_frame.set_index('image_name').to_dict('index')
+
+
+def list_split_samples(split_dir):
+    """
+    Lists the samples of a split directory. Three structures are recognized:
+    - segmentation: split/images/ and split/masks/ with matching names
+    - classification: split/<class_name>/<file>, where file can be an image or a .npy/.npz stack
+    - flat: split/<file>, labels are taken from the annotations file only
+
+    :param split_dir: (str) path to the split (e.g. dataset/train/)
+    :return: (str) type of data, (list) samples as dictionaries, (list) class names
+    """
+    sub_dirs = sorted([f for f in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, f))])
+    samples = list()
+
+    if 'images' in sub_dirs and 'masks' in sub_dirs:
+        dir_images = os.path.join(split_dir, 'images')
+        dir_masks = os.path.join(split_dir, 'masks')
+        masks = {os.path.splitext(f)[0]: f for f in os.listdir(dir_masks)}
+        for image_name in sorted(os.listdir(dir_images)):
+            mask_name = masks.get(os.path.splitext(image_name)[0])
+            if mask_name is None:
+                print(f'the pair of {image_name} does not exists')
+                continue
+            samples.append({'image_name': image_name, 'path_file': os.path.join(dir_images, image_name),
+                            'path_mask': os.path.join(dir_masks, mask_name), 'label': -1})
+        return 'segmentation', samples, []
+
+    if sub_dirs:
+        class_names = sub_dirs
+        for j, class_name in enumerate(class_names):
+            class_dir = os.path.join(split_dir, class_name)
+            for file_name in sorted(os.listdir(class_dir)):
+                samples.append({'image_name': file_name, 'path_file': os.path.join(class_dir, file_name),
+                                'label': j})
+    else:
+        class_names = []
+        for file_name in sorted(os.listdir(split_dir)):
+            if not file_name.endswith('.csv'):
+                samples.append({'image_name': file_name, 'path_file': os.path.join(split_dir, file_name),
+                                'label': -1})
+
+    samples = [s for s in samples if s['path_file'].endswith(IMAGE_EXTENSIONS + ARRAY_EXTENSIONS)]
+    if samples and all(s['path_file'].endswith(ARRAY_EXTENSIONS) for s in samples):
+        data_type = 'npy'
+    else:
+        samples = [s for s in samples if s['path_file'].endswith(IMAGE_EXTENSIONS)]
+        data_type = 'classification'
+
+    return data_type, samples, class_names
+
+
+def balance_shards(sizes, num_shards):
+    """
+    Assigns items to shards so that the total size of each shard is as even as possible
+    (largest item first into the currently smallest shard)
+
+    :param sizes: (list) size of each item
+    :param num_shards: (int) number of shards
+    :return: (list of lists) indexes of the items of each shard, in their original order
+    """
+    heap = [(0, shard) for shard in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(index)
+        heapq.heappush(heap, (total + sizes[index], shard))
+
+    return [sorted(shard) for shard in shards]
+
+
+def serialize_sample(sample, data_type, annotations, label_columns):
+    """
+    Builds a tf.train.Example from a sample, images and masks are stored encoded as they are on disk,
+    .npy/.npz stacks are stored as raw uint8 bytes together with their shape
+    :return: (bytes) serialized example, (tuple) shape of the stack, () for images
+    """
+    if data_type == 'npy':
+        image_bytes, shape = _read_array_bytes(sample['path_file'])
+    else:
+        with open(sample['path_file'], 'rb') as f:
+            image_bytes = f.read()
+        shape = ()
+
+    feature = {'image_name': _bytes_feature(sample['image_name'].encode()),
+               'image': _bytes_feature(image_bytes),
+               'shape': _int64_feature(shape),
+               'label': _int64_feature([sample['label']])}
+
+    if data_type == 'segmentation':
+        with open(sample['path_mask'], 'rb') as f:
+            feature['mask'] = _bytes_feature(f.read())
+
+    row = annotations.get(sample['image_name'])
+    for column in label_columns:
+        value = row.get(column) if row is not None else None
+        value = '' if value is None or pd.isnull(value) else str(value)
+        feature[_feature_name(column)] = _bytes_feature(value.encode())
+
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString(), tuple(shape)
+
+
+def write_tfrecord_dataset(directory_dataset, output_dir, splits=('train', 'val', 'test'), shard_size_mb=100,
+                           csv_annotations=None, label_columns=DEFAULT_LABEL_COLUMNS):
+    """
+    Packs a dataset with a train/val/test structure into size-balanced TFRecord shards and writes an
+    index.json file describing them. Test splits containing sub-folders with different test sets
+    (e.g. test/case_1/images, test/case_1/masks) are stored as 'test/case_1'.
+
+    :param directory_dataset: (str) path to the dataset
+    :param output_dir: (str) directory where to save the shards and the index
+    :param splits: (tuple) names of the splits to pack
+    :param shard_size_mb: (int) approximate size of each shard in MB
+    :param csv_annotations: (str) annotations file, if None the .csv found inside each split is used
+    :param label_columns: (list) columns of the annotations to store with each sample
+    :return: (str) path to the index file
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    split_dirs = list()
+    for split in splits:
+        split_dir = os.path.join(directory_dataset, split)
+        if not os.path.isdir(split_dir):
+            continue
+        sub_dirs = sorted([f for f in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, f))])
+        nested = [f for f in sub_dirs if os.path.isdir(os.path.join(split_dir, f, 'images'))]
+        if split == 'test' and nested:
+            split_dirs += [('/'.join([split, f]), os.path.join(split_dir, f)) for f in nested]
+        else:
+            split_dirs.append((split, split_dir))
+
+    index = {'label_columns': [_feature_name(c) for c in label_columns], 'splits': {}}
+    for split_name, split_dir in split_dirs:
+        data_type, samples, class_names = list_split_samples(split_dir)
+        if not samples:
+            print(f'No samples found in {split_dir}')
+            continue
+
+        annotations = _find_annotations(split_dir, csv_annotations)
+        sizes = [os.path.getsize(s['path_file']) + (os.path.getsize(s['path_mask']) if 'path_mask' in s else 0)
+                 for s in samples]
+        num_shards = max(1, int(np.ceil(sum(sizes) / (shard_size_mb * 1024 ** 2))))
+        shards = balance_shards(sizes, num_shards)
+
+        shards_info = list()
+        sample_shapes = set()
+        file_prefix = split_name.replace('/', '_')
+        for k, shard in enumerate(tqdm.tqdm(shards, desc=f'Writing {split_name} shards')):
+            shard_name = f'{file_prefix}-{str(k).zfill(5)}-of-{str(num_shards).zfill(5)}.tfrecord'
+            with tf.io.TFRecordWriter(os.path.join(output_dir, shard_name)) as writer:
+                for index_sample in shard:
+                    serialized, shape = serialize_sample(samples[index_sample], data_type, annotations,
+                                                         label_columns)
+                    writer.write(serialized)
+                    sample_shapes.add(shape)
+            shards_info.append({'file': shard_name, 'num_records': len(shard),
+                                'bytes': int(sum(sizes[i] for i in shard))})
+
+        # shape of the .npy stacks when all of them have the same one, so the reader knows the static shape
+        sample_shape = list(sample_shapes.pop()) if data_type == 'npy' and len(sample_shapes) == 1 else None
+        index['splits'][split_name] = {'data_type': data_type, 'class_names': list(class_names),
+                                       'num_records': len(samples), 'sample_shape': sample_shape,
+                                       'shards': shards_info}
+        print(f'{len(samples)} samples of {split_dir} saved in {num_shards} shards')
+
+    index_file = os.path.join(output_dir, 'index.json')
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=2)
+    print(f'index saved at: {index_file}')
+
+    return index_file
+
+
+def read_index(tfrecord_dir):
+    with open(os.path.join(tfrecord_dir, 'index.json'), 'r') as f:
+        return json.load(f)
+
+
+def parse_tfrecord_example(serialized, data_type, label_columns=()):
+    """
+    Parses a serialized example written by write_tfrecord_dataset. Images and masks are decoded to uint8
+    tensors (RGB), .npy stacks are restored to their original shape.
+    :return: (dict) features of the sample
+    """
+    features = {'image_name': tf.io.FixedLenFeature([], tf.string),
+                'image': tf.io.FixedLenFeature([], tf.string),
+                'shape': tf.io.VarLenFeature(tf.int64),
+                'label': tf.io.FixedLenFeature([], tf.int64)}
+    if data_type == 'segmentation':
+        features['mask'] = tf.io.FixedLenFeature([], tf.string)
+    for column in label_columns:
+        features[column] = tf.io.FixedLenFeature([], tf.string, default_value='')
+
+    sample = tf.io.parse_single_example(serialized, features)
+    if data_type == 'npy':
+        shape = tf.sparse.to_dense(sample.pop('shape'))
+        sample['image'] = tf.reshape(tf.io.decode_raw(sample['image'], tf.uint8), shape)
+    else:
+        sample.pop('shape')
+        sample['image'] = tf.io.decode_image(sample['image'], channels=3, expand_animations=False)
+    if data_type == 'segmentation':
+        sample['mask'] = tf.io.decode_image(sample['mask'], channels=1, expand_animations=False)
+
+    return sample
+
+
+def read_tfrecord_dataset(tfrecord_dir, split='train', batch_size=8, shuffle=False, buffer_size=500,
+                          cycle_length=4, img_size=256, map_fn=None, repeat=True, num_workers=1, worker_index=0):
+    """
+    Reads the shards of a split with interleave, so several shards are read sequentially in parallel.
+    By default it returns (x, y) pairs compatible with the existing pipelines:
+    - segmentation: (image BGR float32 in [0, 1], binary mask float32), as segmentation.call_models.tf_parse
+    - classification: (image RGB float32 in [0, 255], one-hot label)
+    - npy: (stack uint8 with the shape saved in the index, one-hot label), as call_models_tf.generate_tf_dataset
+    A custom map_fn receiving the dictionary of features can be given instead.
+
+    :param tfrecord_dir: (str) directory with the shards and the index.json file
+    :param split: (str) name of the split
+    :param batch_size: (int)
+    :param shuffle: (bool)
+    :param buffer_size: (int) shuffle buffer, in samples
+    :param cycle_length: (int) number of shards read at the same time
+    :param img_size: (int) size of the output images for the segmentation and classification types
+    :param map_fn: (function) function applied to each dictionary of features
+    :param repeat: (bool)
+    :param num_workers: (int) in a multi-worker training, each worker only reads one out of num_workers shard
+    files (one out of num_workers records if there are fewer files than workers)
+    :param worker_index: (int) index of this worker
+    :return: tf dataset, (int) number of samples of the split
+    """
+    index = read_index(tfrecord_dir)
+    split_info = index['splits'][split]
+    data_type = split_info['data_type']
+    num_classes = max(len(split_info['class_names']), 1)
+    shard_files = [os.path.join(tfrecord_dir, shard['file']) for shard in split_info['shards']]
+
+    # each worker reads its own shard files, the records are only split when there are fewer files than workers
+    shard_records = num_workers > 1 and len(shard_files) < num_workers
+    dataset = tf.data.Dataset.from_tensor_slices(shard_files)
+    if num_workers > 1 and not shard_records:
+        dataset = dataset.shard(num_workers, worker_index)
+        shard_files = shard_files[worker_index::num_workers]
+    if shuffle:
+        # same seed in every worker, so the record streams split below are the same
+        dataset = dataset.shuffle(len(shard_files), seed=0 if shard_records else None)
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=min(cycle_length, len(shard_files)),
+                                 num_parallel_calls=AUTOTUNE, deterministic=shard_records or not shuffle)
+    if shard_records:
+        dataset = dataset.shard(num_workers, worker_index)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size)
+    sample_shape = split_info.get('sample_shape')
+
+    def _to_x_y(sample):
+        if data_type == 'segmentation':
+            x = tf.image.resize(tf.reverse(sample['image'], axis=[-1]), [img_size, img_size]) / 255.0
+            y = tf.image.resize(sample['mask'], [img_size, img_size], method='nearest')
+            y = tf.cast(y > 127, tf.float32)
+            x.set_shape([img_size, img_size, 3])
+            y.set_shape([img_size, img_size, 1])
+        else:
+            if data_type == 'npy':
+                # the stacks stay uint8 until they reach the model
+                x = sample['image']
+                if sample_shape is not None:
+                    x.set_shape(sample_shape)
+            else:
+                x = tf.image.resize(sample['image'], [img_size, img_size])
+                x.set_shape([img_size, img_size, 3])
+            y = tf.one_hot(sample['label'], num_classes)
+        return x, y
+
+    if map_fn is None:
+        map_fn = _to_x_y
+
+    dataset = dataset.map(lambda serialized: parse_tfrecord_example(serialized, data_type, index['label_columns']),
+                          num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    dataset = dataset.map(map_fn, num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    dataset = dataset.batch(batch_size)
+    if repeat:
+        dataset = dataset.repeat()
+
+    return dataset.prefetch(AUTOTUNE), split_info['num_records']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Packs a train/val/test dataset into TFRecord shards')
+    parser.add_argument('--dataset_dir', type=str, required=True, help='directory with the train/val/test splits')
+    parser.add_argument('--output_dir', type=str, required=True, help='directory of the shards and of index.json')
+    parser.add_argument('--splits', type=str, default='train,val,test', help='splits to pack, separated by commas')
+    parser.add_argument('--shard_size_mb', type=int, default=100, help='approximate size of each shard')
+    parser.add_argument('--csv_annotations', type=str, default=None,
+                        help='annotations file, by default the .csv file of each split')
+    args = parser.parse_args()
+
+    write_tfrecord_dataset(args.dataset_dir, args.output_dir, splits=tuple(args.splits.split(',')),
+                           shard_size_mb=args.shard_size_mb, csv_annotations=args.csv_annotations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+import csv
+import os
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+
+
+def make_frame_preprocessing(input_size, preprocess_input=None, rgb=False, rescale=True):
+    """
+    Builds the function that converts a decoded frame (BGR, uint8) into the input of a model
+    :param input_size: (tuple) (width, height) of the input of the model
+    :param preprocess_input: function applied to the float32 frame in [0, 255] (e.g. the preprocess_input of a
+    backbone), it replaces the rescaling
+    :param rgb: (bool) convert the frame to RGB
+    :param rescale: (bool) rescale the frame to [0, 1], otherwise it stays uint8
+    :return: function
+    """
+    def _preprocess(frame):
+        x = cv2.resize(frame, tuple(input_size), interpolation=cv2.INTER_AREA)
+        if rgb is True:
+            x = cv2.cvtColor(x, cv2.COLOR_BGR2RGB)
+        if preprocess_input is not None:
+            return preprocess_input(x.astype(np.float32))
+        if rescale is True:
+            return x.astype(np.float32) / 255.0
+        return x
+
+    return _preprocess
+
+
+def annotate_classification(class_names=None):
+    """
+    Builds the function that writes the top-1 class and its score on the frame
+    :param class_names: (list) names of the classes, by default their index
+    :return: function
+    """
+    def _annotate(frame, output):
+        output = np.asarray(output).ravel()
+        i = int(np.argmax(output))
+        label = class_names[i] if class_names else str(i)
+        cv2.putText(frame, f'{label}: {output[i]:.2f}', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+        return frame
+
+    return _annotate
+
+
+def annotate_segmentation(threshold=0.5, alpha=0.4, color=(0, 255, 0)):
+    """
+    Builds the function that overlays the predicted mask on the frame
+    :param threshold: (float) threshold of the mask
+    :param alpha: (float) opacity of the mask
+    :param color: (tuple) BGR color of the mask
+    :return: function
+    """
+    def _annotate(frame, output):
+        h, w = frame.shape[:2]
+        mask = (np.squeeze(output) > threshold).astype(np.uint8)
+        mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST).astype(bool)
+        overlay = frame.copy()
+        overlay[mask] = color
+        return cv2.addWeighted(overlay, alpha, frame, 1 - alpha, 0)
+
+    return _annotate
+
+
+def default_csv_row(output, threshold=0.5):
+    """
+    Values saved in the CSV for each frame: the scores of a classifier, or the fraction of the frame covered by a
+    segmentation mask
+    """
+    output = np.asarray(output)
+    if output.ndim <= 1:
+        return [float(v) for v in output]
+    return [float(np.mean(output > threshold))]
+
+
+def _put(queue_items, item, stop_event=None, consumer=None, errors=None):
+    # blocking put that gives up if the pipeline is stopped, or if the thread consuming the queue failed or ended
+    while not (stop_event is not None and stop_event.is_set()) and not errors and \
+            (consumer is None or consumer.is_alive()):
+        try:
+            queue_items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _decode_frames(cap, queue_frames, stop_event, frame_step=1):
+    """
+    Decoder thread: reads the frames and puts (index, capture time, frame) in a bounded queue, with a video file
+    the queue being full slows the reading down to the speed of the model
+    """
+    index = 0
+    while not stop_event.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if index % frame_step == 0:
+            if not _put(queue_frames, (index, time.time(), frame), stop_event):
+                break
+        index += 1
+    cap.release()
+    _put(queue_frames, None, stop_event)
+
+
+def _write_outputs(queue_outputs, annotate_function, output_video, fps, output_csv, row_function, errors,
+                   source_fps=None):
+    """
+    Writer thread: annotates the frames and writes them in a video, and/or the outputs of each frame in a CSV file
+    """
+    video_writer = None
+    csv_file = open(output_csv, 'w', newline='') if output_csv else None
+    csv_writer = csv.writer(csv_file) if csv_file else None
+    header_written = False
+    try:
+        while True:
+            item = queue_outputs.get()
+            if item is None:
+                break
+            if errors:
+                continue
+            for index, time_stamp, frame, output in item:
+                if csv_writer is not None:
+                    row = row_function(output)
+                    if not header_written:
+                        csv_writer.writerow(['frame', 'time'] + ['output_' + str(i) for i in range(len(row))])
+                        header_written = True
+                    csv_writer.writerow([index, index / (source_fps or fps)] + row)
+                if output_video:
+                    if annotate_function is not None:
+                        frame = annotate_function(frame, output)
+                    if video_writer is None:
+                        h, w = frame.shape[:2]
+                        video_writer = cv2.VideoWriter(output_video, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                    video_writer.write(frame)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if video_writer is not None:
+            video_writer.release()
+        if csv_file is not None:
+            csv_file.close()
+
+
+def _split_outputs(outputs, n):
+    # one output per sample, for models with several outputs a list with the output of each head
+    if isinstance(outputs, (list, tuple)):
+        outputs = [np.asarray(o) for o in outputs]
+        return [[o[i] for o in outputs] for i in range(n)]
+    outputs = np.asarray(outputs)
+    return [outputs[i] for i in range(n)]
+
+
+def run_video_inference(model, source, preprocess_function=None, annotate_function=None, output_video='',
+                        output_csv='', row_function=default_csv_row, batch_size=8, max_latency=None,
+                        frame_step=1, queue_size=64):
+    """
+    Runs a Keras model over a video file or a camera. The frames are decoded in a separate thread and put in a
+    bounded queue, the model predicts micro-batches of frames and a writer thread saves the annotated frames
+    and/or a CSV with the output of each frame, so decoding, inference and writing overlap.
+
+    :param model: Keras model, e.g. from the load_model helpers
+    :param source: (str or int) path to the video or index of the camera
+    :param preprocess_function: function frame -> input of the model, by default the frame resized to the input
+    of the model and rescaled to [0, 1] (see make_frame_preprocessing)
+    :param annotate_function: function (frame, output) -> annotated frame (see annotate_classification and
+    annotate_segmentation)
+    :param output_video: (str) path of the annotated video, empty to not save it
+    :param output_csv: (str) path of the CSV file with the output of each frame, empty to not save it
+    :param row_function: function output -> list of values saved in the CSV
+    :param batch_size: (int) maximum number of frames predicted together
+    :param max_latency: (float) seconds, a micro-batch is sent to the model when it is full or when its first
+    frame has waited max_latency, None to always wait for full batches
+    :param frame_step: (int) process one out of frame_step frames
+    :param queue_size: (int) size of the queue of decoded frames
+    :return: (dict) number of frames, total time, fps and percentiles of the latency (capture to prediction)
+    """
+    if preprocess_function is None:
+        input_shape = model.inputs[0].shape
+        preprocess_function = make_frame_preprocessing((input_shape[-2], input_shape[-3]))
+
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise ValueError(f'Video source {source} could not be opened')
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+
+    stop_event = threading.Event()
+    queue_frames = queue.Queue(maxsize=queue_size)
+    queue_outputs = queue.Queue(maxsize=queue_size)
+    errors = list()
+    decoder = threading.Thread(target=_decode_frames, args=(cap, queue_frames, stop_event, frame_step),
+                               daemon=True)
+    writer = threading.Thread(target=_write_outputs,
+                              args=(queue_outputs, annotate_function, output_video, fps / frame_step, output_csv,
+                                    row_function, errors, fps), daemon=True)
+    decoder.start()
+    writer.start()
+
+    latencies = list()
+    num_frames = 0
+    init_time = time.time()
+    finished = False
+    try:
+        while not finished and not errors:
+            batch = list()
+            deadline = None
+            while len(batch) < batch_size:
+                timeout = None if deadline is None else max(deadline - time.time(), 0)
+                try:
+                    item = queue_frames.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    finished = True
+                    break
+                index, time_stamp, frame = item
+                x = preprocess_function(frame)
+                batch.append((index, time_stamp, frame, x))
+                if deadline is None and max_latency is not None:
+                    deadline = time_stamp + max_latency
+
+            if not batch:
+                continue
+            outputs = model.predict_on_batch(np.stack([element[3] for element in batch]))
+            prediction_time = time.time()
+            outputs = _split_outputs(outputs, len(batch))
+            latencies += [prediction_time - element[1] for element in batch]
+            num_frames += len(batch)
+            if not _put(queue_outputs, [(index, time_stamp, frame, output) for (index, time_stamp, frame, _), output
+                                        in zip(batch, outputs)], stop_event, consumer=writer, errors=errors):
+                break
+    finally:
+        if not finished:
+            stop_event.set()
+        # the writer drains the queue until it gets None, unless it already stopped because of an error
+        _put(queue_outputs, None, consumer=writer)
+        writer.join()
+        stop_event.set()
+        decoder.join()
+
+    if errors:
+        raise errors[0]
+
+    total_time = time.time() - init_time
+    stats = {'frames': num_frames, 'total_time': total_time,
+             'fps': num_frames / total_time if total_time > 0 else 0.,
+             'video_fps': fps / frame_step}
+    if latencies:
+        stats.update({'latency_p50': float(np.percentile(latencies, 50)),
+                      'latency_p90': float(np.percentile(latencies, 90)),
+                      'latency_p99': float(np.percentile(latencies, 99))})
+    print(f"Processed {num_frames} frames in {total_time:.1f}s ({stats['fps']:.1f} fps, "
+          f"video at {stats['video_fps']:.1f} fps)")
+    return stats
+
+
+def predict_video(model, source, results_directory, results_id, preprocess_input=None, rescale=True,
+                  class_names=None, batch_size=8, max_latency=None):
+    """
+    Classifies the frames of a video (or of the webcam) with run_video_inference, the annotated video and a CSV
+    with the scores of each frame are saved in results_directory. The frames are resized to the input of the
+    model and converted to RGB.
+    :param model: keras model with a single image input
+    :param source: (str or int) path to the video or index of the camera
+    :param results_directory: (str)
+    :param results_id: (str)
+    :param preprocess_input: function applied to the float32 RGB frame in [0, 255], see make_frame_preprocessing
+    :param rescale: (bool) rescale the frames to [0, 1], otherwise they stay uint8
+    :param class_names: (list)
+    :param batch_size: (int) frames predicted together
+    :param max_latency: (float) maximum time in seconds a frame waits for its batch to be full
+    :return: (dict) stats of the run
+    """
+    input_shape = model.inputs[0].shape
+    if len(model.inputs) > 1 or len(input_shape) != 4:
+        raise ValueError(f'the input of the model should be a batch of images, got {model.inputs}')
+    preprocess_function = make_frame_preprocessing((input_shape[2], input_shape[1]), preprocess_input=preprocess_input,
+                                                   rgb=True, rescale=rescale)
+    name_video = 'webcam' if isinstance(source, int) else os.path.splitext(os.path.basename(source))[0]
+    output_base = ''.join([results_directory, 'predictions_', name_video, '_', results_id])
+    stats = run_video_inference(model, source, preprocess_function=preprocess_function,
+                                annotate_function=annotate_classification(class_names),
+                                output_video=output_base + '_.mp4', output_csv=output_base + '_.csv',
+                                batch_size=batch_size, max_latency=max_latency)
+    print(f'Predictions saved at {output_base}')
+    return stats
+
+
+class LatestFrameSlot:
+    """
+    Holds only the newest frame captured. When the inference is slower than the camera the frames that were not
+    consumed in time are replaced (dropped), so the latency stays bounded instead of building a backlog.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._consumed = True
+        self.dropped = 0
+
+    def put(self, index, time_stamp, frame):
+        with self._condition:
+            if not self._consumed:
+                self.dropped += 1
+            self._item = (index, time_stamp, frame)
+            self._consumed = False
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Waits for a frame that was not consumed yet
+        :param timeout: (float) seconds
+        :return: (index, capture time, frame) or None if there was no new frame before the timeout
+        """
+        with self._condition:
+            if self._consumed:
+                self._condition.wait(timeout)
+            if self._consumed:
+                return None
+            self._consumed = True
+            return self._item
+
+
+def capture_to_slot(source, slot, stop_event, real_time=None):
+    """
+    Capture thread: reads the frames of a camera or a video file into a LatestFrameSlot. With a video file and
+    real_time the frames are read at the frame rate of the file, so it behaves like a camera.
+    :param source: (str or int) path to the video or index of the camera
+    :param slot: (LatestFrameSlot)
+    :param stop_event: (threading.Event) it is set when the source ends
+    :param real_time: (bool) by default True for video files
+    """
+    cap = cv2.VideoCapture(source)
+    if real_time is None:
+        real_time = not isinstance(source, int)
+    period = 1.0 / (cap.get(cv2.CAP_PROP_FPS) or 25.0)
+    index = 0
+    init_time = time.time()
+    while not stop_event.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if real_time is True:
+            delay = init_time + index * period - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        slot.put(index, time.time(), frame)
+        index += 1
+    cap.release()
+    stop_event.set()
+
+
+class LiveInference:
+    """
+    Live pipeline: capture thread -> newest frame slot -> inference thread -> display callback.
+
+    The inference thread always takes the newest frame available, annotates it with the output of the model and
+    passes it to on_result(annotated_frame, stats) together with the counters: end-to-end latency (capture to
+    annotated frame), effective fps of the processed frames and number of dropped frames.
+    """
+    def __init__(self, source, model=None, on_result=None, preprocess_function=None, annotate_function=None,
+                 real_time=None, smoothing=0.9):
+        """
+        :param source: (str or int) path to a video (stands in for the camera) or index of the camera
+        :param model: keras model, if None the frames are only displayed
+        :param on_result: function (annotated frame, stats)
+        :param preprocess_function: function frame -> input of the model, see make_frame_preprocessing
+        :param annotate_function: function (frame, output) -> annotated frame
+        :param real_time: (bool) read video files at their frame rate, by default True for video files
+        :param smoothing: (float) weight of the exponential moving averages of the counters
+        """
+        self.source = source
+        self.model = model
+        self.on_result = on_result
+        self.annotate_function = annotate_function
+        self.real_time = real_time
+        self.smoothing = smoothing
+        if model is not None and preprocess_function is None:
+            input_shape = model.inputs[0].shape
+            preprocess_function = make_frame_preprocessing((input_shape[-2], input_shape[-3]))
+        self.preprocess_function = preprocess_function
+        self.slot = LatestFrameSlot()
+        self.stop_event = threading.Event()
+        self.stats = {'frames': 0, 'dropped': 0, 'latency': 0., 'latency_avg': 0., 'fps': 0.}
+        # exception that stopped the inference thread, raised again by stop()
+        self.error = None
+        self._threads = list()
+
+    def start(self):
+        self._threads = [threading.Thread(target=capture_to_slot,
+                                          args=(self.source, self.slot, self.stop_event, self.real_time),
+                                          daemon=True),
+                         threading.Thread(target=self._run_inference, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def is_running(self):
+        return not self.stop_event.is_set()
+
+    def _update_stats(self, time_stamp, previous_time):
+        now = time.time()
+        latency = now - time_stamp
+        s = self.smoothing if self.stats['frames'] > 0 else 0.
+        self.stats['latency'] = latency
+        self.stats['latency_avg'] = s * self.stats['latency_avg'] + (1 - s) * latency
+        if previous_time is not None and now > previous_time:
+            self.stats['fps'] = s * self.stats['fps'] + (1 - s) / (now - previous_time)
+        self.stats['frames'] += 1
+        self.stats['dropped'] = self.slot.dropped
+        return now
+
+    def _run_inference(self):
+        previous_time = None
+        try:
+            while not self.stop_event.is_set():
+                item = self.slot.get(timeout=0.1)
+                if item is None:
+                    continue
+                index, time_stamp, frame = item
+                if self.model is not None:
+                    x = self.preprocess_function(frame)
+                    output = _split_outputs(self.model.predict_on_batch(np.expand_dims(x, axis=0)), 1)[0]
+                    if self.annotate_function is not None:
+                        frame = self.annotate_function(frame, output)
+                previous_time = self._update_stats(time_stamp, previous_time)
+                if self.on_result is not None:
+                    self.on_result(frame, dict(self.stats))
+        except Exception as e:
+            # the pipeline stops (is_running() is False) and stop() raises the error
+            self.error = e
+            self.stop_event.set()
@@ -38,6 +38,7 @@ flags.DEFINE_string('directory_model', '', 'indicate the path to the directory')
 flags.DEFINE_float('validation_split', 0.2, 'iif not validation dir but needed')
 flags.DEFINE_string('after_concat', 'globalpooling', 'layer after concatenation: Global average Pooling or Flatten')
 flags.DEFINE_string('file_to_predic', '', 'Directory or file where to perform predictions if predict mode selected')
+flags.DEFINE_string('tfrecord_dir', None, 'read the training and validation data from the TFRecord shards of this directory')
 flags.DEFINE_list('backbones', ['resnet50', 'resnet101'], 'A list of the nets used as backbones: resnet101, resnet50, densenet121, vgg19')
 
 def grad_cam_experiment(_argv):
@@ -66,7 +67,8 @@ def run_segmentation_experiment(_argv):
     for name_model in name_models:
         for batch in batches:
             for lr in learing_rates:
-                segm.call_model('train', project_folder, name_model, batch=batch, lr=lr)
+                segm.call_model('train', project_folder, name_model, batch=batch, lr=lr,
+                                tfrecord_dir=FLAGS.tfrecord_dir)
 
 
 def run_experiment_classification(_argv):
@@ -151,7 +153,8 @@ def run_experiment_classification_tf(_arv):
                                learning_rate=learning_rate, batch_size=batch_size,
                                dropout=dropout,
                                backbones=backbones,
-                               after_concat=after_concat)
+                               after_concat=after_concat,
+                               tfrecord_dir=FLAGS.tfrecord_dir)
 
 
 def main(_argv):
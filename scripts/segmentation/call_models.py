@@ -10,11 +10,15 @@ from tensorflow.keras.models import Model
 import copy
 import os
 import csv
+import inspect
+import queue
+import threading
 import matplotlib.pyplot as plt
 from segmentation.Unet_based import ResUnet
 from segmentation.Unet_based import Transpose_ResUnet
 from segmentation.Unet_based import Transpose_Unet
 from segmentation.Unet_based import Unet
+from segmentation.Unet_based import residual_unet
 from sklearn.metrics import average_precision_score
 from sklearn.metrics import recall_score
 from sklearn.metrics import accuracy_score
@@ -22,6 +26,9 @@ import datetime
 import tqdm
 from tensorflow.keras import layers
 from general_functions import data_management as dam
+from general_functions import tf_augmentation as tfaug
+from general_functions import distributed_training as dist
+from general_functions import tfrecord_data as tfr
 
 
 def load_model(project_folder, name_model):
@@ -141,17 +148,72 @@ def tf_parse_v3(x, y):
     y.set_shape([256, 256, 1])
     return (x_vol, x_frame), y
 
+
+def decode_image_tf(path, img_size=256, output_dtype=tf.float32):
+    """
+    Reads and decodes a PNG/JPEG image inside the TF graph. The channels are returned in BGR order so the
+    output matches read_image (cv2) and the models trained with it.
+    :param path: (tf.string) path to the image
+    :param img_size: (int) size of the output image
+    :param output_dtype: tf.float32 (normalized to [0, 1]) or tf.uint8 (raw [0, 255])
+    :return: (tensor) image of shape (img_size, img_size, 3)
+    """
+    x = tf.io.read_file(path)
+    x = tf.io.decode_image(x, channels=3, expand_animations=False)
+    x = tf.reverse(x, axis=[-1])
+    x = tf.image.resize(x, [img_size, img_size], method='bilinear')
+    if output_dtype == tf.uint8:
+        x = tf.cast(tf.clip_by_value(tf.round(x), 0, 255), tf.uint8)
+    else:
+        x = tf.cast(x / 255.0, output_dtype)
+    x.set_shape([img_size, img_size, 3])
+    return x
+
+
+def decode_mask_tf(path, img_size=256, output_dtype=tf.float32):
+    """
+    Reads, decodes and binarizes a mask inside the TF graph
+    :param path: (tf.string) path to the mask
+    :param img_size: (int) size of the output mask
+    :param output_dtype: tf.float32 (values {0, 1}) or tf.uint8 (values {0, 255})
+    :return: (tensor) mask of shape (img_size, img_size, 1)
+    """
+    y = tf.io.read_file(path)
+    y = tf.io.decode_image(y, channels=1, expand_animations=False)
+    y = tf.image.resize(y, [img_size, img_size], method='nearest')
+    y = y > 127
+    if output_dtype == tf.uint8:
+        y = tf.cast(y, tf.uint8) * 255
+    else:
+        y = tf.cast(y, output_dtype)
+    y.set_shape([img_size, img_size, 1])
+    return y
+
+
+def tf_parse_native(x, y, output_dtype=tf.float32):
+    """
+    Graph-native equivalent of tf_parse, it does not hold the GIL so it can be mapped in parallel
+    :param x: (tf.string) path to the image
+    :param y: (tf.string) path to the mask
+    :param output_dtype: tf.float32 or tf.uint8
+    :return: image, mask
+    """
+    return decode_image_tf(x, output_dtype=output_dtype), decode_mask_tf(y, output_dtype=output_dtype)
+
+
 batch_size = 32
 AUTOTUNE = tf.data.AUTOTUNE
 
 
-def prepare_dataset(dataset, shuffle=False, augment=False):
+def prepare_dataset(dataset, shuffle=False, augment=False, seed=0):
     """
-    2DO: Build the function to perform data augmentation on the fly
-    :param dataset:
-    :param shuffle:
-    :param augment:
-    :return:
+    Resizes, rescales and batches a dataset of (image, mask) pairs with the images in [0, 255]. If augment is
+    True the batches go through the on-the-fly augmentation stage (tf_augmentation.augment_tf_dataset)
+    :param dataset: (tf.data.Dataset) unbatched dataset of (image, mask)
+    :param shuffle: (bool)
+    :param augment: (bool) use it only on the training set
+    :param seed: (int) seed of the augmentation
+    :return: tf dataset
     """
     def resize_and_rescale(image, label):
         image = tf.cast(image, tf.float32)
@@ -161,8 +223,7 @@ def prepare_dataset(dataset, shuffle=False, augment=False):
         return image, label
 
     # Resize and rescale all datasets.
-    dataset = dataset.map(lambda x, y: (resize_and_rescale(x), y),
-                          num_parallel_calls=AUTOTUNE)
+    dataset = dataset.map(resize_and_rescale, num_parallel_calls=AUTOTUNE)
 
     if shuffle:
         dataset = dataset.shuffle(1000)
@@ -172,35 +233,82 @@ def prepare_dataset(dataset, shuffle=False, augment=False):
 
     # Use data augmentation only on the training set.
     if augment:
-      data_augmentation = tf.keras.Sequential([
-          layers.RandomFlip("horizontal_and_vertical"),
-          layers.RandomRotation(0.2),
-      ])
-
-    dataset = dataset.map(lambda x, y: (data_augmentation(x, training=True), y),
-                num_parallel_calls=AUTOTUNE)
+        dataset = tfaug.augment_tf_dataset(dataset, seed=seed, paired_masks=True, bgr=True)
 
     # Use buffered prefetching on all datasets.
     return dataset.prefetch(buffer_size=AUTOTUNE)
 
 
-def tf_dataset(x, y, batch=8, img_modality='rgb', shuffle=False):
+def tf_dataset(x, y, batch=8, img_modality='rgb', shuffle=False, native_decode=False, output_dtype='float32',
+               augment=False, augmentation_seed=0, shard=False):
+    """
+    Builds the tf.data pipeline used for training and evaluation
+    :param x: (list) paths to the images
+    :param y: (list) paths to the masks
+    :param batch: (int) batch size
+    :param img_modality: (str) 'rgb', 'npy' or 'ensemble'
+    :param shuffle: (bool) shuffle the samples
+    :param native_decode: (bool) decode 'rgb' data with TF ops instead of cv2 inside tf.numpy_function
+    :param output_dtype: (str) 'float32' or 'uint8', only used when native_decode is True
+    :param augment: (bool) augment the batches on the fly, the masks get the same geometric transformations
+    :param augmentation_seed: (int) seed of the augmentation
+    :param shard: (bool) in a multi-worker training keep only the samples of this worker
+    :return: tf dataset
+    """
+    if augment is True and img_modality == 'ensemble':
+        raise ValueError("on the fly augmentation is not available for img_modality='ensemble'")
+
     dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    if shard is True:
+        # each worker only reads its own files
+        dataset = dist.shard(dataset)
+
+    if shuffle:
+        # shuffling the paths is cheap, shuffling decoded images is not
+        dataset = dataset.shuffle(len(x), reshuffle_each_iteration=True)
 
     if img_modality == 'npy':
-        dataset = dataset.map(tf_parse_v2)
+        dataset = dataset.map(tf_parse_v2, num_parallel_calls=AUTOTUNE)
     elif img_modality == 'ensemble':
-        dataset = dataset.map(tf_parse_v3)
+        dataset = dataset.map(tf_parse_v3, num_parallel_calls=AUTOTUNE)
+    elif native_decode is True:
+        dtype = tf.uint8 if output_dtype == 'uint8' else tf.float32
+        dataset = dataset.map(lambda path_x, path_y: tf_parse_native(path_x, path_y, output_dtype=dtype),
+                              num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
     else:
-        dataset = dataset.map(tf_parse)
+        dataset = dataset.map(tf_parse, num_parallel_calls=AUTOTUNE)
 
     dataset = dataset.batch(batch)
     dataset = dataset.repeat()
+    if augment is True:
+        dataset = tfaug.augment_tf_dataset(dataset, seed=augmentation_seed, paired_masks=True, bgr=True)
+    if shard is True:
+        dataset = dist.finalize_dataset(dataset)
 
-    if shuffle:
-        dataset = dataset.shuffle(200)
+    return dataset.prefetch(buffer_size=AUTOTUNE)
+
+
+def tfrecord_dataset(tfrecord_dir, split, batch=8, shuffle=False, augment=False, augmentation_seed=0, shard=False):
+    """
+    Same (image, mask) batches as tf_dataset for 'rgb' data, read from the TFRecord shards written by
+    tfrecord_data.write_tfrecord_dataset instead of decoding one PNG per image and per mask
+    :param tfrecord_dir: (str) directory with the shards and index.json
+    :param split: (str) name of the split, e.g. 'train'
+    :return: tf dataset, (int) number of samples of the split
+    """
+    data_type = tfr.read_index(tfrecord_dir)['splits'][split]['data_type']
+    if data_type != 'segmentation':
+        raise ValueError(f'the split {split} of {tfrecord_dir} has {data_type} samples, images and masks expected')
+
+    num_workers, worker_index = (dist.num_workers(), dist.worker_index()) if shard is True else (1, 0)
+    dataset, num_samples = tfr.read_tfrecord_dataset(tfrecord_dir, split, batch_size=batch, shuffle=shuffle,
+                                                     num_workers=num_workers, worker_index=worker_index)
+    if augment is True:
+        dataset = tfaug.augment_tf_dataset(dataset, seed=augmentation_seed, paired_masks=True, bgr=True)
+    if shard is True:
+        dataset = dist.finalize_dataset(dataset)
 
-    return dataset
+    return dataset, num_samples
 
 
 def iou(y_true, y_pred, smooth=1e-15):
@@ -232,38 +340,152 @@ def dice_coef_loss(y_true, y_pred):
     return 1 - dice_coef(y_true, y_pred)
 
 
-def build_model(model_name):
+def bfloat16_supported():
+    """
+    True if there is a GPU with native bfloat16 (compute capability 8.0 or higher, Ampere and newer) or if the CPU
+    has native bfloat16 instructions (AVX512_BF16 or AMX), otherwise bfloat16 is emulated and slower than float32
+    """
+    gpus = tf.config.list_physical_devices('GPU')
+    if gpus:
+        compute_capability = tf.config.experimental.get_device_details(gpus[0]).get('compute_capability')
+        return compute_capability is not None and compute_capability >= (8, 0)
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            cpu_flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in cpu_flags or 'amx_bf16' in cpu_flags
+
+
+def build_model(model_name, precision='float32'):
+    """
+    :param model_name: (str)
+    :param precision: (str) 'float32' or 'mixed_bfloat16'. With mixed_bfloat16 the layers compute in bfloat16 and
+    keep float32 weights, the output of the model is cast back to float32. It falls back to float32 if the CPU
+    doesn't support bfloat16.
+    :return: keras Model
+    """
     print()
     size = 256
     num_filters = [16, 32, 48, 64]
     # num_filters = [64, 48, 32, 16]
     # num_filters = [64, 128, 256, 512]
-    inputs = Input((size, size, 3))
 
-    if model_name == 'Residual_Unet':
-        model = ResUnet.build_model()
+    policy = 'float32'
+    if precision == 'mixed_bfloat16':
+        if bfloat16_supported():
+            policy = 'mixed_bfloat16'
+        else:
+            print('bfloat16 not supported by this CPU, the model is built in float32')
+    elif precision != 'float32':
+        raise ValueError(f'precision {precision} not supported, options: float32, mixed_bfloat16')
+
+    # the policy only applies to the layers built here
+    previous_policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(policy)
+    try:
+        inputs = Input((size, size, 3))
 
-    elif model_name == 'Transpose_Unet':
-        model = Transpose_Unet.build_model()
+        if model_name == 'Residual_Unet':
+            model = ResUnet.build_model()
 
-    elif model_name == 'Transpose_ResUnet':
-        model = Transpose_ResUnet.build_model()
+        elif model_name == 'Transpose_Unet':
+            model = Transpose_Unet.build_model()
 
-    elif model_name == 'Unet':
-        model = Unet.build_model()
+        elif model_name == 'Transpose_ResUnet':
+            model = Transpose_ResUnet.build_model()
 
-    elif model_name == 'continuous_blocks_ResUnet':
-        model = continuous_blocks_ResUnet.build()
+        elif model_name == 'Unet':
+            model = Unet.build_model()
 
-    elif model_name == 'simple_ensemble':
-        model = ensemble.build_model()
+        elif model_name == 'residual_unet':
+            model = residual_unet.build_model(input_size=size, num_filters=list(num_filters))
 
-    elif model_name == 'ensemble':
-        model = ensemble_2.build_model()
+        elif model_name == 'continuous_blocks_ResUnet':
+            model = continuous_blocks_ResUnet.build()
+
+        elif model_name == 'simple_ensemble':
+            model = ensemble.build_model()
+
+        elif model_name == 'ensemble':
+            model = ensemble_2.build_model()
+
+        if policy != 'float32':
+            # the masks leave the model in float32, for the loss, the metrics and the threshold
+            outputs = Activation('linear', dtype='float32')(model.output)
+            model = Model(inputs=model.inputs, outputs=outputs, name=model.name)
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous_policy)
 
     return model
 
 
+def compile_model(model, optimizer, loss, metrics, jit_compile=False):
+    """
+    Compiles the model, with jit_compile the training and evaluation steps are compiled with XLA, which fuses the
+    conv/batch norm/relu blocks of the U-Nets
+    """
+    if jit_compile is True and 'jit_compile' not in inspect.signature(model.compile).parameters:
+        # the global XLA auto-clustering would also apply to every other model and tf.function of the process
+        print('WARNING: this version of keras has no jit_compile in compile, the model is compiled without XLA')
+        model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
+    elif jit_compile is True:
+        model.compile(optimizer=optimizer, loss=loss, metrics=metrics, jit_compile=True)
+    else:
+        model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
+    return model
+
+
+def make_predict_function(model, jit_compile=False):
+    """
+    Inference function of the model (training=False), compiled with XLA if jit_compile is True
+    :return: function x -> predictions (tensor float32)
+    """
+    def _predict(x):
+        return tf.cast(model(x, training=False), tf.float32)
+
+    return tf.function(_predict, jit_compile=jit_compile, experimental_relax_shapes=True)
+
+
+def check_numerics(model_name, precision='mixed_bfloat16', jit_compile=False, model=None, batch_size=4, seed=0,
+                   tolerance=0.05):
+    """
+    Compares the predictions of a model built with the given precision/XLA options against the float32 baseline
+    with the same weights on a fixed random batch
+
+    :param model_name: (str)
+    :param precision: (str) see build_model
+    :param jit_compile: (bool)
+    :param model: (keras Model) the weights of this model are used if given (e.g. after training), otherwise the
+    initial weights of the baseline
+    :param batch_size: (int)
+    :param seed: (int) seed of the fixed batch
+    :param tolerance: (float) maximum absolute difference accepted, a ValueError is raised above it
+    :return: (dict) max and mean absolute difference, fraction of pixels with the same mask
+    """
+    baseline = build_model(model_name)
+    candidate = build_model(model_name, precision=precision)
+    if model is not None:
+        baseline.set_weights(model.get_weights())
+    candidate.set_weights(baseline.get_weights())
+
+    x = np.random.default_rng(seed).uniform(0, 1, (batch_size,) + tuple(baseline.input_shape[1:]))
+    x = tf.constant(x, dtype=tf.float32)
+    y_baseline = make_predict_function(baseline)(x).numpy()
+    y_candidate = make_predict_function(candidate, jit_compile=jit_compile)(x).numpy()
+
+    difference = np.abs(y_baseline - y_candidate)
+    results = {'max_abs_error': float(np.max(difference)),
+               'mean_abs_error': float(np.mean(difference)),
+               'mask_agreement': float(np.mean((y_baseline > 0.5) == (y_candidate > 0.5)))}
+    print(f'Numerics check {precision}, XLA: {jit_compile} vs float32: {results}')
+    if results['max_abs_error'] > tolerance:
+        raise ValueError(f'{precision}, XLA: {jit_compile}: max absolute error {results["max_abs_error"]} above '
+                         f'{tolerance}')
+
+    return results
+
+
 def mask_parse(mask):
     mask = np.squeeze(mask)
     mask = [mask, mask, mask]
@@ -416,92 +638,108 @@ def read_results_csv(file_path, row_id=0):
         return dice_values
 
 
-def evaluate_and_predict(model, directory_to_evaluate,
-                         image_modality, results_directory, output_name, new_results_id):
+def _score_and_write_masks(queue_batches, results, errors):
+    """
+    Background worker of evaluate_and_predict: computes the metrics of each predicted mask against its
+    ground truth and writes the mask, while the model keeps predicting the next batches.
+    :param queue_batches: (queue.Queue) items (names, paths to save the masks, ground truth masks, predicted masks),
+    None to stop
+    :param results: (list) the rows [name, dice, sensitivity, specificity, accuracy] are appended here
+    :param errors: (list) exceptions raised by the worker
+    """
+    while True:
+        item = queue_batches.get()
+        if item is None:
+            break
+        if errors:
+            continue
+        try:
+            names, paths_results, ground_truth, predicted = item
+            for name, path_result, original_mask, predicted_mask in zip(names, paths_results, ground_truth,
+                                                                       predicted):
+                cv2.imwrite(path_result, predicted_mask.astype(np.uint8) * 255)
+                dice_val = dice(original_mask, predicted_mask)
+                sensitivity, specificity, accuracy = calculate_rates(original_mask, predicted_mask)
+                results.append([name, dice_val, sensitivity, specificity, accuracy])
+        except Exception as e:
+            errors.append(e)
+
 
+def evaluate_and_predict(model, directory_to_evaluate,
+                         image_modality, results_directory, output_name, new_results_id,
+                         native_decode=False, batch_size=8, jit_compile=False):
+    """
+    Predicts the masks of a directory with images/ and masks/ in a single pass over a prefetched dataset:
+    the loss and the compiled metrics, the masks written to results_directory/predictions/output_name/ and the
+    per-image metrics saved in the CSV file are all computed from the same batched predictions.
+
+    :param model: compiled keras model
+    :param directory_to_evaluate: (str)
+    :param image_modality: (str) 'rgb', 'npy' or 'ensemble'
+    :param results_directory: (str)
+    :param output_name: (str)
+    :param new_results_id: (str)
+    :param native_decode: (bool) see tf_dataset
+    :param batch_size: (int)
+    :param jit_compile: (bool) run the predictions with XLA
+    :return: (str) path of the CSV file with the results
+    """
     output_directory = 'predictions/' + output_name + '/'
-    batch_size = 8
+    result_mask_dir = results_directory + output_directory
+    os.makedirs(result_mask_dir, exist_ok=True)
     print(image_modality)
     (test_x, test_y) = load_data(directory_to_evaluate, image_modality)
-    test_dataset = tf_dataset(test_x, test_y, batch=batch_size,
-                              img_modality=image_modality)
     test_steps = (len(test_x)//batch_size)
-
     if len(test_x) % batch_size != 0:
         test_steps += 1
+    test_dataset = tf_dataset(test_x, test_y, batch=batch_size,
+                              img_modality=image_modality, native_decode=native_decode).take(test_steps)
 
-    # evaluate the model in the test dataset
-    model.evaluate(test_dataset, steps=test_steps)
+    list_names = [os.path.basename(x) for x in test_x]
+    paths_results = list()
+    for name_original_file in list_names:
+        if image_modality == 'npy' or image_modality == 'ensemble':
+            name_original_file = name_original_file.replace('.npy', '.png')
+        paths_results.append(''.join([result_mask_dir, name_original_file]))
+
+    queue_batches = queue.Queue(maxsize=8)
+    results = list()
+    errors = list()
+    writer = threading.Thread(target=_score_and_write_masks, args=(queue_batches, results, errors), daemon=True)
+    writer.start()
+
+    compiled = getattr(model, 'compiled_loss', None) is not None
+    if compiled:
+        model.reset_metrics()
+    predict_function = make_predict_function(model, jit_compile=True) if jit_compile is True \
+        else model.predict_on_batch
     times = []
-    for i, (x, y) in tqdm.tqdm(enumerate(zip(test_x, test_y)), total=len(test_x)):
-        directory_image = x
+    index = 0
+    for x, y in tqdm.tqdm(test_dataset, total=test_steps):
         init_time = time.time()
-        x = read_image_test(x, image_modality)
-        if image_modality == 'ensemble':
-            x_vol = np.expand_dims(x[0], axis=0)
-            x_frame = np.expand_dims(x[1], axis=0)
-            print(np.shape(x_vol))
-            print(np.shape(x_frame))
-            x = x_vol, x_frame
-        else:
-            x = np.expand_dims(x, axis=0)
-
-        y_pred = model.predict(x)[0] > 0.5
+        y_pred = predict_function(x)
         delta = time.time() - init_time
-        times.append(delta)
-        name_original_file = directory_image.replace(''.join([directory_to_evaluate, 'images/']), '')
-
-        if image_modality == 'npy' or image_modality == 'ensemble':
-            name_original_file = name_original_file.replace('.npy', '.png')
-        results_name = ''.join([results_directory, output_directory, name_original_file])
-        cv2.imwrite(results_name, y_pred * 255.0)
-
-    # save the results of the test dataset in a CSV file
-    ground_truth_imgs_dir = directory_to_evaluate + 'images/'
-    result_mask_dir = results_directory + output_directory
-
-    ground_truth_image_list = [file for file in os.listdir(ground_truth_imgs_dir) if
-                               os.path.isfile(os.path.join(ground_truth_imgs_dir, file))]
-    results_image_list = [file for file in os.listdir(result_mask_dir) if os.path.isfile(os.path.join(result_mask_dir, file))]
-    results_dice = []
-    results_sensitivity = []
-    results_specificity = []
-    output_directory = 'predictions/' + output_name + '/'
-    batch_size = 8
-    (test_x, test_y) = load_data(directory_to_evaluate, image_modality)
-    test_dataset = tf_dataset(test_x, test_y, batch=batch_size,
-                              img_modality=image_modality)
-    test_steps = (len(test_x) // batch_size)
-
-    # save the results of the test dataset in a CSV file
-    ground_truth_imgs_dir = directory_to_evaluate + 'images/'
-    ground_truth_labels_dir = directory_to_evaluate + 'masks/'
-    result_mask_dir = results_directory + output_directory
-
-    ground_truth_image_list = [file for file in os.listdir(ground_truth_imgs_dir) if
-                               os.path.isfile(os.path.join(ground_truth_imgs_dir, file))]
-    results_image_list = [file for file in os.listdir(result_mask_dir) if os.path.isfile(
-        os.path.join(result_mask_dir, file))]
-    results_dice = []
-    results_sensitivity = []
-    results_specificity = []
-    results_accuracy = []
-
-    for image in ground_truth_image_list[:]:
-        result_image = [name for name in results_image_list if image[:-4] == name[:-4]][0]
-        if result_image is not None:
-            image_name = image[:-4]
-            original_mask = read_img(''.join([ground_truth_labels_dir, image_name, '.png']))
-            predicted_mask = read_img(''.join([result_mask_dir, result_image]))
-            dice_val = dice(original_mask, predicted_mask)
-            results_dice.append(dice_val)
-            sensitivity, specificity, accuracy = calculate_rates(original_mask, predicted_mask)
-            results_sensitivity.append(sensitivity)
-            results_specificity.append(specificity)
-            results_accuracy.append(accuracy)
-
-        else:
-            print(image, 'not found in results list')
+        if compiled:
+            # the loss and metrics of model.evaluate, computed from the same predictions
+            y_true = tf.cast(y, y_pred.dtype)
+            model.compiled_loss(y_true, y_pred)
+            model.compiled_metrics.update_state(y_true, y_pred)
+
+        y_pred = np.asarray(y_pred) > 0.5
+        y_true = np.asarray(y) > 0
+        n = len(y_pred)
+        times += [delta / n] * n
+        queue_batches.put((list_names[index:index + n], paths_results[index:index + n], y_true, y_pred))
+        index += n
+
+    queue_batches.put(None)
+    writer.join()
+    if errors:
+        raise errors[0]
+
+    if compiled:
+        print('Evaluation results:')
+        print({metric.name: float(metric.result()) for metric in model.metrics})
 
     name_test_csv_file = ''.join([results_directory, 'results_evaluation_',
                                   output_name,
@@ -511,17 +749,9 @@ def evaluate_and_predict(model, directory_to_evaluate,
 
     with open(name_test_csv_file, mode='w') as results_file:
         results_file_writer = csv.writer(results_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        for i, file in enumerate(ground_truth_image_list):
-            results_file_writer.writerow(
-                [str(i), file, results_dice[i],
-                 results_sensitivity[i],
-                 results_specificity[i],
-                 results_accuracy[i]])
+        for i, (file, dice_val, sensitivity, specificity, accuracy) in enumerate(results):
+            results_file_writer.writerow([str(i), file, dice_val, sensitivity, specificity, accuracy])
 
-    if len(test_x) % batch_size != 0:
-        test_steps += 1
-        # evaluate the model in the test dataset
-    model.evaluate(test_dataset, steps=test_steps)
     print('Average inference times and std:')
     print(np.average(times), np.std(times))
     return name_test_csv_file
@@ -638,18 +868,27 @@ def save_plots(model_history, results_directory, new_results_id):
 
 
 def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750, prediction_folder='', augmented=False,
-               analyze_validation_set=False, evaluate_train_dir = False):
+               analyze_validation_set=False, evaluate_train_dir = False, native_decode=False,
+               offline_augmentation=False, precision='float32', jit_compile=False, tfrecord_dir=None):
+    """
+    :param precision: (str) 'float32' or 'mixed_bfloat16' (training only, the policy of a saved model is kept when
+    it is loaded)
+    :param jit_compile: (bool) compile the training, evaluation and prediction steps with XLA
+    :param tfrecord_dir: (str) read the training and validation data from the TFRecord shards of this directory
+    (tfrecord_data.py), only for models with 'rgb' images
+    """
 
     if mode == 'train':
-        # optimizer:
-        opt = tf.keras.optimizers.Adam(lr)
+        # if TF_CONFIG is set this process is one of the workers of a multi-worker training (distributed_training)
+        strategy = dist.get_strategy()
 
         # image modality of the data
         image_modality = 'rgb'
         # Define training and validation data
 
-        if augmented is True:
-
+        if augmented is True and offline_augmentation is True:
+            # materialize the augmented copy of the dataset on disk, otherwise the training batches
+            # are augmented on the fly (see tf_dataset)
             train_data_used = ''.join([project_folder, 'dataset/augmented/train/'])
             val_data_used = ''.join([project_folder, 'dataset/val/'])
 
@@ -663,8 +902,8 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
                 os.mkdir(''.join([augmented_dir, 'val/images/']))
                 os.mkdir(''.join([augmented_dir, 'val/masks/']))
 
-                dam.augment_dataset(''.join([project_folder, 'dataset/train/']), destination_path=train_data_used)
-                dam.augment_dataset(''.join([project_folder, 'dataset/val/']), destination_path=val_data_used)
+                dam.augment_dataset(''.join([project_folder, 'dataset/train/']), destination_path=train_data_used,
+                                    augment_maks=True)
 
         else:
             train_data_used = ''.join([project_folder, 'dataset/train/'])
@@ -685,24 +924,40 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
             val_data_used = ''.join([project_folder, 'volume_data/', str(3), '_continuous_frames/',
                                      'val'])
 
-        (train_x, train_y) = load_data(train_data_used, image_modality)
-        print('Data training: ', train_data_used)
+        augment_on_the_fly = augmented is True and offline_augmentation is False and image_modality != 'ensemble'
+        if tfrecord_dir is not None:
+            if image_modality != 'rgb':
+                raise ValueError(f'tfrecord_dir is not supported for {image_modality} data')
+            print('Data training and validation: ', tfrecord_dir)
+            train_dataset, num_train_samples = tfrecord_dataset(tfrecord_dir, 'train', batch=batch, shuffle=True,
+                                                                augment=augment_on_the_fly, shard=True)
+            valid_dataset, num_valid_samples = tfrecord_dataset(tfrecord_dir, 'val', batch=batch, shuffle=True,
+                                                                shard=True)
+        else:
+            (train_x, train_y) = load_data(train_data_used, image_modality)
+            print('Data training: ', train_data_used)
 
-        (valid_x, valid_y) = load_data(val_data_used, image_modality)
-        print('Data validation: ', val_data_used)
+            (valid_x, valid_y) = load_data(val_data_used, image_modality)
+            print('Data validation: ', val_data_used)
 
-        train_dataset = tf_dataset(train_x, train_y, batch=batch,
-                                   img_modality=image_modality, shuffle=True)
-        valid_dataset = tf_dataset(valid_x, valid_y, batch=batch,
-                                   img_modality=image_modality, shuffle=True)
+            train_dataset = tf_dataset(train_x, train_y, batch=batch,
+                                       img_modality=image_modality, shuffle=True,
+                                       native_decode=native_decode, augment=augment_on_the_fly, shard=True)
+            valid_dataset = tf_dataset(valid_x, valid_y, batch=batch,
+                                       img_modality=image_modality, shuffle=True,
+                                       native_decode=native_decode, shard=True)
+            num_train_samples, num_valid_samples = len(train_x), len(valid_x)
 
         # metrics list:
         metrics = ["acc", tf.keras.metrics.Recall(),
                    tf.keras.metrics.Precision(), dice_coef, iou]
 
-        model = build_model(name_model)
-        model.summary()
-        model.compile(optimizer=opt, loss=dice_coef_loss, metrics=metrics)
+        with strategy.scope():
+            # optimizer:
+            opt = tf.keras.optimizers.Adam(lr)
+            model = build_model(name_model, precision=precision)
+            model.summary()
+            model = compile_model(model, opt, dice_coef_loss, metrics, jit_compile=jit_compile)
         training_starting_time = datetime.datetime.now()
 
         # determine if also perform analysis of the training and validation dataset
@@ -719,6 +974,8 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
                                   ])
         results_directory = ''.join([project_folder, 'results/', name_model,
                                      '/', new_results_id, '/'])
+        # only the chief writes in the results directory
+        results_directory = dist.worker_directory(results_directory)
         # if results directory doesn't exists create it
         if not os.path.isdir(results_directory):
             os.mkdir(results_directory)
@@ -730,13 +987,13 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
             TensorBoard(),
             EarlyStopping(monitor='val_loss', patience=35, restore_best_weights=True)]
 
-        train_steps = len(train_x) // batch
-        valid_steps = len(valid_x) // batch
+        # steps of each worker, the same as len(x) / batch with a single worker
+        train_steps = dist.steps_per_worker(num_train_samples, batch)
+        valid_steps = dist.steps_per_worker(num_valid_samples, batch)
 
-        if len(train_x) % batch != 0:
-            train_steps += 1
-        if len(valid_x) % batch != 0:
-            valid_steps += 1
+        if precision != 'float32' or jit_compile is True:
+            # fails fast if the precision/XLA options change the predictions, before the training
+            check_numerics(name_model, precision=precision, jit_compile=jit_compile, model=model)
 
         start_time = datetime.datetime.now()
 
@@ -749,6 +1006,18 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
                                   callbacks=callbacks)
         # save the model
         model.save(results_directory + new_results_id + '_model')
+        if not dist.is_chief():
+            # the results and the evaluation are only written by the chief
+            dist.remove_worker_directory(results_directory)
+            return
+        if dist.num_workers() > 1:
+            # the copy saved outside the strategy is evaluated, see dist.load_saved_model
+            model = dist.load_saved_model(results_directory + new_results_id + '_model',
+                                          custom_objects={'dice_coef_loss': dice_coef_loss, 'dice_coef': dice_coef,
+                                                          'iou': iou})
+            model = compile_model(model, tf.keras.optimizers.Adam(lr), dice_coef_loss,
+                                  ["acc", tf.keras.metrics.Recall(), tf.keras.metrics.Precision(), dice_coef, iou],
+                                  jit_compile=jit_compile)
         print('Total Training TIME:', (datetime.datetime.now() - start_time))
         print('METRICS Considered:')
         print(model_history.history.keys())
@@ -775,7 +1044,8 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
                 evaluation_directory = ''.join([project_folder, 'dataset/test/', folder, '/'])
             name_test_csv_file = evaluate_and_predict(model, evaluation_directory,
                                                       image_modality,
-                                                      results_directory, folder, new_results_id)
+                                                      results_directory, folder, new_results_id,
+                                                      native_decode=native_decode, jit_compile=jit_compile)
             names_csv_files.append(name_test_csv_file)
 
         if analyze_validation_set is True:
@@ -787,7 +1057,8 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
                 evaluation_directory_val = project_folder + "dataset/val/"
             name_test_csv_file = evaluate_and_predict(model, evaluation_directory_val,
                                                       image_modality, results_directory,
-                                                      'val', new_results_id)
+                                                      'val', new_results_id,
+                                                      native_decode=native_decode, jit_compile=jit_compile)
 
         if evaluate_train_dir is True:
             os.mkdir(results_directory + 'predictions/train/')
@@ -798,7 +1069,8 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
                 evaluation_directory_val = project_folder + "dataset/train/"
             name_test_csv_file = evaluate_and_predict(model, evaluation_directory_val,
                                                       image_modality, results_directory,
-                                                      'train', new_results_id)
+                                                      'train', new_results_id,
+                                                      native_decode=native_decode, jit_compile=jit_compile)
 
     elif mode == 'predict':
         # load the model
@@ -815,6 +1087,7 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
             input_size_x = input_layer_shape[0][1]
             input_size_y = input_layer_shape[0][2]
 
+        predict_function = make_predict_function(model, jit_compile=jit_compile)
         list_imgs = [f for f in os.listdir(prediction_folder) if f.endswith('.png')]
         for i, input_img in enumerate(tqdm.tqdm(list_imgs, desc='Reading images')):
             # reshape the input frame to be compatible with the input of the network
@@ -823,7 +1096,7 @@ def call_model(mode, project_folder, name_model, batch=4, lr=0.001, epochs=750,
             reshaped_img = cv2.resize(input_image, (input_size_x, input_size_y),
                                       interpolation=cv2.INTER_AREA) /255
             # normalize the image
-            predicted_mask = model.predict(np.expand_dims(reshaped_img, axis=0))[0] >= 0.5
+            predicted_mask = predict_function(np.expand_dims(reshaped_img, axis=0).astype(np.float32))[0].numpy() >= 0.5
             name_original_file = directory_image.replace(''.join([prediction_folder, 'images/']), '')
 
 